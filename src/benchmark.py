@@ -0,0 +1,241 @@
+"""
+this script runs repeatable microbenchmarks of the database layer and the export path
+and saves the results as json, so that runs can be compared.
+usage: benchmark.py [-h] [--only NAME [NAME ...]] [--sizes N [N ...]] [--writes N] [--out PATH] [--compare PATH]
+benchmarks:
+    write       db_write throughput of each writable type, queueing and draining separately
+    read_user   db_read_user latency from the cache and from the db, idle and under a write load
+    from_db     ActionData.from_db materialization of the whole Actions table, for each of --sizes
+    migration   database_migration_scripts.update from the first schema version, for each of --sizes
+    decode      decode_db.py end-to-end export time (tsv, npz, summary), for each of --sizes
+the default sizes include 10M rows, which take several GB of memory in from_db.
+"""
+import sys
+
+
+def _check(cond: bool, err_msg: str):
+    if not cond:
+        print(err_msg, file=sys.stderr)
+        sys.exit(1)
+
+
+_check(__name__ == "__main__", err_msg="benchmark.py is a script, it cannot be imported")
+
+import json
+import platform
+import random
+import sqlite3 as sql
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from threading import Thread, Event
+from time import perf_counter, sleep
+from typing import Callable, Dict, List
+from mylib import (chips, database, database_migration_scripts as migration, resources as rss)
+
+_START_TIME = datetime(2021, 1, 1).timestamp()
+_USERS = 1000
+# actions of `_USERS` users, one per minute, codes cycled
+_FILL_ACTIONS = """
+WITH RECURSIVE c(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM c WHERE i < ?)
+INSERT INTO Actions (user, date, action) SELECT i % ?, ? + i * 60, 1 + i % 7 FROM c"""
+_FILL_USERS = """
+WITH RECURSIVE c(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM c WHERE i + 1 < ?)
+INSERT INTO Users (user, chip) SELECT i, i % 10000 FROM c"""
+# the schema before the first migration
+_V1_SCHEMA = """
+CREATE TABLE Users (user INTEGER NOT NULL PRIMARY KEY, chip INTEGER NOT NULL, email TEXT);
+CREATE TABLE Actions (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, user INTEGER NOT NULL,
+    date FLOAT NOT NULL, action INTEGER NOT NULL);"""
+
+
+def _latency_summary(samples: List[float]) -> Dict[str, float]:
+    """microseconds"""
+    samples = sorted(samples)
+
+    def q(p: float) -> float:
+        return samples[min(len(samples) - 1, int(p * len(samples)))] * 1e6
+    return {"n": len(samples), "mean_us": sum(samples) / len(samples) * 1e6,
+            "p50_us": q(.5), "p95_us": q(.95), "p99_us": q(.99)}
+
+
+def _new_db(tmp: Path, name: str, users: int = 0, actions: int = 0) -> Path:
+    """a database of the latest version, filled directly with sql"""
+    p = tmp / f"{name}.sqlite3"
+    p.unlink(missing_ok=True)
+    database.db_init(p)
+    database.db_terminate()[0].join()
+    with closing(sql.connect(p)) as conn:
+        if users:
+            conn.execute(_FILL_USERS, (users, ))
+        if actions:
+            conn.execute(_FILL_ACTIONS, (actions, _USERS, _START_TIME))
+            migration._updater_3(conn)  # the rollup of the filled actions
+        conn.commit()
+    return p
+
+
+def bench_write(tmp: Path, n: int) -> dict:
+    def run(name: str, writes: list, users: int = 0, actions: int = 0) -> dict:
+        database.db_init(_new_db(tmp, f"write_{name}", users, actions))
+        commits = database.db_commit_count()
+        start = perf_counter()
+        for w in writes:
+            database.db_write(w)
+        queued = perf_counter()
+        commits = database.db_commit_count() - commits
+        database.db_terminate()[0].join()  # returns once everything is committed
+        done = perf_counter()
+        return {"writes": len(writes), "queue_s": queued - start, "total_s": done - start,
+                "writes_per_s": len(writes) / (done - start), "commits_while_queueing": commits}
+
+    now = datetime.now()
+    return {
+        "ChipData": run("chip", [database.ChipData(u, u) for u in range(min(n, chips.CHIP_SPACE))]),
+        "EmailData": run("email", [database.EmailData(u, f"u{u}@example.com") for u in range(n)], users=n),
+        "ActionData": run("action", [database.ActionData(u % _USERS, now, database.actions(1 + u % 7))
+                                     for u in range(n)]),
+        "UndoActionData": run("undo", [
+            database.UndoActionData(i % _USERS, datetime.fromtimestamp(_START_TIME + i * 60), database.actions(1 + i % 7))
+            for i in range(1, n + 1)
+        ], actions=n),
+    }
+
+
+def bench_read_user(tmp: Path, n: int, users: int = 100_000, write_rate: float = 50_000) -> dict:
+    """:param write_rate: writes per second of the background load"""
+    def run(cache_size: int, load: bool) -> dict:
+        database.db_init(db_path, user_cache_size=cache_size)
+        stop = Event()
+
+        def writer():
+            now, chunk = datetime.now(), max(1, int(write_rate / 100))
+            while not stop.is_set():
+                for i in range(chunk):
+                    database.db_write(database.ActionData(i % _USERS, now, database.actions.sport))
+                sleep(.01)
+        load_thread = Thread(target=writer) if load else None
+        if load_thread is not None:
+            load_thread.start()
+            sleep(.2)
+        rng = random.Random(0)
+        samples = []
+        for _ in range(n):
+            user = rng.randrange(users)
+            start = perf_counter()
+            database.db_read_user(user)
+            samples.append(perf_counter() - start)
+        stop.set()
+        if load_thread is not None:
+            load_thread.join()
+        database.db_terminate()[0].join()
+        return _latency_summary(samples)
+
+    db_path = _new_db(tmp, "read_user", users=users)
+    return {
+        "cache_idle": run(users, False),
+        "db_idle": run(1, False),  # the cache holds one user, every lookup misses it
+        "cache_under_writes": run(users, True),
+        "db_under_writes": run(1, True),
+    }
+
+
+def bench_from_db(tmp: Path, sizes: List[int]) -> dict:
+    results = {}
+    for n in sizes:
+        db_path = _new_db(tmp, "from_db", actions=n)
+        with closing(database.connect_readonly(db_path)) as conn:
+            start = perf_counter()
+            rows = len(database.ActionData.from_db(conn))
+            elapsed = perf_counter() - start
+        results[str(n)] = {"rows": rows, "seconds": elapsed, "rows_per_s": rows / elapsed}
+        db_path.unlink()
+    return results
+
+
+def bench_migration(tmp: Path, sizes: List[int]) -> dict:
+    results = {}
+    for n in sizes:
+        db_path = tmp / "migration.sqlite3"
+        db_path.unlink(missing_ok=True)
+        with closing(sql.connect(db_path)) as conn:
+            conn.executescript(_V1_SCHEMA)
+            conn.execute(_FILL_ACTIONS, (n, _USERS, _START_TIME))
+            conn.commit()
+            start = perf_counter()
+            migration.update(conn, database.LATEST_DB_VERSION)
+            elapsed = perf_counter() - start
+        results[str(n)] = {"rows": n, "seconds": elapsed}
+        db_path.unlink()
+    return results
+
+
+def bench_decode(tmp: Path, sizes: List[int]) -> dict:
+    script = Path(__file__).resolve().with_name("decode_db.py")
+    results = {}
+    for n in sizes:
+        db_path = _new_db(tmp, "decode", users=_USERS, actions=n)
+        out_dir = tmp / "decode"
+        out_dir.mkdir(exist_ok=True)
+        results[str(n)] = {}
+        for name, options in (("tsv", ["--full"]), ("npz", ["--format", "npz"]), ("summary", ["--summary"])):
+            start = perf_counter()
+            done = subprocess.run([sys.executable, str(script), str(db_path), "--out-dir", str(out_dir), *options],
+                                  capture_output=True, text=True)
+            results[str(n)][name] = {"seconds": perf_counter() - start, "ok": done.returncode == 0}
+        db_path.unlink()
+    return results
+
+
+def compare(new: dict, old: dict, path: str = "") -> List[str]:
+    """:returns lines with ratios new/old of the numbers present in both results"""
+    lines = []
+    for k, v in new.items():
+        if k not in old:
+            continue
+        if isinstance(v, dict) and isinstance(old[k], dict):
+            lines.extend(compare(v, old[k], f"{path}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool) and isinstance(old[k], (int, float)) and old[k]:
+            lines.append(f"{path}{k}: {old[k]:.4g} -> {v:.4g} ({v / old[k]:.2f}x)")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="microbenchmarks of the database layer and the export path")
+    parser.add_argument("--only", nargs="+", choices=("write", "read_user", "from_db", "migration", "decode"),
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 1_000_000, 10_000_000],
+                        help="Actions rows for from_db, migration and decode")
+    parser.add_argument("--writes", type=int, default=100_000, help="writes of each type, and user lookups")
+    parser.add_argument("--out", type=Path, help="defaults to ../storage/benchmarks/<date>.json")
+    parser.add_argument("--compare", type=Path, help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    benchmarks: Dict[str, Callable[[Path], dict]] = {
+        "write": lambda tmp: bench_write(tmp, args.writes),
+        "read_user": lambda tmp: bench_read_user(tmp, args.writes),
+        "from_db": lambda tmp: bench_from_db(tmp, args.sizes),
+        "migration": lambda tmp: bench_migration(tmp, args.sizes),
+        "decode": lambda tmp: bench_decode(tmp, args.sizes),
+    }
+    results = {"meta": {
+        "date": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+        "sqlite": sql.sqlite_version, "machine": platform.platform(), "sizes": args.sizes, "writes": args.writes,
+    }}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.only or benchmarks:
+            print(f"{name}...", file=sys.stderr)
+            results[name] = benchmarks[name](Path(tmp))
+            print(json.dumps(results[name], indent=1))
+
+    out: Path = args.out or rss.STORAGE_PATH / "benchmarks" / f"{datetime.now():%Y%m%d_%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with out.open("wt") as f:
+        json.dump(results, f, indent=1)
+    print(f"Success, {out}")
+    if args.compare is not None:
+        with args.compare.open("rt") as f:
+            print("\n".join(compare({k: v for k, v in results.items() if k != "meta"}, json.load(f))))
@@ -1,6 +1,21 @@
-"""this script should convert ../storage/db.sqlite3 to plain-text tables"""
+"""
+this script should convert ../storage/db.sqlite3 to plain-text tables.
+usage: decode_db.py [-h] [--full | --delta] [--format {tsv,parquet,npz}] [--summary] [--out-dir DIR]
+    [path/to/db.sqlite3], the path defaults to ../storage/db_copy.sqlite3, the output directory to ../storage.
+the live database can be read too, since it is in WAL mode.
+
+by default the export is incremental: the last exported Actions.id is kept in a state file,
+and only newer actions are appended to the table. if chip or email of an exported user has changed,
+or exported actions have been deleted (undone), the table is re-exported in full, since its old rows are stale.
+--delta writes the new actions into separate files instead, with its own state file, so the table is not affected.
+
+parquet and npz formats always export the whole table as typed columns,
+they need numpy (and pyarrow for parquet, otherwise npz is written).
+
+--summary writes per user, day and action counts from the DailyActions rollup instead.
+"""
 import sys
-from datetime import datetime
+from datetime import datetime, date, timedelta
 
 
 def _check(cond: bool, err_msg: str):
@@ -12,55 +27,81 @@ def _check(cond: bool, err_msg: str):
 _check(__name__ == "__main__", err_msg="decode_db.py is a script, it cannot be imported")
 
 from pathlib import Path
+import importlib.util
 import sqlite3 as sql
-from typing import List, Optional
-from dataclasses import dataclass
-from collections import namedtuple
+import json
+from argparse import ArgumentParser
+from typing import Optional, Iterator, Callable, NamedTuple, Dict, Tuple, List
 from mylib import (database, resources as rss)
 
 
-
-# todo: move to database ==============================
+# actions without a Users row are kept, their email and chip are empty
+_READ_TABLE = """SELECT a.date, a.action, u.email, u.chip, a.user, a.description
+FROM Actions a LEFT JOIN Users u ON u.user = a.user
+WHERE a.id > ? AND a.id <= ?
+ORDER BY a.id"""
+_READ_LAST_ACTION_ID = "SELECT COALESCE(MAX(id), 0) FROM Actions"
+_COUNT_ACTIONS_UNTIL = "SELECT COUNT(*) FROM Actions WHERE id <= ?"
 _READ_ALL_USERS = "SELECT user, chip, email FROM Users"
+_READ_COLUMNS = """SELECT a.user, COALESCE(u.chip, -1), a.date, a.action, u.email, a.description
+FROM Actions a LEFT JOIN Users u ON u.user = a.user
+ORDER BY a.id"""
+_READ_SUMMARY = """SELECT d.day, d.action, u.email, u.chip, d.user, d.count, d.first, d.last
+FROM DailyActions d LEFT JOIN Users u ON u.user = d.user
+ORDER BY d.user, d.day, d.action"""
+_ACTION_NAMES: Dict[int, str] = {a.value: a.name for a in database.actions}
+_EPOCH = date(1970, 1, 1)
 
 
-@dataclass(frozen=True)
-class UserData:
-    user: int
-    chip: int
-    email: str
+class TimeFormatter:
+    """
+    formats epoch seconds as `fmt` in local time.
+    if `fmt` ends with seconds, the date and time up to minutes are formatted once per minute,
+    since all utc offsets are whole minutes. rows are ordered by time, so the cache is hit almost always
+    """
+    __slots__ = "fmt", "_minute", "_prefix"
 
-    @classmethod
-    def from_db(cls, db_conn: sql.Connection) -> List["UserData"]:
-        return list(cls(*x) for x in db_conn.execute(_READ_ALL_USERS).fetchall())
+    def __init__(self, fmt: str = rss.DATETIME_FMT):
+        self.fmt = fmt
+        self._minute = None
+        self._prefix = ""
 
+    def __call__(self, t: float) -> str:
+        if not self.fmt.endswith("%S"):
+            return datetime.fromtimestamp(t).strftime(self.fmt)
+        t = int(t)
+        minute, second = divmod(t, 60)
+        if minute != self._minute:
+            self._minute = minute
+            self._prefix = datetime.fromtimestamp(minute * 60).strftime(self.fmt[:-2])
+        return f"{self._prefix}{second:02d}"
 
-# ================================================================
 
-
-def read_Users(conn: sql.Connection) -> List[UserData]:
-    return UserData.from_db(conn)
-
-
-@dataclass(frozen=True)
-class TableRow:
-    time: datetime
+class TableRow(NamedTuple):
+    time: float  # epoch seconds
+    action: int
+    email: Optional[str]
+    chip: Optional[int]
     user: int
-    email: str
-    chip: int
-    action: database.actions
     description: Optional[str]
 
     @classmethod
-    def join(cls, a: database.ActionData, u: UserData) -> "TableRow":
-        return cls(a.time, a.user, u.email, u.chip, a.action, a.description)
+    def from_db(cls, conn: sql.Connection, after_id: int, last_id: int,
+                batch_size: int = 10_000) -> Iterator["TableRow"]:
+        """streams the joined table for `after_id < Actions.id <= last_id`, holds at most `batch_size` rows"""
+        cursor = conn.execute(_READ_TABLE, (after_id, last_id))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from map(cls._make, rows)
 
-    def to_str(self, sep: str = "\t", date_fmt=rss.DATETIME_FMT) -> str:
+    def to_str(self, sep: str = "\t", fmt_time: Callable[[float], str] = TimeFormatter()) -> str:
         return sep.join((
-            self.time.strftime(date_fmt),
-            self.action.name,
+            fmt_time(self.time),
+            _ACTION_NAMES[self.action],
             "" if self.email is None else self.email,
-            str(self.chip),
+            "" if self.chip is None else str(self.chip),
             str(self.user),
             "" if self.description is None else self.description,
         ))
@@ -70,19 +111,226 @@ class TableRow:
         return sep.join(("time", "action", "email", "chip_id", "tg_id", "action_description"))
 
 
+# ========================== incremental export ================================
+UserSnapshot = Dict[int, Tuple[int, Optional[str]]]  # user -> (chip, email)
+
+
+class ExportState(NamedTuple):
+    """what has already been exported, persisted next to the table"""
+    last_action_id: int
+    users: UserSnapshot
+    exported: Optional[int] = None  # number of actions with ids up to last_action_id, unknown in old state files
+
+    @classmethod
+    def load(cls, p: Path) -> "ExportState":
+        if not p.exists():
+            return cls(0, dict(), 0)
+        with p.open("rt") as f:
+            d = json.load(f)
+        return cls(d["last_action_id"], {int(u): (c, e) for u, (c, e) in d["users"].items()}, d.get("exported"))
+
+    def save(self, p: Path):
+        tmp = p.with_suffix(".tmp")
+        with tmp.open("wt") as f:
+            json.dump(dict(last_action_id=self.last_action_id, users=self.users, exported=self.exported), f)
+        tmp.replace(p)  # atomic, a crash leaves either the old or the new state
+
+    @staticmethod
+    def read_users(conn: sql.Connection) -> UserSnapshot:
+        return {u: (c, e) for u, c, e in conn.execute(_READ_ALL_USERS)}
+
+    def changed_users(self, users: UserSnapshot) -> List[int]:
+        """users that were exported before and whose chip or email differs now"""
+        return [u for u, old in self.users.items() if users.get(u, old) != old]
+
+    def deleted_actions(self, conn: sql.Connection) -> int:
+        """number of exported actions that are no longer in the database, e.g. undone"""
+        if self.exported is None:
+            return 0
+        (remaining, ), = conn.execute(_COUNT_ACTIONS_UNTIL, (self.last_action_id, )).fetchall()
+        return self.exported - remaining
+
+
+def export(conn: sql.Connection, out_path: Path, after_id: int, last_id: int, append: bool):
+    fmt_time = TimeFormatter()
+    with out_path.open("at" if append else "wt") as f:
+        if not append:
+            f.write(TableRow.header() + "\n")
+        f.writelines(row.to_str(fmt_time=fmt_time) + "\n" for row in TableRow.from_db(conn, after_id, last_id))
+
+
+def write_changed_users(p: Path, state: ExportState, users: UserSnapshot, changed: List[int], sep="\t"):
+    with p.open("wt") as f:
+        f.write(sep.join(("tg_id", "old_chip_id", "old_email", "chip_id", "email")) + "\n")
+        for u in changed:
+            f.write(sep.join(("" if x is None else str(x)) for x in (u, *state.users[u], *users.get(u, (None, None)))))
+            f.write("\n")
+
+
+# ========================== summary ================================
+def export_summary(conn: sql.Connection, out_path: Path, sep: str = "\t", batch_size: int = 10_000) -> Path:
+    p = out_path.with_name(out_path.stem + ".summary.txt")
+    fmt_time = TimeFormatter()
+    cursor = conn.execute(_READ_SUMMARY)
+    with p.open("wt") as f:
+        f.write(sep.join(("date", "action", "email", "chip_id", "tg_id", "count", "first", "last")) + "\n")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            f.writelines(sep.join((
+                (_EPOCH + timedelta(days=day)).isoformat(),
+                _ACTION_NAMES[action],
+                "" if email is None else email,
+                "" if chip is None else str(chip),
+                str(user),
+                str(count),
+                fmt_time(first),
+                fmt_time(last),
+            )) + "\n" for day, action, email, chip, user, count, first, last in rows)
+    return p
+
+
+# ========================== columnar export ================================
+class _Dictionary(dict):
+    """dictionary encoder: maps values to consecutive codes as they are met, None to -1"""
+    def __init__(self):
+        super().__init__({None: -1})
+        self.values: List[str] = []
+
+    def __missing__(self, key: str) -> int:
+        code = self[key] = len(self.values)
+        self.values.append(key)
+        return code
+
+
+def read_columns(conn: sql.Connection, batch_size: int = 100_000) -> dict:
+    """
+    reads the joined table as typed numpy columns, one fetchmany batch at a time.
+    missing chips are -1, email and description are dictionary-encoded (-1 for missing values),
+    their values are stored in `email_values` and `description_values`
+    """
+    import numpy as np
+    dtypes = dict(user=np.int64, chip=np.int16, time=np.float64, action=np.uint8, email=np.int32, description=np.int32)
+    chunks = {k: [] for k in dtypes}
+    emails, descriptions = _Dictionary(), _Dictionary()
+    cursor = conn.execute(_READ_COLUMNS)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        user, chip, time, action, email, description = zip(*rows)
+        for k, col in (("user", user), ("chip", chip), ("time", time), ("action", action)):
+            chunks[k].append(np.array(col, dtype=dtypes[k]))
+        chunks["email"].append(np.fromiter(map(emails.__getitem__, email), dtype=np.int32, count=len(rows)))
+        chunks["description"].append(
+            np.fromiter(map(descriptions.__getitem__, description), dtype=np.int32, count=len(rows)))
+    columns = {k: np.concatenate(v) if v else np.empty(0, dtype=dtypes[k]) for k, v in chunks.items()}
+    columns["email_values"] = np.array(emails.values, dtype=str)
+    columns["description_values"] = np.array(descriptions.values, dtype=str)
+    return columns
+
+
+def write_npz(columns: dict, p: Path):
+    import numpy as np
+    np.savez(p, **columns)  # not compressed, so the file can be loaded (or memory-mapped) quickly
+
+
+def write_parquet(columns: dict, p: Path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    def dictionary(k: str) -> pa.DictionaryArray:
+        codes = columns[k]
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes, mask=codes < 0), pa.array(columns[k + "_values"], type=pa.string()))
+
+    table = pa.table(dict(
+        user=columns["user"],
+        chip=pa.array(columns["chip"], mask=columns["chip"] < 0),
+        time=columns["time"],
+        action=columns["action"],
+        email=dictionary("email"),
+        description=dictionary("description"),
+    ))
+    pq.write_table(table, p)
+
+
+def export_columns(conn: sql.Connection, out_path: Path, fmt: str) -> Path:
+    """:returns path of the written file, parquet falls back to npz if pyarrow is missing"""
+    if fmt == "parquet":
+        if importlib.util.find_spec("pyarrow") is None:
+            print("pyarrow is not installed, writing npz instead of parquet", file=sys.stderr)
+            fmt = "npz"
+    columns = read_columns(conn)
+    p = out_path.with_suffix("." + fmt)
+    write_parquet(columns, p) if fmt == "parquet" else write_npz(columns, p)
+    return p
+
+
 if __name__ == "__main__":
-    out_path = rss.STORAGE_PATH / "db_copy.txt"
-    db_path = rss.STORAGE_PATH / "db_copy.sqlite3"
+    parser = ArgumentParser(description="exports the database to a tab-separated table")
+    parser.add_argument("db_path", nargs="?", type=Path, default=rss.STORAGE_PATH / "db_copy.sqlite3")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--full", action="store_true", help="re-export the whole table")
+    mode.add_argument("--delta", action="store_true",
+                      help="write new actions (and changed users) into separate delta files, "
+                           "the main table is left as is")
+    parser.add_argument("--format", choices=("tsv", "parquet", "npz"), default="tsv",
+                        help="parquet and npz write the whole table as typed columns, "
+                             "the tsv table and its export state are not touched")
+    parser.add_argument("--summary", action="store_true",
+                        help="write daily counts per user and action from the rollup table instead")
+    parser.add_argument("--out-dir", type=Path, default=rss.STORAGE_PATH,
+                        help="directory of the exported files and the export state")
+    args = parser.parse_args()
+
+    out_path = args.out_dir / "db_copy.txt"
+    state_path = args.out_dir / "db_copy.state.json"
+    delta_state_path = args.out_dir / "db_copy.delta.state.json"  # deltas do not move the watermark of the table
+    db_path: Path = args.db_path
     _check(db_path.exists(), err_msg=f"{db_path} does not exist.")
-    conn = sql.connect(db_path)
-    user_dict = {user.user: user for user in read_Users(conn)}
-    rows = [TableRow.join(action, user_dict[action.user])
-            for action in database.ActionData.from_db(conn)]
-    conn.close()
-    del user_dict
+    conn = database.connect_readonly(db_path)
+    if args.summary:
+        print(f"Success, {export_summary(conn, out_path)}")
+        conn.close()
+        sys.exit(0)
+    if args.format != "tsv":
+        print(f"Success, {export_columns(conn, out_path, args.format)}")
+        conn.close()
+        sys.exit(0)
+    conn.execute("BEGIN")  # one read transaction, so users and actions are read from the same snapshot
+    (last_id, ), = conn.execute(_READ_LAST_ACTION_ID).fetchall()
+    users = ExportState.read_users(conn)
+    state = ExportState.load(delta_state_path if args.delta and delta_state_path.exists() else state_path)
+    changed = state.changed_users(users)
+    full = args.full or not out_path.exists()
+    deleted = 0 if full else state.deleted_actions(conn)
+    if deleted and not full:
+        # the exported table has no ids, so deleted rows can not be marked in a delta
+        print(f"{deleted} exported actions were deleted, re-exporting the whole table", file=sys.stderr)
+        full = True
+    if last_id < state.last_action_id and not full:
+        print(f"the last exported action {state.last_action_id} is gone, re-exporting the whole table", file=sys.stderr)
+        full = True
+    if changed and not args.delta and not full:
+        print(f"chip or email changed for {len(changed)} users, re-exporting the whole table", file=sys.stderr)
+        full = True
 
-    with out_path.open("wt") as f:
-        f.write(TableRow.header() + "\n")
-        for row in rows:
-            f.write(row.to_str() + "\n")
+    if full:
+        export(conn, out_path, 0, last_id, append=False)
+    elif args.delta:
+        delta_path = out_path.with_name(f"db_copy.delta_{state.last_action_id + 1}-{last_id}.txt")
+        export(conn, delta_path, state.last_action_id, last_id, append=False)
+        if changed:
+            write_changed_users(delta_path.with_suffix(".users.txt"), state, users, changed)
+    else:
+        export(conn, out_path, state.last_action_id, last_id, append=True)
+    (exported, ), = conn.execute(_COUNT_ACTIONS_UNTIL, (last_id, )).fetchall()
+    conn.close()
+    new_state = ExportState(last_id, users, exported)
+    if full or not args.delta:
+        new_state.save(state_path)
+    if args.delta:
+        new_state.save(delta_state_path)
     print("Success")
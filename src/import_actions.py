@@ -0,0 +1,62 @@
+"""
+this script imports actions collected offline (on paper, in an nfc reader app) into ../storage/db.sqlite3,
+the bot may be running. see mylib/importer.py for the table layout and how rows are checked.
+usage: import_actions.py [-h] [--db PATH] [--chips PATH] [--chunk-size N] [--transaction-seconds S] [--dry-run]
+                         table [table ...]
+per-row errors of `table` are written into `table.errors.txt`.
+"""
+import sys
+
+
+def _check(cond: bool, err_msg: str):
+    if not cond:
+        print(err_msg, file=sys.stderr)
+        sys.exit(1)
+
+
+_check(__name__ == "__main__", err_msg="import_actions.py is a script, it cannot be imported")
+
+from pathlib import Path
+from argparse import ArgumentParser
+from contextlib import closing
+from time import perf_counter
+import sqlite3 as sql
+from mylib import (chips, database, database_migration_scripts as migration, importer, resources as rss)
+
+_SHOWN_ERRORS = 10
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="imports tab- or comma-separated tables of actions in the decode_db.py layout")
+    parser.add_argument("tables", nargs="+", type=Path)
+    parser.add_argument("--db", type=Path, default=rss.DATABASE_PATH)
+    parser.add_argument("--chips", type=Path, default=rss.CHIPS_PATH, help="valid chip ids")
+    parser.add_argument("--chunk-size", type=int, default=importer.DEFAULT_CHUNK_SIZE,
+                        help="maximal rows per transaction")
+    parser.add_argument("--transaction-seconds", type=float, default=importer.DEFAULT_TRANSACTION_SECONDS,
+                        help="how long a transaction may hold the write lock, chunks are sized for it")
+    parser.add_argument("--dry-run", action="store_true", help="check the rows and count duplicates, write nothing")
+    args = parser.parse_args()
+
+    _check(args.db.exists(), err_msg=f"{args.db} does not exist.")
+    with closing(sql.connect(args.db)) as conn:
+        version = migration.get_version(conn)
+    _check(version == database.LATEST_DB_VERSION,
+           err_msg=f"{args.db} is of version {version}, start the bot once to migrate it")
+    try:
+        valid_chips = chips.parse_chip_file(args.chips)
+    except (OSError, ValueError) as e:
+        _check(False, err_msg=f"{args.chips}: {e}")
+    for table in args.tables:
+        _check(table.exists(), err_msg=f"{table} does not exist.")
+        start = perf_counter()
+        report = importer.import_file(table, args.db, valid_chips, chunk_size=args.chunk_size, dry_run=args.dry_run,
+                                      transaction_seconds=args.transaction_seconds)
+        seconds = perf_counter() - start
+        print(f"{table}: {report.summary()}, {report.rows / max(seconds, 1e-9):.0f} rows/s"
+              f"{' (dry run)' if args.dry_run else ''}")
+        if report.errors:
+            for line, error in report.errors[:_SHOWN_ERRORS]:
+                print(f"  line {line}: {error}", file=sys.stderr)
+            print(f"  errors: {report.write_errors(table.with_name(table.name + '.errors.txt'))}", file=sys.stderr)
+    print("Success")
@@ -0,0 +1,211 @@
+"""
+this script finds how many participants one instance can serve before latency degrades.
+the bot runs in-process against a local stand-in for the telegram bot api and a temporary database,
+simulated participants go through the login conversation and then register actions.
+usage: loadtest.py [-h] [--users N] [--concurrency N] [--actions N] [--real-limits] [--runtime {threads,asyncio}]
+                    [--timeout S] [--json PATH]
+reports p50/p95/p99 response latency per step, logins and registrations per second and db write throughput.
+"""
+import sys
+
+
+def _check(cond: bool, err_msg: str):
+    if not cond:
+        print(err_msg, file=sys.stderr)
+        sys.exit(1)
+
+
+_check(__name__ == "__main__", err_msg="loadtest.py is a script, it cannot be imported")
+
+import json
+import sqlite3 as sql
+import tempfile
+from argparse import ArgumentParser
+from collections import deque
+from contextlib import closing
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Deque, Dict, List, NamedTuple, Optional
+from telegram.ext import Updater
+from mylib import (aio, database, outbox, bot_builder, resources as rss, messages as msg)
+from mylib.fake_bot_api import FakeBotApi
+
+_BOT_TOKEN = "100001:load_test"
+
+
+class Step(NamedTuple):
+    name: str
+    text: str
+    expect: str  # the step is complete once a reply contains it
+
+
+def _marker(template: str) -> str:
+    """constant beginning of a message template"""
+    return template.split("{")[0]
+
+
+def login_steps(chip: int) -> List[Step]:
+    skip = f"/{bot_builder.SKIP_CMD}"
+    return [
+        Step("start", f"/{bot_builder.START_CMD}", _marker(msg.ru.LOGIN_CHIP_ASK)),
+        Step("chip", f"{chip:04d}", _marker(msg.ru.LOGIN_EMAIL_ASK)),
+        Step("skip_email", skip, _marker(msg.ru.LOGIN_SURVEY_ASK)),
+        Step("skip_survey", skip, _marker(msg.ru.MAIN_MENU)),
+    ]
+
+
+def action_steps(action: str) -> List[Step]:
+    return [
+        Step("action_start", msg.ru.REGISTER_ACTION, _marker(msg.ru.ACTION_START)),
+        Step("action", action, _marker(msg.ru.ACTION_CONFIRMATION_ASK)),
+        Step("confirm", msg.ru.YES, _marker(msg.ru.MAIN_MENU)),
+    ]
+
+
+class _Participant:
+    __slots__ = "user", "steps", "step", "sent_at"
+
+    def __init__(self, user: int, steps: List[Step]):
+        self.user = user
+        self.steps = steps
+        self.step = 0
+        self.sent_at = 0.
+
+
+class LoadTest:
+    """keeps `concurrency` participants active, each sends its next message as soon as the previous one is answered"""
+
+    def __init__(self, users: int, concurrency: int, actions: int):
+        actions_names = [a for a, code in msg.ru.STR_TO_ACTIONS.items() if code != database.actions.unlisted_action]
+        self.api: Optional[FakeBotApi] = None
+        self.concurrency = concurrency
+        self.waiting: Deque[_Participant] = deque(
+            _Participant(10_000_000 + i, login_steps(i % 10_000) + [
+                s for j in range(actions) for s in action_steps(actions_names[(i + j) % len(actions_names)])
+            ]) for i in range(users)
+        )
+        self.active: Dict[int, _Participant] = dict()
+        self.latency: Dict[str, List[float]] = {s.name: [] for s in login_steps(0) + action_steps("")}
+        self.logins = 0
+        self.registrations = 0
+        self.done = Event()
+        self._lock = Lock()
+
+    def start(self, api: FakeBotApi):
+        self.api = api
+        with self._lock:
+            for _ in range(min(self.concurrency, len(self.waiting))):
+                self._activate()
+
+    def _activate(self):
+        p = self.waiting.popleft()
+        self.active[p.user] = p
+        self._send(p)
+
+    def _send(self, p: _Participant):
+        p.sent_at = monotonic()
+        self.api.push_message(p.user, p.steps[p.step].text)
+
+    def on_reply(self, chat_id: int, text: str):
+        now = monotonic()
+        with self._lock:
+            p = self.active.get(chat_id)
+            if p is None or p.steps[p.step].expect not in text:
+                return  # an intermediate reply
+            step = p.steps[p.step]
+            self.latency[step.name].append(now - p.sent_at)
+            self.logins += step.name == "skip_survey"
+            self.registrations += step.name == "confirm"
+            p.step += 1
+            if p.step < len(p.steps):
+                return self._send(p)
+            del self.active[chat_id]
+            if self.waiting:
+                self._activate()
+            elif not self.active:
+                self.done.set()
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    return {"n": len(values), **{f"p{int(q * 100)}": _percentile(values, q) for q in (.5, .95, .99)}}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="drives simulated participants through the bot against a fake bot api")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=500, help="participants active at the same time")
+    parser.add_argument("--actions", type=int, default=3, help="actions registered by each participant")
+    parser.add_argument("--real-limits", action="store_true", help="keep telegram rate limits in the outbox")
+    parser.add_argument("--runtime", choices=("threads", "asyncio"), default="threads",
+                        help="how handlers that wait for the db run")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds")
+    parser.add_argument("--json", type=Path, help="also write the results into this file")
+    args = parser.parse_args()
+
+    test = LoadTest(args.users, args.concurrency, args.actions)
+    api = FakeBotApi(0, test.on_reply)
+    Thread(target=api.serve_forever, name="fake_api", daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "db.sqlite3"
+        database.db_init(db_path)
+        rss.valid_chips.update(range(10_000))
+        limits = {} if args.real_limits else {"global_rate": 1e9, "chat_rate": 1e9, "chat_burst": 1e9}
+        try:
+            updater = Updater(_BOT_TOKEN, base_url=api.url,
+                              request_kwargs={"con_pool_size": outbox.DEFAULT_WORKERS + 8})
+            outbox.outbox_init(updater.bot, **limits)
+            runtime = aio.AsyncRuntime() if args.runtime == "asyncio" else None
+            if runtime is not None:
+                runtime.start()
+            bot_builder.build_bot(updater, runtime=runtime)
+            updater.start_polling(poll_interval=0, timeout=10)
+            commits_before = database.db_commit_count()
+            start = monotonic()
+            test.start(api)
+            finished = test.done.wait(args.timeout)
+            elapsed = monotonic() - start
+            commits = database.db_commit_count() - commits_before
+            api.close()
+            updater.stop()
+            if runtime is not None:
+                runtime.stop()
+            outbox.outbox_terminate().join()
+        finally:
+            database.db_terminate()[0].join()
+            api.shutdown()
+        with closing(sql.connect(db_path)) as conn:
+            actions_written, = conn.execute("SELECT COUNT(*) FROM Actions").fetchone()
+            users_written, = conn.execute("SELECT COUNT(*) FROM Users").fetchone()
+
+    results = {
+        "users": args.users, "concurrency": args.concurrency, "actions_per_user": args.actions, "runtime": args.runtime,
+        "real_limits": args.real_limits, "finished": finished, "elapsed": elapsed,
+        "unfinished_users": len(test.active) + len(test.waiting),
+        "latency": {name: _summary(v) for name, v in test.latency.items()},
+        "all": _summary([x for v in test.latency.values() for x in v]),
+        "logins_per_second": test.logins / elapsed,
+        "registrations_per_second": test.registrations / elapsed,
+        "db": {"users": users_written, "actions": actions_written, "commits": commits,
+               "rows_per_second": (users_written + actions_written) / elapsed,
+               "rows_per_commit": (users_written + actions_written) / max(commits, 1)},
+    }
+    print(f"{args.users} users, {args.concurrency} concurrent, {args.actions} actions each: "
+          f"{elapsed:.1f} s{'' if finished else ', TIMED OUT'}")
+    print(f"{'step':<14}{'n':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, s in list(results["latency"].items()) + [("all", results["all"])]:
+        print(f"{name:<14}{s['n']:>8}{s['p50'] * 1e3:>10.1f}{s['p95'] * 1e3:>10.1f}{s['p99'] * 1e3:>10.1f}")
+    print(f"logins {test.logins} ({results['logins_per_second']:.1f}/s), "
+          f"registrations {test.registrations} ({results['registrations_per_second']:.1f}/s)")
+    db = results["db"]
+    print(f"db: {db['users']} users and {db['actions']} actions in {db['commits']} commits, "
+          f"{db['rows_per_second']:.0f} rows/s, {db['rows_per_commit']:.1f} rows/commit")
+    if args.json is not None:
+        with args.json.open("wt") as f:
+            json.dump(results, f, indent=1)
+    _check(finished, err_msg="not all participants finished before the timeout")
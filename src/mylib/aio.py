@@ -0,0 +1,110 @@
+"""
+asyncio runtime for handlers. coroutine handlers run on one event loop thread instead of taking a pool thread each,
+waiting for the database is awaiting the futures of the reader pool and the db thread.
+python-telegram-bot 13 dispatches in threads, so a coroutine handler is registered through :meth:`AsyncRuntime.handler`,
+which schedules it and returns a Promise: conversations wait for it as they wait for `run_async` handlers
+"""
+import asyncio
+import contextvars
+import logging
+from datetime import datetime, date
+from functools import update_wrapper
+from threading import Thread
+from typing import Awaitable, Callable, List, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext
+from telegram.ext.utils.promise import Promise
+
+from . import database
+from .database import ActionCursor, ActionData, ActionPage, ChipData, DailyActionData, StatsData
+
+DEFAULT_STOP_TIMEOUT = 10.  # seconds for running handlers to finish on stop
+
+AsyncHandler = Callable[[Update, CallbackContext], Awaitable]
+
+
+class AsyncRuntime:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self.loop.run_forever, name="aio", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: float = DEFAULT_STOP_TIMEOUT):
+        """waits for the running handlers, the ones still running after `timeout` are cancelled"""
+        async def drain():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=timeout)
+                for t in pending:
+                    t.cancel()
+
+        asyncio.run_coroutine_threadsafe(drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def handler(self, callback: AsyncHandler) -> "ScheduledHandler":
+        """a handler callback that runs the coroutine `callback` on the loop"""
+        return ScheduledHandler(self, callback)
+
+
+class ScheduledHandler:
+    """
+    schedules the coroutine `callback` on the loop of `runtime` and returns a Promise of its result,
+    the log context of the calling thread (see logs.update_context) is carried into it.
+    the call returns at once, wrap `callback` to measure the handler
+    """
+
+    def __init__(self, runtime: AsyncRuntime, callback: AsyncHandler):
+        self.runtime = runtime
+        self.callback = callback
+        update_wrapper(self, callback)
+
+    def __call__(self, update: Update, context: CallbackContext) -> Promise:
+        future = asyncio.run_coroutine_threadsafe(
+            _logged(self.callback(update, context), contextvars.copy_context()), self.runtime.loop)
+        promise = Promise(future.result, (), {}, update=update)
+        future.add_done_callback(lambda _: promise.run())  # the future is done, run() only stores its result
+        return promise
+
+
+async def _logged(coroutine: Awaitable, context: contextvars.Context):
+    for var, value in context.items():
+        var.set(value)
+    try:
+        return await coroutine
+    except Exception as e:
+        logging.getLogger(__name__).error("async handler failed", exc_info=e)
+        raise
+
+
+# ============================== database facade =============================
+async def write(data: database.sqlite_writable_types):
+    """returns once the write is committed. :raises ValueError as database.db_write"""
+    await asyncio.wrap_future(database.db_write_future(data))
+
+
+async def read_user(user: int) -> Optional[ChipData]:
+    return await asyncio.wrap_future(database.db_read_user_future(user))
+
+
+async def read_actions(user: int) -> List[ActionData]:
+    return await asyncio.wrap_future(database.db_read_future(database.READ_ACTIONS, user))
+
+
+async def read_actions_page(user: int, since: datetime, until: Optional[datetime] = None,
+                            cursor: Optional[ActionCursor] = None, older: bool = True, size: int = 10) -> ActionPage:
+    """see :meth:`database.ActionPage.from_db`"""
+    return await asyncio.wrap_future(database.db_read_future(
+        database.READ_ACTIONS_PAGE, user, since, until, cursor, older, size))
+
+
+async def read_daily_actions(user: int, since: date) -> List[DailyActionData]:
+    return await asyncio.wrap_future(database.db_read_future(database.READ_DAILY_ACTIONS, user, since))
+
+
+async def read_stats() -> StatsData:
+    return await asyncio.wrap_future(database.db_read_future(database.READ_STATS))
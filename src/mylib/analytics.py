@@ -0,0 +1,220 @@
+"""
+vectorized aggregates over the Actions table.
+days and hours are in local time with the utc offset of each action's time, as the DailyActions rollup counts them
+"""
+from contextlib import closing
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import RLock
+from typing import Dict, Tuple, Callable, Any, NamedTuple
+
+import numpy as np
+
+from . import database
+
+_READ_NEW_ACTIONS = "SELECT id, user, date, action FROM Actions WHERE id > ? ORDER BY id"
+_COUNT_ACTIONS_UNTIL = "SELECT COUNT(*) FROM Actions WHERE id <= ?"
+_DAY = 86400
+N_ACTIONS = max(a.value for a in database.actions) + 1  # action codes are used as indices
+
+
+def _utc_offset(t: float) -> int:
+    """utc offset of the local time zone at epoch time `t`, seconds, as sqlite's 'localtime' applies it"""
+    return int(datetime.fromtimestamp(t, timezone.utc).astimezone().utcoffset().total_seconds())
+
+
+def _utc_offsets(t: np.ndarray) -> np.ndarray:
+    """
+    :func:`_utc_offset` of each time. the offset is looked up once per day of the range,
+    the moment of a change (daylight saving time) is found by bisection, one change per day at most
+    """
+    if len(t) == 0:
+        return np.empty(0, dtype=np.int64)
+    first, last = int(t.min()) // _DAY * _DAY, int(t.max()) // _DAY * _DAY + _DAY
+    changes, offsets = [], [_utc_offset(first)]
+    for day in range(first, last, _DAY):
+        lo, hi = day, day + _DAY
+        if _utc_offset(hi) == offsets[-1]:
+            continue
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if _utc_offset(mid) == offsets[-1]:
+                lo = mid
+            else:
+                hi = mid
+        changes.append(hi)
+        offsets.append(_utc_offset(hi))
+    return np.array(offsets, dtype=np.int64)[np.searchsorted(changes, t, side="right")]
+
+
+def _today() -> int:
+    """days since epoch (local time)"""
+    now = int(datetime.now().timestamp())
+    return (now + _utc_offset(now)) // _DAY
+
+
+class ActionArrays:
+    """
+    the Actions table as numpy columns. only rows newer than the last loaded one are read on refresh,
+    unless some of the loaded rows have been deleted (undone), then the table is read anew
+    """
+    __slots__ = "last_id", "user", "time", "action"
+
+    def __init__(self):
+        self.last_id = 0
+        self.user = np.empty(0, dtype=np.int64)
+        self.time = np.empty(0, dtype=np.float64)
+        self.action = np.empty(0, dtype=np.uint8)
+
+    def refresh(self, conn, batch_size: int = 100_000):
+        (loaded, ), = conn.execute(_COUNT_ACTIONS_UNTIL, (self.last_id, )).fetchall()
+        if loaded != len(self.user):
+            self.__init__()
+        cursor = conn.execute(_READ_NEW_ACTIONS, (self.last_id, ))
+        ids, users, times, acts = [], [self.user], [self.time], [self.action]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            i, u, t, a = zip(*rows)
+            ids.append(i[-1])
+            users.append(np.array(u, dtype=np.int64))
+            times.append(np.array(t, dtype=np.float64))
+            acts.append(np.array(a, dtype=np.uint8))
+        if ids:
+            self.last_id = ids[-1]
+            self.user, self.time, self.action = np.concatenate(users), np.concatenate(times), np.concatenate(acts)
+
+
+class DailyCounts(NamedTuple):
+    first_day: int  # days since epoch (local time) of column 0
+    keys: np.ndarray  # user ids or action codes, one per row
+    counts: np.ndarray  # shape (len(keys), number of days)
+
+
+class Streaks(NamedTuple):
+    users: np.ndarray
+    current: np.ndarray  # consecutive active days up to (and including) today, 0 if inactive today
+    longest: np.ndarray
+
+
+def _longest_runs(active: np.ndarray) -> np.ndarray:
+    """:returns length of the longest run of True in each row of a 2d bool array"""
+    padded = np.zeros((active.shape[0], active.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = active
+    edges = np.diff(padded, axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)  # row-major order, so starts and ends are paired
+    longest = np.zeros(active.shape[0], dtype=np.int64)
+    np.maximum.at(longest, start_rows, end_cols - start_cols)
+    return longest
+
+
+class Analytics:
+    """
+    aggregates over the actions, computed from numpy arrays.
+    results are cached until the db thread commits new writes
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.arrays = ActionArrays()
+        self._commits = -1
+        self._cache: Dict[Tuple, Any] = dict()
+        self._lock = RLock()  # aggregates are computed from other cached aggregates
+
+    def _cached(self, key: Tuple, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            commits = database.db_commit_count()
+            if commits != self._commits:
+                with closing(database.connect_readonly(self.db_path)) as conn:
+                    self.arrays.refresh(conn)
+                self._cache.clear()
+                self._commits = commits
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    def _local_time(self) -> np.ndarray:
+        """epoch times of the actions shifted by their utc offsets"""
+        return self._cached(("local_time", ), lambda: self.arrays.time + _utc_offsets(self.arrays.time))
+
+    def _days(self) -> np.ndarray:
+        return (self._local_time() // _DAY).astype(np.int64)
+
+    def daily_counts(self, by: str = "user") -> DailyCounts:
+        """:param by: "user" or "action" """
+        def compute():
+            days = self._days()
+            if len(days) == 0:
+                return DailyCounts(0, np.empty(0, dtype=np.int64), np.zeros((0, 0), dtype=np.int64))
+            first_day, n_days = days.min(), days.max() - days.min() + 1
+            keys, rows = np.unique(self.arrays.user if by == "user" else self.arrays.action, return_inverse=True)
+            counts = np.bincount(rows * n_days + (days - first_day), minlength=len(keys) * n_days)
+            return DailyCounts(int(first_day), keys, counts.reshape(len(keys), n_days))
+        return self._cached(("daily_counts", by), compute)
+
+    def streaks(self, today: int = None) -> Streaks:
+        """:param today: days since epoch (local time), defaults to the current day"""
+        today = _today() if today is None else today
+
+        def compute():
+            dc = self.daily_counts("user")
+            active = np.zeros((len(dc.keys), max(today - dc.first_day + 1, 0)), dtype=bool)
+            active[:, :dc.counts.shape[1]] = dc.counts[:, :active.shape[1]] > 0
+            if active.shape[1] == 0:
+                zeros = np.zeros(len(dc.keys), dtype=np.int64)
+                return Streaks(dc.keys, zeros, zeros)
+            longest = _longest_runs(active)
+            # the trailing run: distance from today to the last inactive day
+            inactive_from_end = np.argmin(active[:, ::-1], axis=1)
+            current = np.where(active.all(axis=1), active.shape[1], inactive_from_end)
+            return Streaks(dc.keys, current, longest)
+        return self._cached(("streaks", today), compute)
+
+    def last_activity(self) -> Tuple[np.ndarray, np.ndarray]:
+        """:returns (users, epoch time of the last action of each user)"""
+        def compute():
+            users, rows = np.unique(self.arrays.user, return_inverse=True)
+            last = np.full(len(users), -np.inf)
+            np.maximum.at(last, rows, self.arrays.time)
+            return users, last
+        return self._cached(("last_activity", ), compute)
+
+    def inactive_users(self, seconds: float, now: float = None) -> np.ndarray:
+        """:returns users who have logged actions before, but not during the last `seconds`"""
+        users, last = self.last_activity()
+        now = datetime.now().timestamp() if now is None else now
+        return users[last < now - seconds]
+
+    def hourly_histogram(self) -> np.ndarray:
+        """:returns counts of shape (N_ACTIONS, 24), indexed by action code and local hour of day"""
+        def compute():
+            hours = (self._local_time() % _DAY // 3600).astype(np.int64)
+            codes = self.arrays.action.astype(np.int64)
+            return np.bincount(codes * 24 + hours, minlength=N_ACTIONS * 24).reshape(N_ACTIONS, 24)
+        return self._cached(("hourly_histogram", ), compute)
+
+    def report(self, inactive_days: int = 7) -> str:
+        """plain-text summary for admins"""
+        today = _today()
+        by_action = self.daily_counts("action")
+        by_user = self.daily_counts("user")
+        col = today - by_action.first_day
+        in_range = 0 <= col < by_action.counts.shape[1]
+        today_by_action = {database.actions(int(a)).name: int(by_action.counts[i, col]) if in_range else 0
+                           for i, a in enumerate(by_action.keys)}
+        active_today = int((by_user.counts[:, col] > 0).sum()) if in_range else 0
+        streaks = self.streaks(today)
+        inactive = self.inactive_users(inactive_days * _DAY)
+        hist = self.hourly_histogram()
+        lines = [
+            f"actions: {len(self.arrays.time)}, users with actions: {len(by_user.keys)}",
+            f"today: {active_today} active users, " + ", ".join(f"{k} {v}" for k, v in today_by_action.items()),
+            f"current streaks: max {streaks.current.max(initial=0)}, "
+            f"users with streak >= 3 days: {int((streaks.current >= 3).sum())}",
+            f"inactive for {inactive_days}+ days ({len(inactive)}): " + " ".join(map(str, inactive[:50])),
+            "actions by hour of day:",
+        ]
+        lines.extend(f"{a.name}: " + " ".join(map(str, hist[a.value])) for a in database.actions)
+        return "\n".join(lines)
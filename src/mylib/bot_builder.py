@@ -1,10 +1,19 @@
 """Creates bot business logic"""
 
 import logging
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+from concurrent import futures
+from concurrent.futures import Future
+from datetime import datetime, date, time, timedelta
 from functools import partial
+from pathlib import Path
+from threading import Lock
+from time import monotonic
 from typing import (
     Dict,
+    List,
     Optional,
     Generic,
     TypeVar,
@@ -12,18 +21,31 @@ from typing import (
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
 )
 from telegram.ext import (
+    Dispatcher,
     Updater,
     CommandHandler,
     MessageHandler,
     Filters,
     ConversationHandler,
     CallbackContext,
+    CallbackQueryHandler,
+    PicklePersistence,
 )
+from telegram.ext.utils.promise import Promise
 
 from . import (
+    aio,
     database,
+    export,
+    importer,
+    logs,
+    metrics,
+    outbox,
+    analytics,
     resources as rss,
     messages as msg
 )
@@ -56,17 +78,166 @@ class DictKeys(Generic[_T]):
         return Filters.text(self.options.keys())
 
 
+class _PendingAction:
+    __slots__ = "time", "action", "description", "expires"
+
+    def __init__(self, time: float, action: int, description: Optional[str], expires: float):
+        self.time = time
+        self.action = action
+        self.description = description
+        self.expires = expires
+
+
+class PendingActionStore:
+    """
+    action registrations that wait for a description or a confirmation, one per user.
+    records expire `ttl` seconds after the last change, above `max_size` records the oldest ones are evicted.
+    the store is pickled together with the conversation states by :class:`ConversationPersistence`
+    """
+    __slots__ = "ttl", "max_size", "_records", "_lock"
+
+    def __init__(self, ttl: float = 3600., max_size: int = 10_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._records: "OrderedDict[int, _PendingAction]" = OrderedDict()  # ordered by expiration time
+        self._lock = Lock()
+
+    def put(self, ad: database.ActionData):
+        now = datetime.now().timestamp()
+        with self._lock:
+            self._records.pop(ad.user, None)
+            self._records[ad.user] = _PendingAction(ad.time.timestamp(), ad.action.value, ad.description, now + self.ttl)
+            self._evict(now)
+
+    def set_description(self, user: int, description: str) -> Optional[database.ActionData]:
+        """:returns None if there is no (unexpired) record"""
+        now = datetime.now().timestamp()
+        with self._lock:
+            self._evict(now)
+            r = self._records.get(user)
+            if r is None:
+                return None
+            r.description = description
+            r.expires = now + self.ttl
+            self._records.move_to_end(user)
+            return self._to_action_data(user, r)
+
+    def pop(self, user: int) -> Optional[database.ActionData]:
+        """:returns None if there is no (unexpired) record"""
+        with self._lock:
+            self._evict(datetime.now().timestamp())
+            r = self._records.pop(user, None)
+            return None if r is None else self._to_action_data(user, r)
+
+    def restore(self, other: Optional["PendingActionStore"]):
+        """takes over the records of a store loaded by the persistence"""
+        if other is None:
+            return
+        with self._lock:
+            self._records = other._records
+            self._evict(datetime.now().timestamp())
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __getstate__(self):
+        with self._lock:
+            self._evict(datetime.now().timestamp())
+            return self.ttl, self.max_size, [(u, r.time, r.action, r.description, r.expires)
+                                             for u, r in self._records.items()]
+
+    def __setstate__(self, state):
+        self.ttl, self.max_size, records = state
+        self._records = OrderedDict((u, _PendingAction(*r)) for u, *r in records)
+        self._lock = Lock()
+
+    def _evict(self, now: float):
+        records = self._records
+        while records and (len(records) > self.max_size or next(iter(records.values())).expires < now):
+            records.popitem(last=False)
+
+    @staticmethod
+    def _to_action_data(user: int, r: _PendingAction) -> database.ActionData:
+        return database.ActionData(user, datetime.fromtimestamp(r.time), database.actions(r.action), r.description)
+
+
+class DedupWindow:
+    """remembers keys for `window` seconds"""
+    __slots__ = "window", "_seen", "_lock"
+
+    def __init__(self, window: float):
+        self.window = window
+        self._seen: "OrderedDict[object, float]" = OrderedDict()  # ordered by time
+        self._lock = Lock()
+
+    def seen(self, key) -> bool:
+        """:returns True if the key was seen during the window, otherwise remembers it"""
+        now = datetime.now().timestamp()
+        with self._lock:
+            while self._seen and next(iter(self._seen.values())) < now - self.window:
+                self._seen.popitem(last=False)
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            return False
+
+    def forget(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+
+class ConversationPersistence(PicklePersistence):
+    """
+    pickles conversation states, user_data and pending actions into a single file on flush.
+    states of conversations that wait for a `run_async` handler are saved as they were before the handler
+    """
+    _PENDING_KEY = "pending_actions"  # saved as bot_data, since dispatcher.bot_data is copied on every update
+
+    def __init__(self, filename: Path, pending: PendingActionStore):
+        super().__init__(filename=str(filename), store_chat_data=False, store_bot_data=False, on_flush=True)
+        self.pending = pending
+
+    def flush(self) -> None:
+        if self.conversations:
+            self.conversations = {
+                name: {key: self._settled(state) for key, state in list(states.items())}
+                for name, states in list(self.conversations.items())
+            }
+        self.bot_data = {self._PENDING_KEY: self.pending}
+        super().flush()
+
+    @staticmethod
+    def _settled(state):
+        if isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise):
+            return state[0]
+        return state
+
+    def _load_singlefile(self) -> None:
+        super()._load_singlefile()
+        self.pending.restore(self.bot_data.get(self._PENDING_KEY))
+
+    def _dump_singlefile(self) -> None:
+        final = self.filename
+        self.filename = final + ".tmp"
+        try:
+            super()._dump_singlefile()
+        finally:
+            self.filename = final
+        Path(final + ".tmp").replace(final)  # a crash while dumping leaves the previous file intact
+
+
 # ========================== generic commands, handlers ==========================================
 START_CMD, SKIP_CMD, CANCEL_CMD = "start", "next", "cancel"
 
 
 def cancel_dialog(update: Update, _: CallbackContext) -> int:
-    update.message.reply_text(msg.ru.CONVERSATION_CANCELLED)
+    pending_action_data.pop(update.effective_user.id)
+    outbox.reply_text(update, msg.ru.CONVERSATION_CANCELLED)
     return main_menu(update, _)
 
 
 def unknown_command(update: Update, _: CallbackContext) -> None:
-    update.message.reply_text(msg.ru.UNKNOWN_COMMAND)
+    outbox.reply_text(update, msg.ru.UNKNOWN_COMMAND)
 
 
 CANCEL_HANDLER = CommandHandler(CANCEL_CMD, cancel_dialog)
@@ -78,6 +249,7 @@ UNKNOWN_COMMAND_HANDLER = MessageHandler(Filters.all, unknown_command)
 
 MAIN_MENU_KEYS = DictKeys(dict.fromkeys((
     msg.ru.REGISTER_ACTION,
+    msg.ru.HISTORY,
     msg.ru.COMPLETE_SURVEY,
     msg.ru.LOGIN,
 )))
@@ -85,7 +257,8 @@ MAIN_MENU_KEYS = DictKeys(dict.fromkeys((
 
 def main_menu(update: Update, _: CallbackContext) -> int:
     """! always :returns :class:`ConversationHandler.END`"""
-    update.message.reply_text(
+    outbox.reply_text(
+        update,
         msg.ru.MAIN_MENU,
         reply_markup=MAIN_MENU_KEYS.to_keyboard(one_time=False)
     )
@@ -93,7 +266,7 @@ def main_menu(update: Update, _: CallbackContext) -> int:
 
 
 def start_the_bot(update: Update, _: CallbackContext) -> int:
-    update.message.reply_text(msg.ru.START_MESSAGE)
+    outbox.reply_text(update, msg.ru.START_MESSAGE)
     return login_pre(update, _)
 
 
@@ -102,26 +275,28 @@ PRE, CHIP, EMAIL, SURVEY = 1, 2, 3, 4  # conversation states
 
 
 def login_pre(update: Update, _: CallbackContext) -> int:
-    update.message.reply_markdown(msg.ru.LOGIN_CHIP_ASK)
+    outbox.reply_markdown(update, msg.ru.LOGIN_CHIP_ASK)
     return CHIP
 
 
 def login_chip(update: Update, _: CallbackContext) -> Optional[int]:
     chip = update.message.text
     if not rss.CHIP_ID_REGEX.match(chip):
-        update.message.reply_text(msg.ru.LOGIN_CHIP_INPUT_ERR)
+        outbox.reply_text(update, msg.ru.LOGIN_CHIP_INPUT_ERR)
         return  # same step
     chip = int(chip)
     if chip not in rss.valid_chips:
-        update.message.reply_text(msg.ru.LOGIN_CHIP_INVALID_ID.format(chip))
+        outbox.reply_text(update, msg.ru.LOGIN_CHIP_INVALID_ID.format(chip))
         return
     try:
-        database.db_write(database.ChipData(update.effective_user.id, chip))
-        update.message.reply_text(msg.ru.LOGIN_CHIP_COMPLETE.format(chip))
-        update.message.reply_text(msg.ru.LOGIN_EMAIL_ASK.format(skip_cmd=SKIP_CMD))
+        if not database.db_claim_chip(update.effective_user.id, chip):
+            outbox.reply_text(update, msg.ru.LOGIN_CHIP_TAKEN.format(chip))
+            return
+        outbox.reply_text(update, msg.ru.LOGIN_CHIP_COMPLETE.format(chip))
+        outbox.reply_text(update, msg.ru.LOGIN_EMAIL_ASK.format(skip_cmd=SKIP_CMD))
         return EMAIL
     except Exception as e:
-        update.message.reply_text(msg.ru.LOGIN_CHIP_PROG_ERR)
+        outbox.reply_text(update, msg.ru.LOGIN_CHIP_PROG_ERR)
         logging.getLogger(__name__).critical(f"{e}")
         return
 
@@ -129,29 +304,57 @@ def login_chip(update: Update, _: CallbackContext) -> Optional[int]:
 def login_email(update: Update, _: CallbackContext) -> Optional[int]:
     email = update.message.text
     if not rss.EMAIL_REGEX.match(email):
-        update.message.reply_text(msg.ru.LOGIN_EMAIL_INPUT_ERR.format(email))
+        outbox.reply_text(update, msg.ru.LOGIN_EMAIL_INPUT_ERR.format(email))
         return
     try:
         database.db_write(database.EmailData(update.effective_user.id, email))
-        update.message.reply_text(msg.ru.LOGIN_EMAIL_COMPLETE.format(email))
+        outbox.reply_text(update, msg.ru.LOGIN_EMAIL_COMPLETE.format(email))
         return login_survey(update, _)
     except Exception as e:
-        update.message.reply_text(msg.ru.LOGIN_EMAIL_PROG_ERR)
+        outbox.reply_text(update, msg.ru.LOGIN_EMAIL_PROG_ERR)
+        logging.getLogger(__name__).critical(f"{e}")
+        return
+
+
+async def login_email_async(update: Update, _: CallbackContext) -> Optional[int]:
+    email = update.message.text
+    if not rss.EMAIL_REGEX.match(email):
+        outbox.reply_text(update, msg.ru.LOGIN_EMAIL_INPUT_ERR.format(email))
+        return
+    try:
+        await aio.write(database.EmailData(update.effective_user.id, email))
+        outbox.reply_text(update, msg.ru.LOGIN_EMAIL_COMPLETE.format(email))
+        return await login_survey_async(update, _)
+    except Exception as e:
+        outbox.reply_text(update, msg.ru.LOGIN_EMAIL_PROG_ERR)
         logging.getLogger(__name__).critical(f"{e}")
         return
 
 
 def login_email_skip(update: Update, _: CallbackContext) -> int:
-    update.message.reply_text(msg.ru.LOGIN_EMAIL_SKIPPED)
+    outbox.reply_text(update, msg.ru.LOGIN_EMAIL_SKIPPED)
     return login_survey(update, _)
 
 
+async def login_email_skip_async(update: Update, _: CallbackContext) -> int:
+    outbox.reply_text(update, msg.ru.LOGIN_EMAIL_SKIPPED)
+    return await login_survey_async(update, _)
+
+
 def login_survey(update: Update, _: CallbackContext) -> int:
-    chip_data = database.db_read_user(update.effective_user.id)
+    return _login_survey_ask(update, _, database.db_read_user(update.effective_user.id))
+
+
+async def login_survey_async(update: Update, _: CallbackContext) -> int:
+    return _login_survey_ask(update, _, await aio.read_user(update.effective_user.id))
+
+
+def _login_survey_ask(update: Update, _: CallbackContext, chip_data: Optional[database.ChipData]) -> int:
     if chip_data is None:
-        update.message.reply_text(msg.ru.LOGIN_SURVEY_CHIP_UNREGISTERED)
+        outbox.reply_text(update, msg.ru.LOGIN_SURVEY_CHIP_UNREGISTERED)
         return login_pre(update, _)
-    update.message.reply_markdown(
+    outbox.reply_markdown(
+        update,
         msg.ru.LOGIN_SURVEY_ASK.format(
             SURVEY_URL=rss.SURVERY_URL.format(chip_id=chip_data.chip),
             skip_cmd=SKIP_CMD
@@ -162,16 +365,25 @@ def login_survey(update: Update, _: CallbackContext) -> int:
 
 
 def login_complete(update: Update, _: CallbackContext) -> int:
-    update.message.reply_text(msg.ru.LOGIN_COMPLETE)
+    outbox.reply_text(update, msg.ru.LOGIN_COMPLETE)
     return main_menu(update, _)
 
 
-def build_login_conversation() -> ConversationHandler:
+def _offloaded(runtime: Optional[aio.AsyncRuntime], callback, async_callback) -> dict:
+    """handler arguments: the coroutine on the asyncio runtime if there is one, else `run_async` in a pool thread"""
+    if runtime is None:
+        return dict(callback=callback, run_async=True)
+    return dict(callback=runtime.handler(async_callback))
+
+
+def build_login_conversation(persistent: bool = False,
+                             runtime: Optional[aio.AsyncRuntime] = None) -> ConversationHandler:
     start_h = CommandHandler(START_CMD, start_the_bot)
     login_h = MessageHandler(Filters.text([msg.ru.LOGIN]), login_pre)
-    email_h = MessageHandler(Filters.text & (~Filters.command), login_email, run_async=True)
-    email_skip_h = CommandHandler(SKIP_CMD, login_email_skip, run_async=True, )
-    survey_h = MessageHandler(Filters.text([msg.ru.COMPLETE_SURVEY, ]), login_survey, run_async=True)
+    email_h = MessageHandler(Filters.text & (~Filters.command), **_offloaded(runtime, login_email, login_email_async))
+    email_skip_h = CommandHandler(SKIP_CMD, **_offloaded(runtime, login_email_skip, login_email_skip_async))
+    survey_h = MessageHandler(Filters.text([msg.ru.COMPLETE_SURVEY, ]),
+                              **_offloaded(runtime, login_survey, login_survey_async))
     return ConversationHandler(
         entry_points=[start_h, login_h, survey_h],
         states={
@@ -182,20 +394,24 @@ def build_login_conversation() -> ConversationHandler:
         },
         fallbacks=[CANCEL_HANDLER, UNKNOWN_COMMAND_HANDLER],
         allow_reentry=True,
+        name="login",
+        persistent=persistent,
     )
 
 
 # ====================== action conversation =====================================
 REGISTER, DESCRIBE_ACTION, CONFIRM = 1, 2, 3
 
-pending_action_data: Dict[int, database.ActionData] = dict()
+PENDING_ACTION_TTL = 3600  # seconds, an unfinished registration is forgotten after that
+pending_action_data = PendingActionStore(ttl=PENDING_ACTION_TTL)
 
 ACTION_KEYS = DictKeys(msg.ru.STR_TO_ACTIONS)
 YES_NO_KEYS = DictKeys({msg.ru.YES: True, msg.ru.NO: False})
 
 
 def action_start(update: Update, _: CallbackContext) -> int:
-    update.message.reply_text(
+    outbox.reply_text(
+        update,
         msg.ru.ACTION_START,
         reply_markup=ACTION_KEYS.to_keyboard()
     )
@@ -209,25 +425,27 @@ def localize_action_data(ad: database.ActionData) -> str:
 
 def action_register(update: Update, _: CallbackContext) -> int:
     ad = database.ActionData(update.effective_user.id, datetime.now(), ACTION_KEYS.parse(update.message.text))
-    pending_action_data[update.effective_user.id] = ad
+    pending_action_data.put(ad)
     # reading past messages is not supported or not well-documented, so we need to store them
     return ask_action_description(update) \
         if ad.action == database.actions.unlisted_action else ask_confirmation(update, ad)
 
 
 def ask_action_description(update):
-    update.message.reply_text(msg.ru.ASK_ACTION_DESCRIPTION)
+    outbox.reply_text(update, msg.ru.ASK_ACTION_DESCRIPTION)
     return DESCRIBE_ACTION
 
 
 def save_action_description(update: Update, _: CallbackContext) -> int:
-    ad = pending_action_data[update.effective_user.id]
-    ad.description = update.message.text
+    ad = pending_action_data.set_description(update.effective_user.id, update.message.text)
+    if ad is None:
+        return action_expired(update, _)
     return ask_confirmation(update, ad)
 
 
 def ask_confirmation(update: Update, ad: database.ActionData) -> int:
-    update.message.reply_markdown(
+    outbox.reply_markdown(
+        update,
         msg.ru.ACTION_CONFIRMATION_ASK.format(action_data=localize_action_data(ad)),
         reply_markup=YES_NO_KEYS.to_keyboard(),
     )
@@ -235,16 +453,23 @@ def ask_confirmation(update: Update, ad: database.ActionData) -> int:
 
 
 def action_confirm(update: Update, _: CallbackContext) -> int:
+    ad = pending_action_data.pop(update.effective_user.id)
+    if ad is None:
+        return action_expired(update, _)
     if YES_NO_KEYS.parse(update.message.text):
-        database.db_write(pending_action_data.pop(update.effective_user.id))
-        update.message.reply_text(msg.ru.ACTION_CONFIRMED)
+        database.db_write(ad)
+        outbox.reply_text(update, msg.ru.ACTION_CONFIRMED)
     else:
-        pending_action_data.pop(update.effective_user.id)
-        update.message.reply_text(msg.ru.ACTION_CANCELED)
+        outbox.reply_text(update, msg.ru.ACTION_CANCELED)
     return main_menu(update, _)
 
 
-def build_action_conversation() -> ConversationHandler:
+def action_expired(update: Update, _: CallbackContext) -> int:
+    outbox.reply_text(update, msg.ru.ACTION_EXPIRED)
+    return main_menu(update, _)
+
+
+def build_action_conversation(persistent: bool = False) -> ConversationHandler:
     return ConversationHandler(
         entry_points=[MessageHandler(Filters.text(msg.ru.REGISTER_ACTION), action_start)],
         states={
@@ -254,6 +479,184 @@ def build_action_conversation() -> ConversationHandler:
         },
         fallbacks=[CANCEL_HANDLER, UNKNOWN_COMMAND_HANDLER],
         allow_reentry=True,
+        conversation_timeout=PENDING_ACTION_TTL,
+        name="action",
+        persistent=persistent,
+    )
+
+
+# ====================== one-tap registration =====================================
+# NFC chips carry links like t.me/<bot>?start=<chip>_<action>, which register the action right away
+ONE_TAP_DEDUP_WINDOW = 10  # seconds, repeated taps are ignored
+UNDO_WINDOW = 600  # seconds
+UNDO_PREFIX = "undo:"
+
+recent_taps = DedupWindow(ONE_TAP_DEDUP_WINDOW)
+
+
+def parse_action(s: str) -> Optional[database.actions]:
+    """accepts both names and codes of actions"""
+    try:
+        return database.actions(int(s)) if s.isdigit() else database.actions[s]
+    except (KeyError, ValueError):
+        return None
+
+
+def one_tap_register(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user.id
+    chip, action = rss.ONE_TAP_PAYLOAD_REGEX.match(context.args[0]).groups()
+    chip, action = int(chip), parse_action(action)
+    if action is None:
+        return unknown_command(update, context)
+    if chip not in rss.valid_chips:
+        outbox.reply_text(update, msg.ru.LOGIN_CHIP_INVALID_ID.format(chip))
+        return
+    registered = database.db_read_user(user)
+    if registered is None:
+        outbox.reply_text(update, msg.ru.ONE_TAP_UNREGISTERED)
+        return
+    if registered.chip != chip:
+        outbox.reply_text(update, msg.ru.ONE_TAP_FOREIGN_CHIP.format(chip))
+        return
+    if recent_taps.seen((user, action)):
+        outbox.reply_text(update, msg.ru.ONE_TAP_DUPLICATE)
+        return
+    ad = database.ActionData(user, datetime.now(), action)
+    database.db_write(ad)
+    undo = InlineKeyboardButton(msg.ru.UNDO, callback_data=f"{UNDO_PREFIX}{ad.time.timestamp()!r}:{action.value}")
+    outbox.reply_markdown(
+        update,
+        msg.ru.ONE_TAP_REGISTERED.format(action_data=localize_action_data(ad)),
+        reply_markup=InlineKeyboardMarkup.from_button(undo),
+    )
+
+
+def one_tap_undo(update: Update, _: CallbackContext) -> None:
+    query = update.callback_query
+    t, action = query.data[len(UNDO_PREFIX):].split(":")
+    t, action = float(t), database.actions(int(action))
+    if datetime.now().timestamp() - t > UNDO_WINDOW:
+        query.answer(msg.ru.UNDO_TOO_LATE)
+        outbox.edit_message_reply_markup(query)
+        return
+    database.db_write(database.UndoActionData(query.from_user.id, datetime.fromtimestamp(t), action))
+    recent_taps.forget((query.from_user.id, action))
+    query.answer()
+    outbox.edit_message_text(query, msg.ru.ACTION_CANCELED)
+
+
+def build_one_tap_handlers() -> list:
+    """these handlers should precede the conversations, since the login conversation starts on `/start` too"""
+    return [
+        CommandHandler(START_CMD, one_tap_register,
+                       filters=Filters.regex(rf"^/{START_CMD} {rss.ONE_TAP_PAYLOAD_REGEX.pattern[1:]}")),
+        CallbackQueryHandler(one_tap_undo, pattern=f"^{UNDO_PREFIX}"),
+    ]
+
+
+# ====================== history conversation =====================================
+HISTORY_CMD = "history"
+PAGE = 1
+HISTORY_PAGE_SIZE = 10
+
+HISTORY_KEYS = DictKeys({msg.ru.HISTORY_NEWER: False, msg.ru.HISTORY_OLDER: True, msg.ru.HISTORY_CLOSE: None})
+
+
+def _history_since(update: Update, context: CallbackContext) -> Optional[datetime]:
+    """parses the command argument, None if it is invalid"""
+    try:
+        days = int(context.args[0]) if context.args else 1
+        assert days > 0
+    except (ValueError, AssertionError):
+        outbox.reply_text(update, msg.ru.HISTORY_ARG_ERR.format(history_cmd=HISTORY_CMD))
+        return None
+    since = datetime.combine(date.today() - timedelta(days=days - 1), time.min)
+    context.user_data["history_since"] = since
+    return since
+
+
+def history_start(update: Update, context: CallbackContext) -> int:
+    """shows actions registered during the last `days` days (command argument), today by default"""
+    since = _history_since(update, context)
+    if since is None:
+        return main_menu(update, context)
+    page = database.db_read_actions_page(update.effective_user.id, since, size=HISTORY_PAGE_SIZE)
+    return show_history_page(update, context, page)
+
+
+async def history_start_async(update: Update, context: CallbackContext) -> int:
+    since = _history_since(update, context)
+    if since is None:
+        return main_menu(update, context)
+    page = await aio.read_actions_page(update.effective_user.id, since, size=HISTORY_PAGE_SIZE)
+    return show_history_page(update, context, page)
+
+
+def _history_cursor(update: Update, context: CallbackContext) -> (Optional[database.ActionCursor], Optional[bool]):
+    older = HISTORY_KEYS.parse(update.message.text)
+    page: database.ActionPage = context.user_data.get("history_page")
+    return None if older is None or page is None else page.older if older else page.newer, older
+
+
+def history_turn_page(update: Update, context: CallbackContext) -> int:
+    cursor, older = _history_cursor(update, context)
+    if cursor is None:
+        return history_close(update, context)
+    page = database.db_read_actions_page(
+        update.effective_user.id, context.user_data["history_since"],
+        cursor=cursor, older=older, size=HISTORY_PAGE_SIZE
+    )
+    return show_history_page(update, context, page)
+
+
+async def history_turn_page_async(update: Update, context: CallbackContext) -> int:
+    cursor, older = _history_cursor(update, context)
+    if cursor is None:
+        return history_close(update, context)
+    page = await aio.read_actions_page(
+        update.effective_user.id, context.user_data["history_since"],
+        cursor=cursor, older=older, size=HISTORY_PAGE_SIZE
+    )
+    return show_history_page(update, context, page)
+
+
+def show_history_page(update: Update, context: CallbackContext, page: database.ActionPage) -> int:
+    if len(page.actions) == 0:
+        outbox.reply_text(update, msg.ru.HISTORY_EMPTY)
+        return history_close(update, context)
+    context.user_data["history_page"] = page
+    keys = DictKeys({k: older for k, older in HISTORY_KEYS.options.items()
+                     if older is None or (page.older if older else page.newer) is not None})
+    outbox.reply_markdown(
+        update,
+        "\n".join(localize_action_data(ad) for ad in page.actions),
+        reply_markup=keys.to_keyboard(one_time=False),
+    )
+    return PAGE
+
+
+def history_close(update: Update, context: CallbackContext) -> int:
+    context.user_data.pop("history_page", None)
+    context.user_data.pop("history_since", None)
+    return main_menu(update, context)
+
+
+def build_history_conversation(persistent: bool = False,
+                               runtime: Optional[aio.AsyncRuntime] = None) -> ConversationHandler:
+    start = _offloaded(runtime, history_start, history_start_async)
+    return ConversationHandler(
+        entry_points=[
+            CommandHandler(HISTORY_CMD, **start),
+            MessageHandler(Filters.text([msg.ru.HISTORY]), **start),
+        ],
+        states={
+            PAGE: [MessageHandler(HISTORY_KEYS.to_filter(),
+                                  **_offloaded(runtime, history_turn_page, history_turn_page_async)), ],
+        },
+        fallbacks=[CANCEL_HANDLER, UNKNOWN_COMMAND_HANDLER],
+        allow_reentry=True,
+        name="history",
+        persistent=persistent,
     )
 
 
@@ -270,16 +673,81 @@ def senddoc(update: Update, _: CallbackContext, password=None) -> None:
         return unknown_command(update, _)
 
 
-def upload_file(update: Update, _: CallbackContext, file: "Path" = None):
-    if file is None:
-        for file in rss.STORAGE_PATH.iterdir():
-            with file.open("rb") as f:
-                update.message.reply_document(f, disable_content_type_detection=True)
-    else:
+def upload_file(update: Update, _: CallbackContext, file: "Path" = None) -> List[Future]:
+    """
+    storage files (all if `file` is None) are exported as parts of a compressed archive with a manifest.
+    the parts are queued with a low priority, so users are answered first, the export is removed once they are sent
+    """
+    files = None
+    if file is not None:
         file = rss.STORAGE_PATH / file
         assert file.exists() and file.resolve() == file
-        with file.open("rb") as f:
-            update.message.reply_document(f, disable_content_type_detection=True)
+        files = [file]
+    parts = export.export(files)
+    sent = [outbox.reply_document(update, part, disable_content_type_detection=True) for part in parts]
+    export.remove_when_done(parts[0].parent, sent)
+    return sent
+
+
+def send_snapshot(update: Update, _: CallbackContext, password=None) -> None:
+    """`/snapshot <password> [gz]` sends a consistent copy of the live database, the bot keeps running"""
+    try:
+        _, passw, *options = update.message.text.split()
+        assert passw == password
+        snapshot_path = database.snapshot(rss.DATABASE_PATH, rss.STORAGE_PATH / "db_copy.sqlite3",
+                                          compress="gz" in options)
+        logging.getLogger(__name__).critical(f"db snapshot read by {update.effective_user}")
+        upload_file(update, _, file=snapshot_path.name)
+    except Exception as e:
+        logging.getLogger(__name__).critical(f"attempt to snapshot db msg={update.message.text}", exc_info=e)
+        return unknown_command(update, _)
+
+
+def import_actions(update: Update, _: CallbackContext, password=None) -> None:
+    """a table of actions sent as a document with the caption `/import <password> [dry]`, see importer.py"""
+    try:
+        _, passw, *options = update.message.caption.split()
+        assert passw == password
+        document = update.message.document
+        importer.IMPORT_PATH.mkdir(exist_ok=True)
+        path = importer.IMPORT_PATH / f"{datetime.now():%Y%m%d_%H%M%S}_{Path(document.file_name or 'actions.txt').name}"
+        document.get_file().download(custom_path=str(path))
+        logging.getLogger(__name__).critical(f"{path.name} imported by {update.effective_user}")
+        report = importer.import_file(path, rss.DATABASE_PATH, rss.valid_chips, dry_run="dry" in options,
+                                      write=importer.write_with_db_thread)
+        outbox.reply_text(update, report.summary() + (" (dry run)" if "dry" in options else ""))
+        if report.errors:
+            outbox.reply_document(update, report.write_errors(path.with_name(path.name + ".errors.txt")))
+    except Exception as e:
+        logging.getLogger(__name__).critical(f"attempt to import actions msg={update.message.caption}", exc_info=e)
+        return unknown_command(update, _)
+
+
+def stats(update: Update, _: CallbackContext, password=None, engine: analytics.Analytics = None) -> None:
+    """`/stats <password> [inactive_days]`"""
+    try:
+        _, passw, *inactive_days = update.message.text.split()
+        assert passw == password
+        report = engine.report(*map(int, inactive_days))
+        outbox.reply_markdown(update, f"```\n{report}\n```")
+    except Exception as e:
+        logging.getLogger(__name__).critical(f"attempt to read stats msg={update.message.text}", exc_info=e)
+        return unknown_command(update, _)
+
+
+def metrics_report(update: Update, _: CallbackContext, password=None) -> None:
+    """`/metrics <password>`"""
+    try:
+        _, passw = update.message.text.split()
+        assert passw == password
+        report = metrics.report() if metrics.enabled() else "metrics are disabled"
+        outbox.reply_markdown(update, f"```\n{report[:outbox.MAX_MESSAGE_LENGTH - 8]}\n```")
+    except Exception as e:
+        logging.getLogger(__name__).critical(f"attempt to read metrics msg={update.message.text}", exc_info=e)
+        return unknown_command(update, _)
+
+
+shutdown_pid: Optional[int] = None  # process that /shutdown sends SIGTERM to, this one if None
 
 
 def shutdown(update: Update, _: CallbackContext, password=None) -> None:
@@ -294,20 +762,120 @@ def shutdown(update: Update, _: CallbackContext, password=None) -> None:
         import os, signal
         logging.getLogger(__name__).critical(f"bot terminated by {update.effective_user} msg={update.message.text}")
         database.db_terminate()[0].join()
-        upload_file(update, _) if upload == "upload" else None
-        update.message.reply_text("terminating")
-        os.kill(os.getpid(), signal.SIGTERM)
+        if upload == "upload":
+            futures.wait(upload_file(update, _))
+        outbox.reply_text(update, "terminating").result()
+        os.kill(os.getpid() if shutdown_pid is None else shutdown_pid, signal.SIGTERM)
     except Exception as e:
         logging.getLogger(__name__).critical(f"attempt to terminate bot msg={update.message.text}", exc_info=e)
         return unknown_command(update, _)
 
 
-def build_bot(updater: Updater, password=None) -> Updater:
+# ============================== instrumentation =============================
+HANDLER_SECONDS = metrics.Histogram("handler_seconds", "handler duration", ("conversation", "state", "handler"))
+UPDATES = metrics.Counter("updates_total", "handled updates", ("conversation", "state", "outcome"))
+
+
+@contextmanager
+def _measured(conversation: str, state: str, name: str):
+    """
+    the handler called inside appends its result to the yielded list.
+    outcome is "error", "end" or "next" (conversation state), "same" (stays in the state or not a conversation)
+    """
+    start = monotonic()
+    returned = []
+    try:
+        yield returned
+    finally:
+        duration = monotonic() - start
+        result = returned[0] if returned else None
+        outcome = ("error" if not returned else "same" if result is None
+                   else "end" if result == ConversationHandler.END else "next")
+        HANDLER_SECONDS.observe(duration, conversation, state, name)
+        UPDATES.inc(conversation, state, outcome)
+        logging.getLogger(__name__).debug("handled", extra={"outcome": outcome, "duration": duration})
+
+
+def _timed(callback, conversation: str, state: str):
+    name = getattr(callback, "func", callback).__name__  # partial admin commands
+    scheduled = isinstance(callback, aio.ScheduledHandler)
+    if scheduled:  # the call returns a Promise at once, the coroutine is measured until it is done
+        coroutine_callback = callback.callback
+
+        async def timed_coroutine(update: Update, context: CallbackContext):
+            with _measured(conversation, state, name) as returned:
+                returned.append(await coroutine_callback(update, context))
+            return returned[0]
+        callback = callback.runtime.handler(timed_coroutine)
+
+    def timed_callback(update: Update, context: CallbackContext):
+        user = update.effective_user.id if isinstance(update, Update) and update.effective_user else None
+        with logs.update_context(user=user, conversation=conversation, state=state, handler=name):
+            if scheduled:
+                return callback(update, context)
+            with _measured(conversation, state, name) as returned:
+                returned.append(callback(update, context))
+            return returned[0]
+    return timed_callback
+
+
+def _instrumented(handlers: list, conversation: str, state: str) -> list:
+    """handlers are copied, since the same handler (e.g. cancel) is shared by several conversations"""
+    result = []
+    for h in handlers:
+        if isinstance(h, ConversationHandler):
+            _instrument_conversation(h)
+        else:
+            h = copy(h)
+            h.callback = _timed(h.callback, conversation, state)
+        result.append(h)
+    return result
+
+
+def _instrument_conversation(conv: ConversationHandler):
+    name = conv.name or "conversation"
+    conv._entry_points = _instrumented(conv.entry_points, name, "entry")
+    conv._fallbacks = _instrumented(conv.fallbacks, name, "fallback")
+    conv._states = {
+        state: _instrumented(handlers, name, "timeout" if state == ConversationHandler.TIMEOUT else str(state))
+        for state, handlers in conv.states.items()
+    }
+
+
+def instrument_handlers(dispatcher: Dispatcher):
+    """wraps every handler callback with timing and log context, the handlers are replaced with instrumented copies"""
+    for group, handlers in dispatcher.handlers.items():
+        dispatcher.handlers[group] = _instrumented(handlers, "none", "none")
+
+
+PERSISTENCE_FLUSH_INTERVAL = 60  # seconds
+
+
+def build_bot(updater: Updater, password=None, runtime: Optional[aio.AsyncRuntime] = None) -> Updater:
+    """
+    if the updater has a persistence, conversations are persistent and saved periodically.
+    handlers that wait for the database run on `runtime` if it is given, otherwise in pool threads.
+    handlers are instrumented if metrics or json logs are enabled
+    """
     dispatcher = updater.dispatcher
-    dispatcher.add_handler(build_login_conversation())
-    dispatcher.add_handler(build_action_conversation())
+    persistent = dispatcher.persistence is not None
+    if persistent:
+        updater.job_queue.run_repeating(lambda _: dispatcher.persistence.flush(), interval=PERSISTENCE_FLUSH_INTERVAL)
+    for h in build_one_tap_handlers():
+        dispatcher.add_handler(h)
+    dispatcher.add_handler(build_login_conversation(persistent, runtime))
+    dispatcher.add_handler(build_action_conversation(persistent))
+    dispatcher.add_handler(build_history_conversation(persistent, runtime))
     if password is not None:
-        dispatcher.add_handler(CommandHandler("senddoc", partial(senddoc, password=password)))
+        dispatcher.add_handler(CommandHandler("senddoc", partial(senddoc, password=password), run_async=True))
         dispatcher.add_handler(CommandHandler("shutdown", partial(shutdown, password=password)))
+        dispatcher.add_handler(CommandHandler("snapshot", partial(send_snapshot, password=password), run_async=True))
+        engine = analytics.Analytics(rss.DATABASE_PATH)
+        dispatcher.add_handler(CommandHandler("stats", partial(stats, password=password, engine=engine), run_async=True))
+        dispatcher.add_handler(CommandHandler("metrics", partial(metrics_report, password=password)))
+        dispatcher.add_handler(MessageHandler(Filters.document & Filters.caption_regex(r"^/import\b"),
+                                              partial(import_actions, password=password), run_async=True))
     dispatcher.add_handler(UNKNOWN_COMMAND_HANDLER)
+    if metrics.enabled() or logs.json_lines():
+        instrument_handlers(dispatcher)
     return updater
@@ -0,0 +1,98 @@
+"""valid chip ids: a bitmap over the 4 digit id space, reloaded when the chip file changes"""
+import logging
+import re
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+
+CHIP_SPACE = 10_000
+# a chip id or an inclusive range of them, e.g. `1234` or `1000-1999`
+CHIP_LINE_REGEX = re.compile(r"^([0-9]{4})(?:-([0-9]{4}))?$")
+
+
+class ChipSet:
+    """
+    bitmap of chip ids, 1250 bytes for the whole id space.
+    updates build new bits and swap them in at once, so readers never see a half-applied update
+    """
+    __slots__ = "_bits",
+
+    def __init__(self, chips: Iterable[int] = ()):
+        self._bits = bytes(CHIP_SPACE // 8)
+        self.update(chips)
+
+    def __contains__(self, chip: int) -> bool:
+        return 0 <= chip < CHIP_SPACE and bool(self._bits[chip >> 3] >> (chip & 7) & 1)
+
+    def __len__(self) -> int:
+        return int.from_bytes(self._bits, "little").bit_count()
+
+    def __iter__(self) -> Iterator[int]:
+        bits = self._bits
+        return (c for c in range(CHIP_SPACE) if bits[c >> 3] >> (c & 7) & 1)
+
+    def update(self, chips: Iterable[int]):
+        bits = bytearray(self._bits)
+        for c in chips:
+            bits[c >> 3] |= 1 << (c & 7)
+        self._bits = bytes(bits)
+
+    def replace(self, other: "ChipSet"):
+        self._bits = other._bits
+
+
+def parse_chip_file(p: Path) -> ChipSet:
+    """
+    comment lines start with `#`, each other line is a chip id or an inclusive range of them.
+    :raises ValueError listing the invalid lines
+    """
+    with p.open("rt") as f:
+        lines = [(i + 1, c) for (i, c) in enumerate(f.readlines()) if not c.startswith("#")]
+    if len(lines) == 0:
+        raise ValueError(f"chip file {p} is empty")
+    chips = ChipSet()
+    ranges, invalid = [], []
+    for i, c in lines:
+        m = CHIP_LINE_REGEX.match(c)
+        lo, hi = (None, None) if m is None else (int(m[1]), int(m[2] or m[1]))
+        if lo is None or lo > hi:
+            invalid.append((i, c))
+        else:
+            ranges.append(range(lo, hi + 1))
+    if len(invalid) > 0:
+        raise ValueError(
+            "Following invalid chips detected:\n" +
+            "\n".join(f"{i}: {c}" for i, c in invalid)
+        )
+    chips.update(c for r in ranges for c in r)
+    return chips
+
+
+class ChipRegistry:
+    """keeps `chips` in sync with the chip file, the file is re-read when its modification time or size changes"""
+
+    def __init__(self, path: Path, chips: ChipSet):
+        self.path = path
+        self.chips = chips
+        self._stamp: Optional[Tuple[int, int]] = None
+
+    def load(self):
+        """:raises OSError, ValueError"""
+        st = self.path.stat()
+        self.chips.replace(parse_chip_file(self.path))
+        self._stamp = st.st_mtime_ns, st.st_size
+
+    def reload_if_changed(self) -> bool:
+        """
+        an invalid file is logged once and the chips are kept as they were until the file changes again.
+        :returns whether the file was re-read
+        """
+        try:
+            st = self.path.stat()
+            if (st.st_mtime_ns, st.st_size) == self._stamp:
+                return False
+            self._stamp = st.st_mtime_ns, st.st_size
+            self.load()
+            logging.getLogger(__name__).info(f"chips reloaded from {self.path}, {len(self.chips)} valid")
+        except (OSError, ValueError) as e:
+            logging.getLogger(__name__).error(f"chip file {self.path} is not reloaded", exc_info=e)
+        return True
@@ -0,0 +1,173 @@
+"""
+multi-process deployment. the main process receives updates and shards them by user between worker processes,
+each worker runs a dispatcher with all the handlers, one writer process owns the database.
+a user always lands on the same worker, so conversation states and the user cache stay in one process.
+changing the number of workers moves users between them, their conversations in progress are lost then
+"""
+import logging
+import os
+import signal
+import sys
+import multiprocessing as mp
+from multiprocessing.connection import Connection
+from threading import Thread
+from typing import List, Optional, Tuple, Union
+
+from setproctitle import setproctitle
+from telegram import Update
+from telegram.ext import Updater, Dispatcher, TypeHandler, CallbackContext
+
+from . import (
+    resources as rss,
+    aio,
+    bot_builder,
+    chips,
+    database,
+    logs,
+    metrics,
+    outbox,
+)
+
+DB_SOCKET_PATH = rss.STORAGE_PATH / "db.sock"
+# multiprocessing has no unix sockets on windows, the writer listens on a free localhost port there, the authkey
+# keeps other local processes out
+DB_ADDRESS: Union[str, Tuple[str, int]] = ("127.0.0.1", 0) if sys.platform == "win32" else str(DB_SOCKET_PATH)
+DEFAULT_START_TIMEOUT = 60.  # seconds for the writer process to prepare (migrate) the database
+
+_mp = mp.get_context("spawn")  # children do not inherit threads and locks of the main process
+
+
+def shard(update: Update, workers: int) -> int:
+    user = update.effective_user or update.effective_chat
+    return 0 if user is None else user.id % workers
+
+
+def _child_setup(title: str, log_kwargs: dict, metrics_listen: Optional[str], metrics_port: Optional[int]):
+    """
+    the main process decides when children terminate, and writes their logs.
+    :param log_kwargs: passed to :func:`logs.setup_child`
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setproctitle(title)
+    logs.setup_child(**log_kwargs)
+    if metrics_port is not None:
+        metrics.enable()
+        metrics.serve(metrics_listen, metrics_port)
+
+
+def run_writer(title: str, log_kwargs: dict, authkey: bytes, workers: int, ready: Connection,
+               db_kwargs: dict, metrics_listen: Optional[str] = None, metrics_port: Optional[int] = None):
+    """writer process, sends the address workers connect to into `ready`, exits once all workers have disconnected"""
+    _child_setup(title, log_kwargs, metrics_listen, metrics_port)
+    database.db_serve(DB_ADDRESS, authkey, workers, rss.DATABASE_PATH, on_ready=ready.send, **db_kwargs)
+
+
+def run_worker(title: str, log_kwargs: dict, authkey: bytes, db_address: Union[str, Tuple[str, int]],
+               index: int, token: str, updates: Connection,
+               db_kwargs: dict, outbox_kwargs: dict, password: Optional[str], chips_reload_interval: float,
+               metrics_listen: Optional[str] = None, metrics_port: Optional[int] = None, async_runtime: bool = False):
+    """worker process, dispatches updates received from `updates` until None or the end of the pipe"""
+    _child_setup(title, log_kwargs, metrics_listen, metrics_port)
+    bot_builder.shutdown_pid = os.getppid()  # /shutdown terminates the whole deployment
+    registry = chips.ChipRegistry(rss.CHIPS_PATH, rss.valid_chips)
+    registry.load()
+    database.db_connect(db_address, authkey, rss.DATABASE_PATH, **db_kwargs)
+    persistence = bot_builder.ConversationPersistence(
+        rss.STORAGE_PATH / f"conversations.{index}.pickle", bot_builder.pending_action_data)
+    updater = Updater(token, persistence=persistence)
+    outbox.outbox_init(updater.bot, **outbox_kwargs)
+    runtime = aio.AsyncRuntime() if async_runtime else None
+    if runtime is not None:
+        runtime.start()
+    bot_builder.build_bot(updater, password=password, runtime=runtime)
+    updater.job_queue.run_repeating(lambda _: registry.reload_if_changed(), interval=chips_reload_interval)
+    updater.job_queue.start()
+    dispatcher = Thread(target=updater.dispatcher.start, name="dispatcher")
+    dispatcher.start()
+
+    while True:
+        try:
+            data = updates.recv()
+        except EOFError:
+            break
+        if data is None:
+            break
+        updater.update_queue.put(Update.de_json(data, updater.bot))
+
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    dispatcher.join()
+    updater.dispatcher.update_persistence()
+    persistence.flush()
+    if runtime is not None:
+        runtime.stop()
+    outbox.outbox_terminate().join()
+    database.db_terminate()[0].join()
+
+
+class Cluster:
+    """
+    starts the writer and the worker processes, :meth:`route` makes a dispatcher of the main process forward
+    every update to the worker of its user.
+    the global outbox rate is split between the workers, metrics of process `i` are served at `metrics_port + 1 + i`
+    (workers first, then the writer)
+    """
+
+    def __init__(self, workers: int, token: str, title: str, log_kwargs: dict, db_kwargs: dict,
+                 outbox_kwargs: dict, password: Optional[str], chips_reload_interval: float,
+                 metrics_listen: Optional[str] = None, metrics_port: Optional[int] = None,
+                 async_runtime: bool = False, start_timeout: float = DEFAULT_START_TIMEOUT):
+        authkey = os.urandom(32)
+        outbox_kwargs = {**outbox_kwargs}
+        if "global_rate" in outbox_kwargs:
+            outbox_kwargs["global_rate"] /= workers
+
+        def port(i: int) -> Optional[int]:
+            return None if metrics_port is None else metrics_port + 1 + i
+
+        ready, ready_sender = _mp.Pipe(duplex=False)
+        self.writer = _mp.Process(
+            target=run_writer, name="writer",
+            args=(f"{title}_writer", log_kwargs, authkey, workers, ready_sender, db_kwargs, metrics_listen,
+                  port(workers)))
+        self.writer.start()
+        ready_sender.close()
+        try:
+            db_address = ready.recv() if ready.poll(start_timeout) else None  # a free port is known once it listens
+        except EOFError:  # the writer has exited
+            db_address = None
+        ready.close()
+        if db_address is None:
+            self.writer.terminate()
+            raise RuntimeError(f"writer process is not ready in {start_timeout} s")
+        self.pipes: List[Connection] = []
+        self.workers: List[mp.Process] = []
+        for i in range(workers):
+            receiver, sender = _mp.Pipe(duplex=False)
+            self.workers.append(_mp.Process(
+                target=run_worker, name=f"worker{i}",
+                args=(f"{title}_worker{i}", log_kwargs, authkey, db_address, i, token, receiver, db_kwargs,
+                      outbox_kwargs,
+                      password, chips_reload_interval, metrics_listen, port(i), async_runtime)))
+            self.workers[-1].start()
+            receiver.close()
+            self.pipes.append(sender)
+        logging.getLogger(__name__).info(f"cluster of {workers} workers started")
+
+    def forward(self, update: Update, _: CallbackContext):
+        """a worker that does not keep up blocks the pipe, and the dispatcher of the main process with it"""
+        self.pipes[shard(update, len(self.pipes))].send(update.to_dict())
+
+    def route(self, dispatcher: Dispatcher):
+        dispatcher.add_handler(TypeHandler(Update, self.forward))
+
+    def terminate(self):
+        """waits for the workers to stop and the writer to commit everything"""
+        for p in self.pipes:
+            p.send(None)
+            p.close()
+        for w in self.workers:
+            w.join()
+        self.writer.join()
+        logging.getLogger(__name__).info("cluster terminated")
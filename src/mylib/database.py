@@ -1,13 +1,21 @@
 import logging
 import sqlite3 as sql
-from typing import Union, Dict, List, Optional
-from datetime import datetime
+import struct
+from typing import Union, Dict, List, Optional, Any, Tuple, Callable
+from datetime import datetime, date, time, timedelta
 from enum import Enum
 from pathlib import Path
-from threading import Thread, Event
-from queue import Queue
-from time import sleep
+from threading import Thread, Lock, local
+from queue import Queue, Empty
+from time import monotonic, sleep
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from contextlib import closing
+from multiprocessing.connection import Listener, Client, Connection
+
+from . import metrics
+from .spool import Spool, DEFAULT_FSYNC_INTERVAL as DEFAULT_SPOOL_FSYNC_INTERVAL
 
 # sql commands
 _NEW_USER_TABLE = """
@@ -24,12 +32,48 @@ CREATE TABLE Actions (
     action INTEGER NOT NULL,
     description TEXT
 );"""
-LATEST_DB_VERSION = 2
+_NEW_ACTION_INDEX = """
+CREATE INDEX IF NOT EXISTS ActionsByUserDate ON Actions (user, date);"""
+# per (user, local day, action) rollup of Actions, kept up to date by ActionData.to_db
+_NEW_DAILY_ACTION_TABLE = """
+CREATE TABLE IF NOT EXISTS DailyActions (
+    user INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    action INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    first FLOAT NOT NULL,
+    last FLOAT NOT NULL,
+    PRIMARY KEY (user, day, action)
+) WITHOUT ROWID;"""
+# chip -> user, a chip belongs to one user at most
+_NEW_CHIP_TABLE = """
+CREATE TABLE IF NOT EXISTS Chips (
+    chip INTEGER NOT NULL PRIMARY KEY,
+    user INTEGER NOT NULL UNIQUE
+);"""
+# number of the last record of the write spool that is committed, see spool.py
+_NEW_SPOOL_TABLE = """
+CREATE TABLE IF NOT EXISTS SpoolState (seq INTEGER NOT NULL);
+INSERT INTO SpoolState (seq) SELECT 0 WHERE NOT EXISTS (SELECT * FROM SpoolState);"""
+_DAY_OF = "CAST(julianday({}, 'unixepoch', 'localtime') - 2440587.5 AS INTEGER)"  # local days since epoch
+LATEST_DB_VERSION = 6
 _NEW_DB_VERSION = _ADD_VERSION = f"""
 CREATE TABLE DBVersion (version_number INTEGER NOT NULL);
 INSERT INTO DBVersion (version_number) values ({LATEST_DB_VERSION});
 """
 _INSERT_ACTION = """INSERT INTO Actions (user, date, action, description) values (?, ?, ?, ?)"""
+_UPSERT_DAILY_ACTION = f"""INSERT INTO DailyActions (user, day, action, count, first, last)
+VALUES (?1, {_DAY_OF.format('?2')}, ?3, 1, ?2, ?2)
+ON CONFLICT (user, day, action) DO UPDATE
+SET count = count + 1, first = MIN(first, excluded.first), last = MAX(last, excluded.last)"""
+_DELETE_ACTION = """DELETE FROM Actions
+WHERE id = (SELECT id FROM Actions WHERE user = ? AND date = ? AND action = ? ORDER BY id DESC LIMIT 1)"""
+_COUNT_DAILY_ACTION = """SELECT COUNT(*), MIN(date), MAX(date) FROM Actions
+WHERE user = ? AND date >= ? AND date < ? AND action = ?"""
+_UPDATE_DAILY_ACTION = f"""UPDATE DailyActions SET count = ?4, first = ?5, last = ?6
+WHERE user = ?1 AND day = {_DAY_OF.format('?2')} AND action = ?3"""
+_DELETE_DAILY_ACTION = f"""DELETE FROM DailyActions
+WHERE user = ?1 AND day = {_DAY_OF.format('?2')} AND action = ?3"""
 _INSERT_EMAIL = """UPDATE Users
 SET email=?
 WHERE user=?"""
@@ -37,8 +81,26 @@ _NEW_CHIP = """INSERT INTO Users (user, chip) values (?, ?)"""
 _INSERT_CHIP = """UPDATE Users
 SET chip=?
 WHERE user=?"""
+_READ_CHIP_OWNER = """SELECT user FROM Chips WHERE chip = ?"""
+_RELEASE_CHIP = """DELETE FROM Chips WHERE user = ? AND chip != ?"""
+_CLAIM_CHIP = """INSERT INTO Chips (chip, user) VALUES (?, ?)"""
 _READ_USER_BY_ID = 'SELECT user, chip, email FROM Users WHERE user = ?'
+_READ_ALL_CHIPS = 'SELECT user, chip FROM Users'
+_READ_CHIP_OWNERS = 'SELECT user, chip FROM Chips'
 _READ_ACTIONS_BY_ID = 'SELECT id, user, date, action, description FROM Actions'
+_READ_ACTIONS_BY_USER = 'SELECT id, user, date, action, description FROM Actions WHERE user = ?'
+_READ_ACTIONS_PAGE_OLDER = """SELECT id, user, date, action, description FROM Actions
+WHERE user = ? AND date >= ? AND date < ? AND (date, id) < (?, ?)
+ORDER BY date DESC, id DESC LIMIT ?"""
+_READ_ACTIONS_PAGE_NEWER = """SELECT id, user, date, action, description FROM Actions
+WHERE user = ? AND date >= ? AND date < ? AND (date, id) > (?, ?)
+ORDER BY date ASC, id ASC LIMIT ?"""
+_READ_SPOOL_SEQ = 'SELECT seq FROM SpoolState'
+_WRITE_SPOOL_SEQ = 'UPDATE SpoolState SET seq = ?'
+_COUNT_USERS = 'SELECT COUNT(*) FROM Users'
+_COUNT_ACTIONS = 'SELECT action, SUM(count) FROM DailyActions GROUP BY action'
+_READ_DAILY_ACTIONS_BY_USER = """SELECT user, day, action, count, first, last FROM DailyActions
+WHERE user = ? AND day >= ? ORDER BY day, action"""
 
 
 class actions(Enum):
@@ -62,7 +124,15 @@ class ActionData:
     description: Optional[str] = None
 
     def to_db(self, db_conn: sql.Connection):
-        db_conn.execute(_INSERT_ACTION, (self.user, self.time.timestamp(), self.action.value, self.description))
+        t = self.time.timestamp()
+        db_conn.execute(_INSERT_ACTION, (self.user, t, self.action.value, self.description))
+        db_conn.execute(_UPSERT_DAILY_ACTION, (self.user, t, self.action.value))
+
+    @staticmethod
+    def to_db_many(db_conn: sql.Connection, rows: List[Tuple[int, float, int, Optional[str]]]):
+        """:meth:`to_db` of many (user, timestamp, action value, description) rows"""
+        db_conn.executemany(_INSERT_ACTION, rows)
+        db_conn.executemany(_UPSERT_DAILY_ACTION, ((user, t, action) for user, t, action, _ in rows))
 
     @classmethod
     def from_db(cls, db_conn: sql.Connection) -> List["ActionData"]:
@@ -71,6 +141,13 @@ class ActionData:
             for (_, user, time, action, description) in db_conn.execute(_READ_ACTIONS_BY_ID).fetchall()
         )
 
+    @classmethod
+    def from_db_by_user(cls, db_conn: sql.Connection, user: int) -> List["ActionData"]:
+        return list(
+            cls(user, datetime.fromtimestamp(time), actions(action), description)
+            for (_, user, time, action, description) in db_conn.execute(_READ_ACTIONS_BY_USER, (user,)).fetchall()
+        )
+
 
 @dataclass(frozen=True)
 class ChipData:
@@ -78,11 +155,17 @@ class ChipData:
     chip: int
 
     def to_db(self, db_conn: sql.Connection):
+        """:raises sqlite3.IntegrityError if the chip belongs to another user"""
+        owner = db_conn.execute(_READ_CHIP_OWNER, (self.chip, )).fetchone()
+        if owner is not None and owner[0] != self.user:
+            raise sql.IntegrityError(f"chip {self.chip} belongs to user {owner[0]}")
+        db_conn.execute(_RELEASE_CHIP, (self.user, self.chip))
+        if owner is None:
+            db_conn.execute(_CLAIM_CHIP, (self.chip, self.user))
         try:
             db_conn.execute(_NEW_CHIP, (self.user, self.chip))
         except sql.IntegrityError:
             db_conn.execute(_INSERT_CHIP, (self.chip, self.user))
-        db_conn.commit()
 
     def from_db(self, db_conn: sql.Connection) -> Optional["ChipData"]:
         try:
@@ -101,8 +184,286 @@ class EmailData:
         db_conn.execute(_INSERT_EMAIL, (self.email, self.user))
 
 
-sqlite_writable_types = Union[ChipData, EmailData, ActionData]
-# this could be an interface declaration, but python does not have interface keywords
+@dataclass(frozen=True)
+class UndoActionData:
+    """removes an action written by `ActionData(user, time, action).to_db`"""
+    user: int
+    time: datetime
+    action: actions
+
+    def to_db(self, db_conn: sql.Connection):
+        t = self.time.timestamp()
+        db_conn.execute(_DELETE_ACTION, (self.user, t, self.action.value))
+        day_start = datetime.combine(self.time.date(), time.min)
+        day_end = day_start + timedelta(days=1)
+        count, first, last = db_conn.execute(
+            _COUNT_DAILY_ACTION, (self.user, day_start.timestamp(), day_end.timestamp(), self.action.value)
+        ).fetchone()
+        if count == 0:
+            db_conn.execute(_DELETE_DAILY_ACTION, (self.user, t, self.action.value))
+        else:
+            db_conn.execute(_UPDATE_DAILY_ACTION, (self.user, t, self.action.value, count, first, last))
+
+
+@dataclass(frozen=True)
+class ActionRowsData:
+    """many (user, timestamp, action value, description) rows of an import, see :meth:`ActionData.to_db_many`"""
+    rows: Tuple[Tuple[int, float, int, Optional[str]], ...]
+
+    def to_db(self, db_conn: sql.Connection):
+        ActionData.to_db_many(db_conn, self.rows)
+
+
+sqlite_writable_types = Union[ChipData, EmailData, ActionData, UndoActionData, ActionRowsData]
+
+
+@dataclass(frozen=True)
+class _Committed:
+    """write whose future is completed once it is committed"""
+    data: sqlite_writable_types
+    future: Future
+
+    def to_db(self, db_conn: sql.Connection):
+        self.data.to_db(db_conn)
+
+
+# records of the write spool: kind, fixed fields, then the text field if any
+_CHIP_KIND, _EMAIL_KIND, _ACTION_KIND, _UNDO_KIND, _ROWS_KIND = range(1, 6)
+_CHIP_RECORD = struct.Struct("<Bqi")  # kind, user, chip
+_EMAIL_RECORD = struct.Struct("<Bq")  # kind, user
+_ACTION_RECORD = struct.Struct("<BqdB?")  # kind, user, timestamp, action, has description
+_UNDO_RECORD = struct.Struct("<BqdB")  # kind, user, timestamp, action
+_ROWS_RECORD = struct.Struct("<BI")  # kind, number of rows, then the rows
+_ROW_RECORD = struct.Struct("<qdBi")  # user, timestamp, action, description length (-1 for None), then the text
+
+
+def _to_record(data: sqlite_writable_types) -> bytes:
+    if isinstance(data, ActionData):
+        return _ACTION_RECORD.pack(_ACTION_KIND, data.user, data.time.timestamp(), data.action.value,
+                                   data.description is not None) + (data.description or "").encode()
+    elif isinstance(data, ChipData):
+        return _CHIP_RECORD.pack(_CHIP_KIND, data.user, data.chip)
+    elif isinstance(data, EmailData):
+        return _EMAIL_RECORD.pack(_EMAIL_KIND, data.user) + data.email.encode()
+    elif isinstance(data, UndoActionData):
+        return _UNDO_RECORD.pack(_UNDO_KIND, data.user, data.time.timestamp(), data.action.value)
+    elif isinstance(data, ActionRowsData):
+        parts = [_ROWS_RECORD.pack(_ROWS_KIND, len(data.rows))]
+        for user, t, action, description in data.rows:
+            text = description.encode() if description is not None else b""
+            parts.append(_ROW_RECORD.pack(user, t, action, -1 if description is None else len(text)) + text)
+        return b"".join(parts)
+    raise TypeError(f"{type(data).__name__} can not be spooled")
+
+
+def _from_record(record: bytes) -> sqlite_writable_types:
+    kind = record[0]
+    if kind == _ACTION_KIND:
+        _, user, t, action, described = _ACTION_RECORD.unpack_from(record)
+        description = record[_ACTION_RECORD.size:].decode() if described else None
+        return ActionData(user, datetime.fromtimestamp(t), actions(action), description)
+    elif kind == _CHIP_KIND:
+        _, user, chip = _CHIP_RECORD.unpack(record)
+        return ChipData(user, chip)
+    elif kind == _EMAIL_KIND:
+        _, user = _EMAIL_RECORD.unpack_from(record)
+        return EmailData(user, record[_EMAIL_RECORD.size:].decode())
+    elif kind == _UNDO_KIND:
+        _, user, t, action = _UNDO_RECORD.unpack(record)
+        return UndoActionData(user, datetime.fromtimestamp(t), actions(action))
+    elif kind == _ROWS_KIND:
+        _, n = _ROWS_RECORD.unpack_from(record)
+        pos, rows = _ROWS_RECORD.size, []
+        for _ in range(n):
+            user, t, action, length = _ROW_RECORD.unpack_from(record, pos)
+            pos += _ROW_RECORD.size
+            rows.append((user, t, action, None if length < 0 else record[pos:pos + length].decode()))
+            pos += max(length, 0)
+        return ActionRowsData(tuple(rows))
+    raise ValueError(f"unknown spool record kind {kind}")
+
+
+_EPOCH = date(1970, 1, 1)
+
+
+@dataclass(frozen=True)
+class DailyActionData:
+    """row of the DailyActions rollup"""
+    user: int
+    day: date
+    action: actions
+    count: int
+    first: datetime
+    last: datetime
+
+    @classmethod
+    def from_db_by_user(cls, db_conn: sql.Connection, user: int, since: date) -> List["DailyActionData"]:
+        return list(
+            cls(user, _EPOCH + timedelta(days=day), actions(action), count,
+                datetime.fromtimestamp(first), datetime.fromtimestamp(last))
+            for (user, day, action, count, first, last)
+            in db_conn.execute(_READ_DAILY_ACTIONS_BY_USER, (user, (since - _EPOCH).days)).fetchall()
+        )
+
+
+ActionCursor = Tuple[float, int]  # (Actions.date, Actions.id) of a row on the page border
+
+
+@dataclass(frozen=True)
+class ActionPage:
+    """user actions from newest to oldest, cursors are None if there is nothing in that direction"""
+    actions: List[ActionData]
+    newer: Optional[ActionCursor]
+    older: Optional[ActionCursor]
+
+    @classmethod
+    def from_db(cls, db_conn: sql.Connection, user: int, since: datetime, until: Optional[datetime] = None,
+                cursor: Optional[ActionCursor] = None, older: bool = True, size: int = 10) -> "ActionPage":
+        """
+        keyset pagination over the (user, date) index, the cost of a page does not depend on the table size.
+        :param cursor: border of the current page, None for the newest page
+        :param older: direction to move from the cursor
+        """
+        window = (user, since.timestamp(), float("inf") if until is None else until.timestamp())
+        if older:
+            rows = db_conn.execute(
+                _READ_ACTIONS_PAGE_OLDER, (*window, *(cursor or (float("inf"), 0)), size + 1)).fetchall()
+            more = len(rows) > size
+            rows = rows[:size]
+            has_newer, has_older = cursor is not None, more
+        else:
+            rows = db_conn.execute(_READ_ACTIONS_PAGE_NEWER, (*window, *cursor, size + 1)).fetchall()
+            more = len(rows) > size
+            rows = rows[:size][::-1]
+            has_newer, has_older = more, True
+        if not rows:
+            return cls([], None, None)
+        return cls(
+            [ActionData(u, datetime.fromtimestamp(t), actions(a), d) for (_, u, t, a, d) in rows],
+            (rows[0][2], rows[0][0]) if has_newer else None,
+            (rows[-1][2], rows[-1][0]) if has_older else None,
+        )
+
+
+@dataclass(frozen=True)
+class StatsData:
+    users: int
+    actions: Dict[actions, int]
+
+    @classmethod
+    def from_db(cls, db_conn: sql.Connection) -> "StatsData":
+        (users, ), = db_conn.execute(_COUNT_USERS).fetchall()
+        return cls(users, {actions(a): n for a, n in db_conn.execute(_COUNT_ACTIONS).fetchall()})
+
+
+READ_USER, READ_ACTIONS, READ_ACTIONS_PAGE, READ_DAILY_ACTIONS, READ_STATS = \
+    "user", "actions", "actions_page", "daily_actions", "stats"  # kinds of read requests
+
+
+@dataclass(frozen=True)
+class _Read:
+    kind: str
+    key: Optional[int] = None
+    args: tuple = ()
+
+    def from_db(self, conn: sql.Connection) -> Any:
+        if self.kind == READ_USER:
+            return ChipData(self.key, 0).from_db(conn)
+        elif self.kind == READ_ACTIONS:
+            return ActionData.from_db_by_user(conn, self.key)
+        elif self.kind == READ_ACTIONS_PAGE:
+            return ActionPage.from_db(conn, self.key, *self.args)
+        elif self.kind == READ_DAILY_ACTIONS:
+            return DailyActionData.from_db_by_user(conn, self.key, *self.args)
+        elif self.kind == READ_STATS:
+            return StatsData.from_db(conn)
+        raise ValueError(f"unknown read kind {self.kind}")
+
+
+class _UserCache:
+    """
+    write-through LRU cache of the user -> chip part of the Users table.
+    while nothing has been evicted the cache holds the whole table,
+    so misses are answered without touching the database
+    """
+    __slots__ = "capacity", "complete", "hits", "misses", "_users", "_lock"
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.complete = False
+        self.hits = self.misses = 0
+        self._users: "OrderedDict[int, ChipData]" = OrderedDict()
+        self._lock = Lock()
+
+    def load(self, db_conn: sql.Connection):
+        with self._lock:
+            self._users.clear()
+            self.complete = True
+            for row in db_conn.execute(_READ_ALL_CHIPS):
+                self._put(ChipData(*row))
+
+    def get(self, user: int) -> (bool, Optional[ChipData]):
+        """:returns (found, chip_data), found is True if the cache knows the answer"""
+        with self._lock:
+            cd = self._users.get(user)
+            if cd is not None:
+                self._users.move_to_end(user)
+            return self._count(cd is not None or self.complete), cd
+
+    def put(self, cd: ChipData):
+        with self._lock:
+            self._put(cd)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(size=len(self._users), capacity=self.capacity, hits=self.hits, misses=self.misses)
+
+    def _count(self, hit: bool) -> bool:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit
+
+    def _put(self, cd: ChipData):
+        self._users.pop(cd.user, None)
+        self._users[cd.user] = cd
+        while len(self._users) > self.capacity:
+            self._users.popitem(last=False)
+            self.complete = False
+
+
+class _ChipIndex:
+    """
+    chip -> user mirror of the Chips table, it is small (one entry per chip) so it is always complete.
+    claims are decided here, before the write is queued, the unique constraints of the table back it up
+    """
+    __slots__ = "_owners", "_chips", "_lock"
+
+    def __init__(self):
+        self._owners: Dict[int, int] = dict()
+        self._chips: Dict[int, int] = dict()  # user -> chip
+        self._lock = Lock()
+
+    def load(self, db_conn: sql.Connection):
+        with self._lock:
+            self._owners = {chip: user for user, chip in db_conn.execute(_READ_CHIP_OWNERS)}
+            self._chips = {user: chip for chip, user in self._owners.items()}
+
+    def owner(self, chip: int) -> Optional[int]:
+        return self._owners.get(chip)
+
+    def claim(self, user: int, chip: int) -> bool:
+        """:returns False if the chip belongs to another user, otherwise it is now the only chip of `user`"""
+        with self._lock:
+            owner = self._owners.get(chip)
+            if owner is not None:
+                return owner == user
+            old = self._chips.pop(user, None)
+            if old is not None:
+                del self._owners[old]
+            self._owners[chip] = user
+            self._chips[user] = chip
+            return True
 
 
 # ================================ database singleton ==========================
@@ -110,33 +471,87 @@ sqlite_writable_types = Union[ChipData, EmailData, ActionData]
 __db_path: Path
 __db_thread: Thread
 __db_queue: Queue
-__db_sigterm: Event
+__db_readers: ThreadPoolExecutor
+__db_reader_conn = local()  # each reader thread holds its own read-only connection
+__db_reader_conns: List[sql.Connection] = []  # of all reader threads, closed by db_terminate
+__db_reader_conns_lock = Lock()
+__db_user_cache: _UserCache
+__db_chip_index: _ChipIndex
+__db_spool: Optional[Spool] = None  # writes are appended to it before they are queued
+__db_commits = 0  # number of group commits, lets caches of derived data notice new writes
+__db_version_conn: Optional[sql.Connection] = None  # in a worker process, commits are noticed through it
+__db_version_lock = Lock()
 
+_SHUTDOWN = object()  # queue sentinel, makes the db thread commit and exit
+DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_MAX_COMMIT_DELAY = 0.01  # seconds
+DEFAULT_READ_TIMEOUT = 5.0  # seconds
+DEFAULT_READ_POOL_SIZE = 4
+DEFAULT_CHECKPOINT_INTERVAL = 60.0  # seconds
+DEFAULT_USER_CACHE_SIZE = 100_000
 
-def db_init(db_path: Path):
-    global __db_path
-    global __db_thread
-    global __db_queue
-    global __db_sigterm
-    __db_path = db_path
-    __db_sigterm = Event()
-    __db_queue = Queue()  # input type is (read_request_id, data): Tuple[Optional[int], sqlite_writable_types]
-    __db_thread = Thread(target=_db_thread, name="db", args=(db_path, __db_queue, __db_sigterm))
-    __db_thread.start()
+_QUEUE_LENGTH = metrics.Gauge("db_queue_length", "writes waiting for the db thread")
+_BATCH_SIZE = metrics.Histogram("db_batch_size", "writes per group commit", buckets=metrics.SIZE_BUCKETS)
+_COMMIT_SECONDS = metrics.Histogram("db_commit_seconds", "duration of a group commit")
+_READ_SECONDS = metrics.Histogram("db_read_seconds", "read requests, waiting in the pool included", ("kind", ))
+_USER_LOOKUP_SECONDS = metrics.Histogram("db_user_lookup_seconds", "db_read_user wait", ("source", ))
+_WAL_SIZE_LIMIT = 64 * 2**20  # bytes, the wal file is truncated to this size after checkpoints
+_RETRY_DELAY = 0.05  # seconds before a batch is written again after a failed commit, doubled up to the maximum
+_MAX_RETRY_DELAY = 5.0
 
 
-def db_terminate() -> (Thread, Path):
-    __db_sigterm.set()
-    logging.getLogger(__name__).info("sigterm to db")
-    return __db_thread, __db_path
+def connect_readonly(db_path: Path, check_same_thread: bool = True) -> sql.Connection:
+    """read-only connection, can be used on the live database since it is in WAL mode"""
+    return sql.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=check_same_thread)
 
 
-def db_write(data: sqlite_writable_types):
-    __db_queue.put((None, data))
+class _BackupRestarted(Exception):
+    pass
+
+
+def snapshot(db_path: Path, out_path: Path, compress: bool = False,
+             pages_per_step: int = 1024, max_restarts: int = 3) -> Path:
+    """
+    consistent copy of a (live) database through the sqlite online backup api.
+    the copy is done in steps of `pages_per_step` pages, yielding to other threads in between,
+    so the db thread keeps committing. a commit during the backup restarts it,
+    after `max_restarts` restarts the rest is copied in a single step.
+    :param compress: gzip the copy, ".gz" is appended to the name
+    :returns path of the copy
+    """
+    tmp = out_path.with_name(out_path.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    remaining_before = [None, 0]  # remaining pages after the previous step, restarts
+
+    def progress(_, remaining: int, __):
+        if remaining_before[0] is not None and remaining > remaining_before[0]:
+            remaining_before[1] += 1
+            if remaining_before[1] > max_restarts:
+                raise _BackupRestarted()
+        remaining_before[0] = remaining
+        sleep(0)  # yield the gil between the steps
+
+    with closing(connect_readonly(db_path)) as src, closing(sql.connect(tmp)) as dst:
+        try:
+            src.backup(dst, pages=pages_per_step, progress=progress)
+        except _BackupRestarted:
+            src.backup(dst, pages=-1)
+        dst.execute("PRAGMA journal_mode=DELETE")  # the copy is a single self-contained file
+    if compress:
+        import gzip
+        import shutil
+        out_path = out_path.with_name(out_path.name + ".gz")
+        with tmp.open("rb") as f_in, gzip.open(out_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 2**20)
+        tmp.unlink()
+    else:
+        tmp.replace(out_path)
+    logging.getLogger(__name__).info(f"db snapshot {out_path}")
+    return out_path
 
 
-def _db_thread(db_path: Path, task_queue: Queue, sigterm: Event,
-               queue_poll_interval: float = 0.2):
+def _prepare_db(db_path: Path):
+    """creates or migrates the database, switches it to WAL mode"""
     if db_path.exists():
         db_conn = sql.connect(db_path)
         from .database_migration_scripts import update
@@ -147,41 +562,490 @@ def _db_thread(db_path: Path, task_queue: Queue, sigterm: Event,
         with db_conn:
             db_conn.execute(_NEW_USER_TABLE)
             db_conn.execute(_NEW_ACTION_TABLE)
+            db_conn.execute(_NEW_ACTION_INDEX)
+            db_conn.execute(_NEW_DAILY_ACTION_TABLE)
+            db_conn.execute(_NEW_CHIP_TABLE)
+            db_conn.executescript(_NEW_SPOOL_TABLE)
             db_conn.executescript(_NEW_DB_VERSION)
+    db_conn.execute("PRAGMA journal_mode=WAL")  # persistent, readers no longer wait for the writer
+    db_conn.close()
+
+
+def db_init(db_path: Path,
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_commit_delay: float = DEFAULT_MAX_COMMIT_DELAY,
+            read_pool_size: int = DEFAULT_READ_POOL_SIZE,
+            checkpoint_interval: float = DEFAULT_CHECKPOINT_INTERVAL,
+            user_cache_size: int = DEFAULT_USER_CACHE_SIZE,
+            spool: bool = True,
+            spool_fsync_interval: float = DEFAULT_SPOOL_FSYNC_INTERVAL):
+    """
+    prepares the database, fills the user cache and the chip index, starts the db (writer) thread and the pool of reader threads.
+    :param max_batch_size: maximal number of queued writes that are committed in a single transaction
+    :param max_commit_delay: how long (seconds) the first write of a batch may wait for other writes to join it
+    :param read_pool_size: number of read-only connections
+    :param checkpoint_interval: minimal time (seconds) between wal checkpoints issued by the writer
+    :param user_cache_size: maximal number of Users rows kept in memory
+    :param spool: queued writes are kept in `<db_path>.spool` until they are committed,
+        writes left there by a crash are committed first
+    :param spool_fsync_interval: how long (seconds) appended writes may wait for the group fsync of the spool
+    """
+    global __db_path
+    global __db_thread
+    global __db_queue
+    global __db_readers
+    global __db_user_cache
+    global __db_chip_index
+    global __db_spool
+    __db_path = db_path
+    _prepare_db(db_path)
+    __db_spool = _replay_spool(db_path, spool_fsync_interval) if spool else None
+    __db_user_cache = _UserCache(user_cache_size)
+    __db_chip_index = _ChipIndex()
+    with closing(connect_readonly(db_path)) as conn:
+        __db_user_cache.load(conn)
+        __db_chip_index.load(conn)
+    __db_queue = Queue()  # input type is sqlite_writable_types
+    _QUEUE_LENGTH.set_function(__db_queue.qsize)
+    __db_thread = Thread(target=_db_thread, name="db", args=(
+        db_path, __db_queue, max_batch_size, max_commit_delay, checkpoint_interval, __db_spool))
+    __db_thread.start()
+    __db_readers = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="db_reader")
+
+
+def _replay_spool(db_path: Path, fsync_interval: float) -> Spool:
+    """commits the writes that a crash left in the spool, :returns the emptied spool"""
+    logger = logging.getLogger(__name__)
+    with closing(sql.connect(db_path)) as db_conn:
+        (committed, ), = db_conn.execute(_READ_SPOOL_SEQ).fetchall()
+        spool = Spool(db_path.with_name(db_path.name + ".spool"), committed, fsync_interval)
+        # a busy or failing database raises here, the bot does not start and the spool is kept
+        for data, e in _write_batch(db_conn, [_from_record(record) for _, record in spool.pending], spool.seq):
+            logger.error(f"spooled db write {data} failed", exc_info=e)
+    if spool.pending:
+        logger.warning(f"{len(spool.pending)} spooled db writes are committed after a crash")
+    spool.pending = []
+    spool.committed(spool.seq)
+    return spool
+
+
+def db_terminate() -> (Thread, Path):
+    """waits for the reads in progress and closes the reader connections, the db thread commits the queued writes"""
+    global __db_version_conn
+    __db_queue.put(_SHUTDOWN)
+    __db_readers.shutdown(wait=True)
+    with __db_reader_conns_lock:
+        for conn in __db_reader_conns:
+            conn.close()
+        __db_reader_conns.clear()
+    with __db_version_lock:
+        if __db_version_conn is not None:
+            __db_version_conn.close()
+            __db_version_conn = None
+    logging.getLogger(__name__).info("sigterm to db")
+    return __db_thread, __db_path
+
 
-    while True:
-        if task_queue.empty():
-            if sigterm.is_set():
-                db_conn.commit()
-                logging.getLogger(__name__).info("db terminated")
+def _claim(data: sqlite_writable_types):
+    if isinstance(data, ChipData):
+        if not __db_chip_index.claim(data.user, data.chip):
+            raise ValueError(f"chip {data.chip} belongs to user {__db_chip_index.owner(data.chip)}")
+        __db_user_cache.put(data)  # write-through: readers see the chip before it is committed
+
+
+def _enqueue(data: sqlite_writable_types, task):
+    if __db_spool is None:
+        __db_queue.put(task)
+    else:
+        __db_spool.append(_to_record(data), lambda: __db_queue.put(task))
+
+
+def db_write(data: sqlite_writable_types):
+    """
+    returns once the write is in the spool (see :func:`db_init`), it is committed later.
+    :raises ValueError if `data` is a ChipData with a chip of another user
+    """
+    _claim(data)
+    _enqueue(data, data)
+
+
+def db_write_future(data: sqlite_writable_types) -> Future:
+    """
+    :func:`db_write` that can be waited for, use `asyncio.wrap_future` to await it.
+    :returns future that is completed once the write is committed, in a worker process once the writer process has it
+    :raises ValueError as db_write
+    """
+    _claim(data)
+    future = Future()
+    _enqueue(data, _Committed(data, future))
+    return future
+
+
+def _collect_batch(task_queue: Queue, max_batch_size: int, max_commit_delay: float) -> list:
+    """blocks until a task arrives, then drains the queue for at most `max_commit_delay` seconds"""
+    batch = [task_queue.get()]
+    deadline = monotonic() + max_commit_delay
+    while len(batch) < max_batch_size and batch[-1] is not _SHUTDOWN:
+        try:
+            batch.append(task_queue.get_nowait())
+            continue
+        except Empty:
+            pass
+        timeout = deadline - monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(task_queue.get(timeout=timeout))
+        except Empty:
+            break
+    return batch
+
+
+def db_commit_count() -> int:
+    """in a worker process (see :func:`db_connect`) it is the data version of the file, it changes on every commit"""
+    if __db_version_conn is None:
+        return __db_commits
+    with __db_version_lock:
+        (version, ), = __db_version_conn.execute("PRAGMA data_version").fetchall()
+        return version
+
+
+def _write_batch(db_conn: sql.Connection, batch: list, spool_seq: Optional[int] = None,
+                 isolated: bool = False) -> List[Tuple[Any, Exception]]:
+    """
+    writes the tasks of `batch` and the spool number in one transaction, a task rejected for its data
+    (a constraint) is rolled back alone.
+    :param isolated: each task is in a savepoint. a batch without them is written again with them once a task
+        is rejected, so only such batches pay for the savepoints
+    :returns the rejected tasks and their errors
+    :raises sqlite3.OperationalError (busy, locked, i/o error) or what the commit raises,
+        after a rollback of the whole batch, so it can be written again
+    """
+    rejected = []
+    try:
+        db_conn.execute("BEGIN")
+        for data in batch:
+            if isolated:
+                db_conn.execute("SAVEPOINT task")
+            try:
+                data.to_db(db_conn)
+            except sql.OperationalError:
+                raise
+            except Exception as e:
+                rejected.append((data, e))
+                if not isolated:
+                    break
+                db_conn.execute("ROLLBACK TO task")
+            if isolated:
+                db_conn.execute("RELEASE task")
+        if rejected and not isolated:
+            db_conn.rollback()
+            return _write_batch(db_conn, batch, spool_seq, isolated=True)
+        if spool_seq is not None:
+            db_conn.execute(_WRITE_SPOOL_SEQ, (spool_seq, ))
+        with _COMMIT_SECONDS.time():
+            db_conn.commit()  # one group commit for the whole batch
+    except BaseException:
+        db_conn.rollback()
+        raise
+    return rejected
+
+
+def _db_thread(db_path: Path, task_queue: Queue,
+               max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+               max_commit_delay: float = DEFAULT_MAX_COMMIT_DELAY,
+               checkpoint_interval: float = DEFAULT_CHECKPOINT_INTERVAL,
+               spool: Optional[Spool] = None):
+    """
+    every task of `task_queue` but the sentinel is a record of `spool`, in the same order.
+    a batch whose commit fails (the database is busy, locked, full) is written again after a growing delay,
+    its records stay in the spool until then. a task rejected for its data counts as done, a replay rejects it too
+    """
+    global __db_commits
+    db_conn = sql.connect(db_path)
+    db_conn.execute(f"PRAGMA journal_size_limit={_WAL_SIZE_LIMIT}")
+    logger = logging.getLogger(__name__)
+    last_checkpoint = monotonic()
+    seq = 0 if spool is None else spool.committed_seq  # writes may be appended before the thread runs
+    batch = []  # tasks that are not committed yet
+    delay = _RETRY_DELAY
+    running = True
+    while running or batch:
+        if not batch:
+            batch = _collect_batch(task_queue, max_batch_size, max_commit_delay)
+            if batch[-1] is _SHUTDOWN:
+                running = False
+                batch.pop()
+                continue
+        try:
+            rejected = _write_batch(db_conn, batch, None if spool is None else seq + len(batch))
+        except Exception as e:
+            if not running and delay >= _MAX_RETRY_DELAY:
+                logger.error(f"{len(batch)} db writes are not committed on shutdown", exc_info=e)  # kept in the spool
                 break
-            sleep(queue_poll_interval)
+            logger.warning(f"db commit of {len(batch)} writes failed, retry in {delay} s", exc_info=e)
+            sleep(delay)
+            delay = min(2 * delay, _MAX_RETRY_DELAY)
             continue
-        read_request_id, data = task_queue.get()  # read_request_id: Optional[int]; data: sqlite_writable_types
-        if read_request_id is None:
-            data.to_db(db_conn)
-            logging.getLogger(__name__).debug("db commit")
-            db_conn.commit()
-        else:
-            __db_output[read_request_id] = data.from_db(db_conn)
+        delay = _RETRY_DELAY
+        seq += len(batch)
+        __db_commits += 1
+        _BATCH_SIZE.observe(len(batch) - len(rejected))
+        logger.debug(f"db commit, {len(batch) - len(rejected)} writes")
+        if spool is not None:
+            spool.committed(seq)
+        failed = {id(data): e for data, e in rejected}
+        for data in batch:
+            e = failed.get(id(data))
+            if e is not None:
+                logger.error(f"db write {data} failed", exc_info=e)
+            if isinstance(data, _Committed):
+                if e is None:
+                    data.future.set_result(None)
+                else:
+                    data.future.set_exception(e)
+        batch = []
+        if monotonic() - last_checkpoint > checkpoint_interval:
+            # passive checkpoints never block on readers, the wal is reset once it has been fully copied
+            try:
+                busy, *_ = db_conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                logger.debug(f"db checkpoint, busy={busy}")
+            except sql.Error as e:
+                logger.warning("db checkpoint failed", exc_info=e)
+            last_checkpoint = monotonic()
+    try:
+        db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except sql.Error as e:
+        logger.warning("db checkpoint failed", exc_info=e)
+    db_conn.close()
+    if spool is not None:
+        spool.close()
+    logger.info("db terminated")
 
 
-__db_output: Dict[int, sqlite_writable_types] = dict()
+def _read_in_pool(request: _Read):
+    conn = getattr(__db_reader_conn, "conn", None)
+    if conn is None:
+        conn = __db_reader_conn.conn = connect_readonly(__db_path, check_same_thread=False)  # closed by db_terminate
+        with __db_reader_conns_lock:
+            __db_reader_conns.append(conn)
+    return request.from_db(conn)
 
 
-@dataclass(frozen=True)
-class _Read:
-    request: int
-    table: str
-    key: int
+def db_read(request: _Read) -> Future:
+    """
+    submits a read request to the reader pool, reads do not wait for queued writes.
+    :returns future that is completed as soon as the data is read,
+    use `asyncio.wrap_future` to await it
+    """
+    future = __db_readers.submit(_read_in_pool, request)
+    if metrics.enabled():
+        start = monotonic()
+        future.add_done_callback(lambda _: _READ_SECONDS.observe(monotonic() - start, request.kind))
+    return future
+
+
+def db_read_future(kind: str, key: Optional[int] = None, *args) -> Future:
+    """:param kind: READ_USER, READ_ACTIONS, ..., `key` and `args` are those of the matching `db_read_*` function"""
+    return db_read(_Read(kind, key, args))
+
+
+def db_read_user_future(user: int) -> Future:
+    """:func:`db_read_user` without waiting, the future is already done if the user is cached"""
+    start = monotonic()
+    found, u = __db_user_cache.get(user)
+    if found:
+        future = Future()
+        future.set_result(u)
+        _USER_LOOKUP_SECONDS.observe(monotonic() - start, "cache")
+        return future
+
+    def cache(f: Future):
+        logging.getLogger(__name__).debug("db read")
+        if f.exception() is None and f.result() is not None:
+            __db_user_cache.put(f.result())
+        _USER_LOOKUP_SECONDS.observe(monotonic() - start, "db")
+    future = db_read(_Read(READ_USER, user))
+    future.add_done_callback(cache)
+    return future
+
+
+def db_read_user(user: int, timeout: Optional[float] = DEFAULT_READ_TIMEOUT) -> Optional[ChipData]:
+    """:raises concurrent.futures.TimeoutError"""
+    return db_read_user_future(user).result(timeout)
+
+
+def db_claim_chip(user: int, chip: int) -> bool:
+    """registers the chip to the user unless another user has it. :returns whether the chip is the user's now"""
+    try:
+        db_write(ChipData(user, chip))
+        return True
+    except ValueError:
+        return False
+
+
+def db_read_chip_owner(chip: int) -> Optional[ChipData]:
+    user = __db_chip_index.owner(chip)
+    return None if user is None else ChipData(user, chip)
+
+
+def db_user_cache_stats() -> Dict[str, int]:
+    return __db_user_cache.stats()
+
+
+def db_read_actions(user: int, timeout: Optional[float] = DEFAULT_READ_TIMEOUT) -> List[ActionData]:
+    """:raises concurrent.futures.TimeoutError"""
+    return db_read(_Read(READ_ACTIONS, user)).result(timeout)
+
+
+def db_read_actions_page(user: int, since: datetime, until: Optional[datetime] = None,
+                         cursor: Optional[ActionCursor] = None, older: bool = True, size: int = 10,
+                         timeout: Optional[float] = DEFAULT_READ_TIMEOUT) -> ActionPage:
+    """see :meth:`ActionPage.from_db`. :raises concurrent.futures.TimeoutError"""
+    return db_read(_Read(READ_ACTIONS_PAGE, user, (since, until, cursor, older, size))).result(timeout)
+
+
+def db_read_daily_actions(user: int, since: date,
+                          timeout: Optional[float] = DEFAULT_READ_TIMEOUT) -> List[DailyActionData]:
+    """per day and action counts of a user since `since` (local days). :raises concurrent.futures.TimeoutError"""
+    return db_read(_Read(READ_DAILY_ACTIONS, user, (since, ))).result(timeout)
+
+
+def db_read_stats(timeout: Optional[float] = DEFAULT_READ_TIMEOUT) -> StatsData:
+    """:raises concurrent.futures.TimeoutError"""
+    return db_read(_Read(READ_STATS)).result(timeout)
+
+
+# ================================ writer process ==========================
+# with several worker processes one process owns the database and runs the db thread (`db_serve`),
+# workers (`db_connect`) read the file themselves and send writes and chip claims to it over a local socket
+
+_WRITE, _CLAIM, _OWNER = "write", "claim", "owner"  # requests to the writer process
+
+
+class _RemoteQueue:
+    """write queue of a worker process, its thread sends the writes to the writer process in batches"""
+
+    def __init__(self, conn: Connection, lock: Lock, max_batch_size: int, max_commit_delay: float):
+        self._queue = Queue()
+        self._conn = conn
+        self._lock = lock
+        self.thread = Thread(target=self._run, name="db_sender", args=(max_batch_size, max_commit_delay))
+        self.thread.start()
+
+    def put(self, data):
+        self._queue.put(data)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self, max_batch_size: int, max_commit_delay: float):
+        running = True
+        while running:
+            batch = _collect_batch(self._queue, max_batch_size, max_commit_delay)
+            if batch[-1] is _SHUTDOWN:
+                running = False
+                batch.pop()
+            if batch:
+                with self._lock:
+                    self._conn.send((_WRITE, [d.data if isinstance(d, _Committed) else d for d in batch]))
+                for d in batch:
+                    if isinstance(d, _Committed):
+                        d.future.set_result(None)
+        with self._lock:
+            self._conn.close()  # the writer process commits what it got and exits when all workers are gone
+        logging.getLogger(__name__).info("db sender terminated")
+
+
+class _RemoteChipIndex:
+    """claims are decided by the writer process, it has the only complete chip index"""
+
+    def __init__(self, conn: Connection, lock: Lock):
+        self._conn = conn
+        self._lock = lock
+
+    def owner(self, chip: int) -> Optional[int]:
+        return self._call(_OWNER, chip)
+
+    def claim(self, user: int, chip: int) -> bool:
+        return self._call(_CLAIM, user, chip)
+
+    def _call(self, *request):
+        with self._lock:
+            self._conn.send(request)
+            return self._conn.recv()
+
+
+def db_connect(address: Union[str, Tuple[str, int]], authkey: bytes, db_path: Path,
+               max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+               max_commit_delay: float = DEFAULT_MAX_COMMIT_DELAY,
+               read_pool_size: int = DEFAULT_READ_POOL_SIZE,
+               user_cache_size: int = DEFAULT_USER_CACHE_SIZE,
+               **_):
+    """
+    :func:`db_init` of a worker process, the database is prepared by the writer process.
+    reads are done in this process, writes are batched and sent to the writer process at `address`.
+    the user cache is only consistent for users whose writes go through this process
+    """
+    global __db_path
+    global __db_thread
+    global __db_queue
+    global __db_readers
+    global __db_user_cache
+    global __db_chip_index
+    global __db_version_conn
+    __db_path = db_path
+    conn, lock = Client(address, authkey=authkey), Lock()
+    __db_user_cache = _UserCache(user_cache_size)
+    __db_chip_index = _RemoteChipIndex(conn, lock)
+    with closing(connect_readonly(db_path)) as read_conn:
+        __db_user_cache.load(read_conn)
+    __db_version_conn = sql.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+    __db_queue = _RemoteQueue(conn, lock, max_batch_size, max_commit_delay)
+    __db_thread = __db_queue.thread
+    _QUEUE_LENGTH.set_function(__db_queue.qsize)
+    __db_readers = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="db_reader")
+
 
-    def from_db(self, conn: sql.Connection):
-        pass
+def _serve_client(conn: Connection):
+    logger = logging.getLogger(__name__)
+    with conn:
+        while True:
+            try:
+                kind, *args = conn.recv()
+            except EOFError:
+                return
+            if kind == _WRITE:
+                for data in args[0]:
+                    try:
+                        db_write(data)
+                    except ValueError as e:
+                        logger.error(f"db write {data} rejected", exc_info=e)
+            elif kind == _CLAIM:
+                conn.send(__db_chip_index.claim(*args))
+            elif kind == _OWNER:
+                conn.send(__db_chip_index.owner(*args))
 
 
-def db_read_user(user: int) -> Optional[ChipData]:
-    __db_queue.put((user, ChipData(user, 0)))
-    while user not in __db_output:
-        sleep(0.05)
-    logging.getLogger(__name__).debug("db read")
-    return __db_output.pop(user)
+def db_serve(address: Union[str, Tuple[str, int]], authkey: bytes, clients: int, db_path: Path,
+             on_ready: Optional[Callable[[Union[str, Tuple[str, int]]], None]] = None, **kwargs):
+    """
+    runs the db thread for `clients` worker processes connecting with :func:`db_connect`,
+    returns once all of them have disconnected and everything they sent is committed.
+    :param address: path of a unix socket, or (host, port) of a tcp one, port 0 picks a free one
+    :param on_ready: called with the address workers connect to, once they can
+    :param kwargs: passed to :func:`db_init`
+    """
+    db_init(db_path, **kwargs)
+    if isinstance(address, str):
+        Path(address).unlink(missing_ok=True)  # left by a crash
+    with Listener(address, authkey=authkey) as listener:
+        if on_ready is not None:
+            on_ready(listener.address)
+        threads = []
+        for i in range(clients):
+            threads.append(Thread(target=_serve_client, args=(listener.accept(), ), name=f"db_client{i}"))
+            threads[-1].start()
+    for t in threads:
+        t.join()
+    db_terminate()[0].join()
@@ -2,6 +2,7 @@
 # I've spent half an hour automating something that could be done in 2 minutes by hand.
 # Totally worth it.
 
+import logging
 import sqlite3
 from typing import Callable, List
 
@@ -39,3 +40,59 @@ def _updater_1(conn: sqlite3.Connection):
     INSERT INTO DBVersion (version_number) values (2);
     ALTER TABLE Actions ADD description TEXT;""")
 
+
+def _updater_2(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS ActionsByUserDate ON Actions (user, date);")
+
+
+def _updater_3(conn: sqlite3.Connection, chunk_size: int = 100_000):
+    """adds the DailyActions rollup and backfills it from Actions, committing after each chunk of ids"""
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS DailyActions (
+        user INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        action INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        first FLOAT NOT NULL,
+        last FLOAT NOT NULL,
+        PRIMARY KEY (user, day, action)
+    ) WITHOUT ROWID;
+    DELETE FROM DailyActions;""")  # a backfill interrupted earlier is started anew
+    (last_id, ), = conn.execute("SELECT COALESCE(MAX(id), 0) FROM Actions").fetchall()
+    for lo in range(0, last_id, chunk_size):
+        conn.execute("""
+        INSERT INTO DailyActions (user, day, action, count, first, last)
+        SELECT user, CAST(julianday(date, 'unixepoch', 'localtime') - 2440587.5 AS INTEGER) AS day, action,
+            COUNT(*), MIN(date), MAX(date)
+        FROM Actions WHERE id > ? AND id <= ?
+        GROUP BY user, day, action
+        ON CONFLICT (user, day, action) DO UPDATE
+        SET count = count + excluded.count, first = MIN(first, excluded.first), last = MAX(last, excluded.last)
+        """, (lo, lo + chunk_size))
+        conn.commit()
+
+
+def _updater_4(conn: sqlite3.Connection):
+    """
+    adds the Chips table, a chip belongs to one user at most.
+    if several users registered the same chip, the one with the smallest id keeps it,
+    the chip of the others becomes -1 (no chip, as decode_db.py exports it), they register a chip again
+    """
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS Chips (
+        chip INTEGER NOT NULL PRIMARY KEY,
+        user INTEGER NOT NULL UNIQUE
+    );
+    INSERT OR IGNORE INTO Chips (chip, user) SELECT chip, user FROM Users ORDER BY user;""")
+    losers = conn.execute("""SELECT u.user, u.chip, c.user FROM Users u JOIN Chips c ON c.chip = u.chip
+    WHERE c.user != u.user""").fetchall()
+    for user, chip, owner in losers:
+        logging.getLogger(__name__).warning(f"chip {chip} of user {user} belongs to user {owner}, the chip is cleared")
+    conn.executemany("UPDATE Users SET chip = -1 WHERE user = ?", ((user, ) for user, _, _ in losers))
+
+
+def _updater_5(conn: sqlite3.Connection):
+    """adds the number of the last committed record of the write spool"""
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS SpoolState (seq INTEGER NOT NULL);
+    INSERT INTO SpoolState (seq) SELECT 0 WHERE NOT EXISTS (SELECT * FROM SpoolState);""")
@@ -0,0 +1,164 @@
+"""
+admin export: storage files packed into a compressed archive, streamed into size-limited parts.
+the live database is replaced with a consistent snapshot of it
+"""
+import hashlib
+import json
+import logging
+import shutil
+import tarfile
+import tempfile
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional, Iterable, Dict
+
+from . import database, resources as rss
+
+EXPORT_PATH = rss.STORAGE_PATH / "export"  # each export is a directory in it
+ARCHIVE_NAME = "export.tar.gz"
+MANIFEST_NAME = "export.manifest.json"
+DEFAULT_PART_SIZE = 45 * 2**20  # bots may send documents up to 50 MB
+
+
+class _PartWriter:
+    """write-only file object that splits the stream into parts of at most `part_size` bytes and hashes them"""
+
+    def __init__(self, out_dir: Path, name: str, part_size: int):
+        self.out_dir = out_dir
+        self.name = name
+        self.part_size = part_size
+        self.parts: List[Dict] = []
+        self.total = hashlib.sha256()
+        self._file = None
+        self._hash = None
+        self._size = 0
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        while view:
+            if self._file is None or self._size == self.part_size:
+                self._next_part()
+            chunk = view[:self.part_size - self._size]
+            self._file.write(chunk)
+            self._hash.update(chunk)
+            self.total.update(chunk)
+            self._size += len(chunk)
+            view = view[len(chunk):]
+        return len(data)
+
+    def _next_part(self):
+        self._close_part()
+        path = self.out_dir / f"{self.name}.{len(self.parts):03d}"
+        self._file, self._hash, self._size = path.open("wb"), hashlib.sha256(), 0
+        self.parts.append({"name": path.name})
+
+    def _close_part(self):
+        if self._file is not None:
+            self._file.close()
+            self.parts[-1].update(size=self._size, sha256=self._hash.hexdigest())
+            self._file = None
+
+    def close(self):
+        self._close_part()
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _sources(files: Optional[Iterable[Path]]) -> List[Path]:
+    """storage files to export: all of them by default, never the export itself or the live db side files"""
+    skip = {EXPORT_PATH} | {rss.DATABASE_PATH.with_name(rss.DATABASE_PATH.name + suffix)
+                            for suffix in ("-wal", "-shm", ".spool")}
+    files = rss.STORAGE_PATH.iterdir() if files is None else files
+    return sorted(f for f in files if f not in skip and f.is_file())
+
+
+def export(files: Optional[Iterable[Path]] = None, out_dir: Optional[Path] = None,
+           part_size: int = DEFAULT_PART_SIZE) -> List[Path]:
+    """
+    :param files: storage files to export, all by default
+    :param out_dir: a new directory, by default one in EXPORT_PATH, so exports in progress or queued for sending
+        do not overwrite each other. remove it when the parts are sent, see :func:`remove_when_done`
+    :returns paths of the manifest and the archive parts in `out_dir`.
+        the parts are joined with `cat export.tar.gz.* > export.tar.gz`
+    """
+    if out_dir is None:
+        EXPORT_PATH.mkdir(parents=True, exist_ok=True)
+        out_dir = Path(tempfile.mkdtemp(prefix=f"{datetime.now():%Y%m%d_%H%M%S}_", dir=EXPORT_PATH))
+    else:
+        out_dir.mkdir(parents=True)
+    sources = _sources(files)
+    members = []
+    writer = _PartWriter(out_dir, ARCHIVE_NAME, part_size)
+    try:
+        with tarfile.open(fileobj=writer, mode="w|gz") as tar:  # streaming mode, nothing is kept in memory
+            for f in sources:
+                if f == rss.DATABASE_PATH:
+                    path = database.snapshot(rss.DATABASE_PATH, out_dir / f.name)
+                else:
+                    path = f
+                info = tar.gettarinfo(path, arcname=f.name)  # size is fixed here, a growing log is cut
+                with path.open("rb") as src:
+                    reader = _HashingReader(src)
+                    tar.addfile(info, reader)
+                members.append({"name": f.name, "size": info.size, "sha256": reader.hash.hexdigest()})
+                if path != f:
+                    path.unlink()
+    finally:
+        writer.close()
+    manifest = out_dir / MANIFEST_NAME
+    with manifest.open("wt") as f:
+        json.dump({
+            "archive": ARCHIVE_NAME,
+            "sha256": writer.total.hexdigest(),
+            "parts": writer.parts,
+            "files": members,
+        }, f, indent=1)
+    logging.getLogger(__name__).info(f"exported {len(members)} files into {len(writer.parts)} parts")
+    return [manifest] + [out_dir / p["name"] for p in writer.parts]
+
+
+def remove_when_done(out_dir: Path, fs: List[Future]):
+    """removes the export directory once all `fs` (the sending of its parts) are done, failed or cancelled"""
+    pending = len(fs)
+    lock = Lock()
+
+    def done(_):
+        nonlocal pending
+        with lock:
+            pending -= 1
+            if pending:
+                return
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    if not fs:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    for f in fs:
+        f.add_done_callback(done)
+
+
+class _HashingReader:
+    """hashes what tarfile reads from the file, so each file is read once"""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+
+def verify(manifest: Path) -> bool:
+    """checks the parts next to the manifest against their checksums"""
+    with manifest.open("rt") as f:
+        m = json.load(f)
+    return all(_sha256(manifest.parent / p["name"]) == p["sha256"] for p in m["parts"])
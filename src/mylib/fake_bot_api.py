@@ -0,0 +1,96 @@
+"""
+local stand-in for the telegram bot api, for load tests and tests of the bot.
+point a bot at it with `Updater(token, base_url=api.url)`
+"""
+import json
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import count
+from threading import Condition
+from time import monotonic, time
+from typing import Callable, Deque, List
+
+_BOT_INFO = {"id": 100001, "is_bot": True, "first_name": "bot", "username": "load_test_bot"}
+
+
+class _ApiRequestHandler(BaseHTTPRequestHandler):
+    server: "FakeBotApi"
+    protocol_version = "HTTP/1.1"  # keep-alive, as with the real api
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        params = json.loads(body) if self.headers.get("Content-Type", "").startswith("application/json") else {}
+        result = self.server.call(method, params)
+        out = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *_):
+        pass
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """
+    answers getMe, getUpdates (long polling, honouring `offset` and `timeout`) and every sending method.
+    texts sent by the bot are passed to `on_reply(chat_id, text)`
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int, on_reply: Callable[[int, str], None]):
+        super().__init__(("127.0.0.1", port), _ApiRequestHandler)
+        self.on_reply = on_reply
+        self._updates: Deque[dict] = deque()
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+        self._cond = Condition()
+        self._closed = False
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def push_message(self, user: int, text: str):
+        message_id = next(self._message_ids)
+        message = {
+            "message_id": message_id, "date": int(time()), "text": text,
+            "chat": {"id": user, "type": "private"}, "from": {"id": user, "is_bot": False, "first_name": "p"},
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        with self._cond:
+            self._updates.append({"update_id": next(self._update_ids), "message": message})
+            self._cond.notify_all()
+
+    def close(self):
+        """releases pending getUpdates"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def call(self, method: str, params: dict):
+        if method == "getMe":
+            return _BOT_INFO
+        if method == "getUpdates":
+            return self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0),
+                                     int(params.get("limit") or 100))
+        if method in ("deleteWebhook", "setWebhook", "answerCallbackQuery"):
+            return True
+        chat_id = int(params.get("chat_id", 0))
+        if "text" in params:
+            self.on_reply(chat_id, params["text"])
+        return {"message_id": next(self._message_ids), "date": int(time()), "text": params.get("text", ""),
+                "chat": {"id": chat_id, "type": "private"}, "from": _BOT_INFO}
+
+    def _get_updates(self, offset: int, timeout: float, limit: int) -> List[dict]:
+        deadline = monotonic() + timeout
+        with self._cond:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()  # confirmed by the offset
+            while not self._updates and not self._closed and monotonic() < deadline:
+                self._cond.wait(deadline - monotonic())
+            return [self._updates[i] for i in range(min(limit, len(self._updates)))]
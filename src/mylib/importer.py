@@ -0,0 +1,204 @@
+"""
+bulk import of actions collected offline. the table has the layout of the decode_db.py export
+(`time, action, email, chip_id, tg_id, action_description`), tab- or comma-separated, detected from the header.
+the participant is `tg_id`, or the owner of `chip_id` if it is empty, the email column is not imported.
+an action that is already in the database or earlier in the table (same user, action and second) is skipped.
+invalid rows are reported by line number, valid ones are inserted with executemany, one transaction per chunk.
+inside the bot the chunks are written by the db thread (database.ActionRowsData), with its spool and retries.
+from another process (import_actions.py) the chunks are written by an own connection, which competes with the
+db thread of a running bot for the write lock: chunks are sized so that a transaction holds it
+for about `transaction_seconds`, the db thread waits for it (and retries if it waits longer than its busy timeout)
+"""
+import csv
+import sqlite3 as sql
+from concurrent.futures import Future
+from contextlib import closing
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from time import monotonic
+from typing import Dict, List, Optional, Tuple, Set, Callable
+
+from . import database, resources as rss, messages as msg
+from .chips import ChipSet
+
+COLUMNS = ("time", "action", "email", "chip_id", "tg_id", "action_description")  # decode_db.TableRow.header()
+IMPORT_PATH = rss.STORAGE_PATH / "imports"  # tables uploaded to the bot
+DEFAULT_CHUNK_SIZE = 50_000  # maximal rows per transaction
+MIN_CHUNK_SIZE = 1000
+DEFAULT_TRANSACTION_SECONDS = 0.5  # the db thread of a running bot waits 5 s for the lock before it retries
+DEFAULT_BUSY_TIMEOUT = 60.  # seconds to wait for the db thread to release the database
+# russian names as the bot shows them, english ones as decode_db.py writes them
+ACTION_NAMES: Dict[str, database.actions] = {**{a.name: a for a in database.actions}, **msg.ru.STR_TO_ACTIONS}
+
+_READ_CHIP_OWNERS = "SELECT chip, user FROM Chips"
+_NEW_KEY_TABLE = """CREATE TEMP TABLE IF NOT EXISTS ImportKeys (
+    line INTEGER PRIMARY KEY,
+    user INTEGER,
+    date FLOAT,
+    action INTEGER
+)"""
+_INSERT_KEY = "INSERT INTO ImportKeys (line, user, date, action) VALUES (?, ?, ?, ?)"
+_READ_DUPLICATE_KEYS = """SELECT line FROM ImportKeys k WHERE EXISTS (SELECT * FROM Actions a
+WHERE a.user = k.user AND a.date >= k.date AND a.date < k.date + 1 AND a.action = k.action)"""
+_CLEAR_KEYS = "DELETE FROM ImportKeys"
+
+Row = Tuple[int, float, int, Optional[str]]  # user, timestamp, action value, description
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    imported: int = 0  # would be imported, in a dry run
+    duplicates: int = 0
+    errors: List[Tuple[int, str]] = field(default_factory=list)  # (line number, reason)
+
+    def summary(self) -> str:
+        return (f"{self.rows} rows: {self.imported} imported, {self.duplicates} duplicates skipped, "
+                f"{len(self.errors)} errors")
+
+    def write_errors(self, p: Path, sep: str = "\t") -> Path:
+        with p.open("wt") as f:
+            f.write(sep.join(("line", "error")) + "\n")
+            f.writelines(f"{line}{sep}{error}\n" for line, error in self.errors)
+        return p
+
+
+class TimeParser:
+    """
+    inverse of decode_db.TimeFormatter: local time formatted as `fmt` to epoch seconds.
+    if `fmt` ends with seconds, the date and time up to minutes are parsed once per minute
+    """
+    __slots__ = "fmt", "_prefix", "_minute"
+
+    def __init__(self, fmt: str = rss.DATETIME_FMT):
+        self.fmt = fmt
+        self._prefix = None
+        self._minute = 0.
+
+    def __call__(self, s: str) -> float:
+        """:raises ValueError"""
+        if not self.fmt.endswith("%S"):
+            return datetime.strptime(s, self.fmt).timestamp()
+        prefix, second = s[:-2], s[-2:]
+        if prefix != self._prefix:
+            self._minute = datetime.strptime(prefix, self.fmt[:-2]).timestamp()
+            self._prefix = prefix
+        if not (second.isdigit() and int(second) < 60):
+            raise ValueError(f"time data {s!r} does not match format {self.fmt!r}")
+        return self._minute + int(second)
+
+
+def _parse_row(fields: List[str], parse_time: Callable[[str], float], valid_chips: ChipSet,
+               owners: Dict[int, int]) -> Row:
+    """:raises ValueError with the reason"""
+    if len(fields) != len(COLUMNS):
+        raise ValueError(f"{len(fields)} columns instead of {len(COLUMNS)}")
+    time, action, _, chip, user, description = (f.strip() for f in fields)
+    try:
+        t = parse_time(time)
+    except ValueError:
+        raise ValueError(f"time {time!r} is not in the format {rss.DATETIME_FMT}")
+    a = ACTION_NAMES.get(action.lower())
+    if a is None:
+        raise ValueError(f"unknown action {action!r}")
+    owner = None
+    if chip:
+        if not chip.isdigit() or int(chip) not in valid_chips:
+            raise ValueError(f"chip {chip!r} is not in the chip list")
+        owner = owners.get(int(chip))
+    if user:
+        if not user.isdigit():
+            raise ValueError(f"tg_id {user!r} is not a number")
+        if owner is not None and owner != int(user):
+            raise ValueError(f"chip {chip} belongs to user {owner}")
+        owner = int(user)
+    elif owner is None:
+        raise ValueError(f"chip {chip} is not registered and tg_id is empty" if chip else "tg_id and chip_id are empty")
+    return owner, t, a.value, description or None
+
+
+def write_with_db_thread(rows: List[Row]) -> Future:
+    """`write` of :func:`import_file` in a process that runs the database singleton (the bot)"""
+    return database.db_write_future(database.ActionRowsData(tuple(rows)))
+
+
+def _write_chunk(conn: sql.Connection, chunk: List[Tuple[int, Row]], report: ImportReport, dry_run: bool,
+                 write: Optional[Callable[[List[Row]], Future]] = None) -> float:
+    """
+    without `write`, duplicates are looked up and the rows are written in one transaction,
+    holding the write lock from its start. with it, `conn` only reads and `write` commits the rows.
+    :returns seconds the rows took to be committed
+    """
+    conn.execute("BEGIN" if dry_run or write is not None else "BEGIN IMMEDIATE")
+    start = monotonic()
+    try:
+        conn.executemany(_INSERT_KEY, ((line, user, t, action) for line, (user, t, action, _) in chunk))
+        duplicates = {line for line, in conn.execute(_READ_DUPLICATE_KEYS)}
+        conn.execute(_CLEAR_KEYS)
+        rows = [row for line, row in chunk if line not in duplicates]
+        if not dry_run and write is None:
+            database.ActionData.to_db_many(conn, rows)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    if rows and not dry_run and write is not None:
+        write(rows).result()
+    report.duplicates += len(duplicates)
+    report.imported += len(rows)
+    return monotonic() - start
+
+
+def import_file(p: Path, db_path: Path, valid_chips: ChipSet, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                dry_run: bool = False, busy_timeout: float = DEFAULT_BUSY_TIMEOUT,
+                transaction_seconds: float = DEFAULT_TRANSACTION_SECONDS,
+                write: Optional[Callable[[List[Row]], Future]] = None) -> ImportReport:
+    """
+    the database may be in use by the bot, a bot notices an import of another process with its next commit.
+    :param chunk_size: maximal rows per transaction, a chunk is sized from the speed of the previous one
+        to last `transaction_seconds`
+    :param dry_run: rows are checked and duplicates are counted, nothing is written
+    :param write: commits the rows of a chunk, e.g. :func:`write_with_db_thread`,
+        the database is then only read here. None to write them with an own connection
+    """
+    report = ImportReport()
+    parse_time = TimeParser()
+    seen: Set[Tuple[int, int, int]] = set()  # (user, second, action) of the rows so far
+    with p.open("rt", encoding="utf-8-sig", newline="") as f, \
+            closing(sql.connect(db_path, timeout=busy_timeout) if write is None
+                    else database.connect_readonly(db_path)) as conn:
+        conn.isolation_level = None
+        header = f.readline().rstrip("\r\n")
+        sep = "\t" if "\t" in header else ","
+        if [c.strip() for c in header.split(sep)] != list(COLUMNS):
+            report.errors.append((1, f"the header is not {sep.join(COLUMNS)!r}"))
+            return report
+        owners = dict(conn.execute(_READ_CHIP_OWNERS).fetchall())
+        conn.execute(_NEW_KEY_TABLE)
+        reader = csv.reader(f, delimiter=sep, quoting=csv.QUOTE_NONE if sep == "\t" else csv.QUOTE_MINIMAL)
+        chunk: List[Tuple[int, Row]] = []
+        size = min(chunk_size, MIN_CHUNK_SIZE)  # of the next chunk
+        for fields in reader:
+            if not fields:
+                continue
+            line = reader.line_num + 1  # the header is line 1
+            report.rows += 1
+            try:
+                row = _parse_row(fields, parse_time, valid_chips, owners)
+            except ValueError as e:
+                report.errors.append((line, str(e)))
+                continue
+            key = (row[0], int(row[1]), row[2])
+            if key in seen:
+                report.duplicates += 1
+                continue
+            seen.add(key)
+            chunk.append((line, row))
+            if len(chunk) >= size:
+                seconds = _write_chunk(conn, chunk, report, dry_run, write)
+                size = min(chunk_size, max(MIN_CHUNK_SIZE, int(len(chunk) * transaction_seconds / max(seconds, 1e-3))))
+                chunk = []
+        if chunk:
+            _write_chunk(conn, chunk, report, dry_run, write)
+    return report
@@ -0,0 +1,162 @@
+"""
+logging pipeline: records are put into a queue by the threads that log them and written by a listener thread,
+so handlers never wait for the disk. the log file is rotated by size and time, rotated files are gzipped
+"""
+import gzip
+import json
+import logging
+import logging.handlers
+import multiprocessing as mp
+import shutil
+from copy import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from queue import Queue
+from time import time
+from typing import Optional
+
+DEFAULT_MAX_BYTES = 64 * 2**20
+DEFAULT_ROTATE_INTERVAL = 24 * 3600  # seconds
+DEFAULT_BACKUP_COUNT = 14
+TEXT_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+UPDATE_FIELDS = ("user", "conversation", "state", "handler", "outcome", "duration")
+
+_update: ContextVar[Optional[dict]] = ContextVar("update", default=None)  # fields of the update being handled
+_json_lines = False
+
+
+def json_lines() -> bool:
+    return _json_lines
+
+
+@contextmanager
+def update_context(**fields):
+    """records logged inside carry `fields`, see UPDATE_FIELDS"""
+    token = _update.set(fields)
+    try:
+        yield
+    finally:
+        _update.reset(token)
+
+
+class _UpdateFilter(logging.Filter):
+    """runs in the logging thread, before the record is queued"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        for k, v in (_update.get() or {}).items():
+            if not hasattr(record, k):
+                setattr(record, k, v)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """one json object per line"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "process": record.processName,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        exc = getattr(record, "exc", None) or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc:
+            entry["exc"] = exc
+        entry.update((k, getattr(record, k)) for k in UPDATE_FIELDS if getattr(record, k, None) is not None)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler.prepare merges the traceback into the message and drops exc_info,
+    for json lines the traceback is kept apart, as the `exc` field
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not (_json_lines and record.exc_info):
+            return super().prepare(record)
+        exc = logging.Formatter().formatException(record.exc_info)
+        record = copy(record)
+        record.exc_info = record.exc_text = None
+        record = super().prepare(record)
+        record.exc = exc
+        return record
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    rotates when the file would grow over `max_bytes` or every `interval` seconds, whichever comes first.
+    rotated files are named by the time of rotation, `backup_count` newest of them are kept
+    """
+
+    def __init__(self, path: Path, max_bytes: int = DEFAULT_MAX_BYTES, interval: float = DEFAULT_ROTATE_INTERVAL,
+                 backup_count: int = DEFAULT_BACKUP_COUNT, compress: bool = True):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval = interval
+        self.compress = compress
+        self.rollover_at = time() + interval if interval else float("inf")
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        return time() >= self.rollover_at or super().shouldRollover(record)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.rollover_at = time() + self.interval if self.interval else float("inf")
+        path = Path(self.baseFilename)
+        if not path.exists() or path.stat().st_size == 0:
+            return
+        stamp = f"{datetime.now():%Y%m%d_%H%M%S}"
+        rotated = path.with_name(f"{path.name}.{stamp}")
+        i = 0
+        while rotated.exists() or rotated.with_name(rotated.name + ".gz").exists():
+            i += 1
+            rotated = path.with_name(f"{path.name}.{stamp}_{i:03d}")
+        path.replace(rotated)
+        if self.compress:
+            with rotated.open("rb") as f_in, gzip.open(rotated.with_name(rotated.name + ".gz"), "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, 2**20)
+            rotated.unlink()
+        if self.backupCount > 0:
+            for old in sorted(path.parent.glob(f"{path.name}.*"))[:-self.backupCount]:
+                old.unlink()
+
+
+def _queue_handler(queue, level: int, json_lines: bool):
+    global _json_lines
+    _json_lines = json_lines
+    handler = _QueueHandler(queue)
+    handler.addFilter(_UpdateFilter())
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def setup(path: Optional[Path], level: int, json_lines: bool = False,
+          max_bytes: int = DEFAULT_MAX_BYTES, interval: float = DEFAULT_ROTATE_INTERVAL,
+          backup_count: int = DEFAULT_BACKUP_COUNT, compress: bool = True,
+          multiprocess: bool = False) -> logging.handlers.QueueListener:
+    """
+    :param path: log file, None to log to the console
+    :param json_lines: json objects instead of text lines
+    :param multiprocess: child processes may log into `listener.queue`, see :func:`setup_child`
+    :returns started listener, stop it on exit to write what is queued
+    """
+    if path is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = RotatingFileHandler(path, max_bytes, interval, backup_count, compress)
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(TEXT_FORMAT))
+    queue = mp.get_context("spawn").Queue() if multiprocess else Queue()
+    _queue_handler(queue, level, json_lines)
+    listener = logging.handlers.QueueListener(queue, handler)
+    listener.start()
+    return listener
+
+
+def setup_child(queue, level: int, json_lines: bool = False):
+    """logging of a child process goes into the queue of the parent's listener"""
+    _queue_handler(queue, level, json_lines)
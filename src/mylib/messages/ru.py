@@ -13,6 +13,7 @@ NO = "Нет"
 LOGIN = "Логин"
 COMPLETE_SURVEY = "Опрос"
 REGISTER_ACTION = "Регистрация действия"
+HISTORY = "История"
 MAIN_MENU = "Главное меню бота. Выберите действие."
 
 
@@ -25,6 +26,7 @@ LOGIN_CHIP_INPUT_ERR = "Формат номера чипа неправильн
 LOGIN_CHIP_PROG_ERR = "При регистрации чипа произошла ошибка. Попробуйте ввести номер чипа еще раз."
 LOGIN_CHIP_INVALID_ID = "Номер чипа {:04d} не действителен. Пожалуйста, введите другой номер."
 LOGIN_CHIP_COMPLETE = "Чип {:04d} успешно зарегистрирован."
+LOGIN_CHIP_TAKEN = "Чип {:04d} уже зарегистрирован другим участником. Пожалуйста, введите другой номер."
 
 LOGIN_EMAIL_ASK = "Пожалуйста, укажите свой email. Вы можете пропустить данный шаг, нажав сюда: /{skip_cmd}"
 LOGIN_EMAIL_INPUT_ERR = "Строка {} не разпознана как email-адрес. " \
@@ -56,7 +58,23 @@ ACTION_CONFIRMATION_ASK = \
     "Вы действительно хотите зарегистрировать: {action_data}?"
 ACTION_CONFIRMED = "Действие успешно зарегистрировано."
 ACTION_CANCELED = "Регистрация действия отменена."
+ACTION_EXPIRED = "Время ожидания истекло, зарегистрируйте действие заново."
+
+
+ONE_TAP_REGISTERED = "Зарегистрировано: {action_data}"
+ONE_TAP_DUPLICATE = "Это действие только что уже было зарегистрировано."
+ONE_TAP_UNREGISTERED = "Чтобы регистрировать действия касанием чипа, сначала зарегистрируйте чип: /start"
+ONE_TAP_FOREIGN_CHIP = "Чип {:04d} зарегистрирован не на вас."
+UNDO = "Отменить"
+UNDO_TOO_LATE = "Отменить регистрацию уже нельзя."
 
 
 ASK_ACTION_DESCRIPTION = "Пожалуйста, опишите в нескольких предложениях. Текст должен занимать одно сообщение."
 DESCRIPTION_TEMPLATE = "описание: {}"
+
+
+HISTORY_ARG_ERR = "Количество дней должно быть целым положительным числом, например: /{history_cmd} 7"
+HISTORY_EMPTY = "За выбранный период не зарегистрировано ни одного действия."
+HISTORY_NEWER = "<< Новее"
+HISTORY_OLDER = "Старше >>"
+HISTORY_CLOSE = "Закрыть"
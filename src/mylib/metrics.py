@@ -0,0 +1,202 @@
+"""
+in-process metrics: counters, gauges and histograms, rendered in the prometheus text format.
+everything is a no-op until :func:`enable` is called
+"""
+import logging
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+PREFIX = "bot_"
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)  # seconds
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_enabled = False
+_registry: List["_Metric"] = []
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _label_str(self, values: Tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labels, values)] + ([extra] if extra else [])
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        ...
+
+    @abstractmethod
+    def report(self) -> List[str]:
+        """short human-readable lines"""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[Tuple, float] = dict()
+
+    def inc(self, *label_values, amount: float = 1):
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._label_str(k)} {v}" for k, v in sorted(self._values.items())]
+
+    def report(self) -> List[str]:
+        return [s[len(PREFIX):] for s in self._samples()]
+
+
+class Gauge(_Metric):
+    """value is read from a function at render time"""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, doc)
+        self.fn = fn
+
+    def set_function(self, fn: Callable[[], float]):
+        self.fn = fn
+
+    def _samples(self) -> List[str]:
+        return [] if self.fn is None else [f"{self.name} {self.fn()}"]
+
+    def report(self) -> List[str]:
+        return [s[len(PREFIX):] for s in self._samples()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, List] = dict()  # label values -> [counts per bucket and +Inf, sum]
+
+    def observe(self, value: float, *label_values):
+        if not _enabled:
+            return
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(label_values)
+            if s is None:
+                s = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.]
+            s[0][i] += 1
+            s[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, *label_values)
+
+    def _snapshot(self) -> List[Tuple[Tuple, List[int], float]]:
+        with self._lock:
+            return [(k, list(counts), total) for k, (counts, total) in sorted(self._series.items())]
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for k, counts, total in self._snapshot():
+            cumulative = 0
+            for le, c in zip(self.buckets + ("+Inf", ), counts):
+                cumulative += c
+                le = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{self._label_str(k, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(k)} {total}")
+            lines.append(f"{self.name}_count{self._label_str(k)} {cumulative}")
+        return lines
+
+    def quantile(self, q: float, counts: List[int]) -> float:
+        """estimate by linear interpolation inside the bucket, the upper bound if it is +Inf"""
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, c in enumerate(counts):
+            if c and cumulative + c >= rank:
+                lo = self.buckets[i - 1] if i > 0 else 0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - cumulative) / c
+            cumulative += c
+        return 0.
+
+    def report(self) -> List[str]:
+        lines = []
+        for k, counts, total in self._snapshot():
+            n = sum(counts)
+            p50, p95, p99 = (self.quantile(q, counts) for q in (.5, .95, .99))
+            lines.append(f"{self.name[len(PREFIX):]}{self._label_str(k)} n={n} mean={total / n:.4g} "
+                         f"p50={p50:.4g} p95={p95:.4g} p99={p99:.4g}")
+        return lines
+
+
+def render() -> str:
+    """all metrics in the prometheus text exposition format"""
+    return "\n".join(line for m in _registry for line in m.render()) + "\n"
+
+
+def report() -> str:
+    """compact summary for admins"""
+    return "\n".join(line for m in _registry for line in m.report()) or "no metrics yet"
+
+
+def write_file(path: Path):
+    """for the textfile collector of node_exporter, the file is replaced atomically"""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(render())
+    tmp.replace(path)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt: str, *args):
+        logging.getLogger(__name__).debug(fmt % args)
+
+
+def serve(listen: str, port: int) -> ThreadingHTTPServer:
+    """serves `GET /metrics` from a daemon thread. :returns the server, `shutdown()` it to stop"""
+    server = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
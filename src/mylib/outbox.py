@@ -0,0 +1,333 @@
+"""
+outbound message scheduler. every message to users goes through it,
+so that bursts and bulk uploads stay within telegram rate limits instead of failing with 429
+"""
+import heapq
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
+from pathlib import Path
+from threading import Thread, Condition
+from time import monotonic
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram import Bot, Update, CallbackQuery, ParseMode
+from telegram.error import RetryAfter, TelegramError
+
+from . import metrics
+
+INTERACTIVE, BULK = 0, 1  # priorities, smaller ones are sent first
+MAX_MESSAGE_LENGTH = 4096
+
+DEFAULT_GLOBAL_RATE = 30.  # messages per second, telegram's limit for a bot
+DEFAULT_CHAT_RATE = 1.  # messages per second to one chat
+DEFAULT_CHAT_BURST = 3
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_BULK_IN_FLIGHT = 2  # bulk uploads never take all the workers
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_DRAIN_TIMEOUT = 10.  # seconds to send what is queued on termination
+
+_QUEUED = metrics.Gauge("outbox_queued", "messages waiting to be sent")
+_SEND_SECONDS = metrics.Histogram("outbox_send_seconds", "bot api call duration", ("method", ))
+_RETRIES = metrics.Counter("outbox_retries_total", "sends retried after 429", ("method", ))
+
+
+class TokenBucket:
+    __slots__ = "rate", "capacity", "tokens", "updated"
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """:returns when a token is available, a moment not later than `now` if it is already"""
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.updated + max(0., 1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.ready_at(now)
+        self.tokens -= 1
+
+    def pause(self, until: float):
+        """no tokens until `until`, as telegram asks in `retry_after`"""
+        self.tokens = min(self.tokens, 0.)
+        self.updated = max(self.updated, until)
+
+    def is_full(self, now: float) -> bool:
+        self.ready_at(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = "priority", "seq", "chat_id", "method", "kwargs", "futures", "attempts", "queued"
+
+    def __init__(self, priority: int, seq: int, chat_id: int, method: str, kwargs: dict):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.futures: List[Future] = [Future()]
+        self.attempts = 0
+        self.queued = True
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def coalesce(self, priority: int, method: str, kwargs: dict) -> Optional[Future]:
+        """appends a text message to this queued one if they can be sent as one"""
+        if not (self.queued and method == self.method == "send_message" and priority == self.priority):
+            return None
+        mine, theirs = dict(self.kwargs), dict(kwargs)
+        text = f"{mine.pop('text')}\n{theirs.pop('text')}"
+        if mine.pop("reply_markup", None) is not None or len(text) > MAX_MESSAGE_LENGTH:
+            return None
+        markup = theirs.pop("reply_markup", None)
+        if mine != theirs:  # parse mode and other options
+            return None
+        self.kwargs.update(text=text, reply_markup=markup)
+        self.futures.append(Future())
+        return self.futures[-1]
+
+
+class Outbox:
+    """
+    sends messages from worker threads, in order of priority, within a global and per chat token bucket.
+    interactive messages to one chat are sent one at a time and in order of submission,
+    bulk ones (documents) may be sent concurrently, up to `max_bulk_in_flight` in total.
+    on 429 the chat is paused for `retry_after` and the message is retried
+    """
+
+    def __init__(self, bot: Bot, global_rate: float = DEFAULT_GLOBAL_RATE, chat_rate: float = DEFAULT_CHAT_RATE,
+                 chat_burst: int = DEFAULT_CHAT_BURST, workers: int = DEFAULT_WORKERS,
+                 max_bulk_in_flight: int = DEFAULT_MAX_BULK_IN_FLIGHT, max_retries: int = DEFAULT_MAX_RETRIES):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_bulk_in_flight = max_bulk_in_flight
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate, monotonic())
+        self._buckets: Dict[int, TokenBucket] = dict()
+        self._queues: Dict[int, List[_Job]] = dict()  # heaps
+        # chats are picked from heaps, so a send does not look at every chat. entries are checked when they are
+        # popped: an entry whose head job is no longer the head of its chat is dropped, the chat has a newer one
+        self._ready: List[Tuple[int, int, int]] = []  # (priority, seq) of the head job, chat
+        self._waiting: List[Tuple[float, int]] = []  # (when the chat bucket has a token, chat)
+        self._bulk_blocked: Set[int] = set()  # chats with a bulk head job that wait for a free bulk slot
+        self._last: Dict[int, _Job] = dict()  # last submitted job of each chat, for coalescing
+        self._in_flight: Dict[int, _Job] = dict()  # interactive jobs being sent, by chat
+        self._bulk_in_flight = 0
+        self._seq = count()
+        self._cond = Condition()
+        self._stopping: Optional[float] = None  # drain deadline
+        self._last_gc = monotonic()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="outbox")
+        self._thread = Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id: int, method: str, priority: int = INTERACTIVE, **kwargs) -> Future:
+        """:param method: name of a :class:`telegram.Bot` method that takes `chat_id`"""
+        with self._cond:
+            if self._stopping is not None:
+                raise RuntimeError("outbox is terminated")
+            last = self._last.get(chat_id)
+            if last is not None:
+                future = last.coalesce(priority, method, kwargs)
+                if future is not None:
+                    return future
+            job = _Job(priority, next(self._seq), chat_id, method, kwargs)
+            heapq.heappush(self._queues.setdefault(chat_id, []), job)
+            self._schedule(chat_id)
+            self._last[chat_id] = job
+            self._cond.notify()
+            return job.futures[0]
+
+    def terminate(self, timeout: float = DEFAULT_DRAIN_TIMEOUT) -> Thread:
+        """stops accepting messages, queued ones are sent until `timeout` and cancelled after it"""
+        with self._cond:
+            self._stopping = monotonic() + timeout
+            self._cond.notify()
+        return self._thread
+
+    def queued(self) -> int:
+        with self._cond:
+            return sum(map(len, self._queues.values()))
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = monotonic()
+                if self._stopping is not None and (now >= self._stopping or not (
+                        self._queues or self._in_flight or self._bulk_in_flight)):
+                    break
+                job, wait = self._pick(now)
+                if job is None:
+                    self._cond.wait(wait)
+                    continue
+                self._pool.submit(self._send, job)
+                if now - self._last_gc > 60:
+                    self._gc(now)
+            for queue in self._queues.values():
+                for job in queue:
+                    for f in job.futures:
+                        f.cancel()
+            self._queues.clear()
+        self._pool.shutdown(wait=True)
+
+    def _pick(self, now: float) -> Tuple[Optional[_Job], Optional[float]]:
+        """:returns next job to send, or how long to wait for one (None if until a notification)"""
+        ready_at = self._global.ready_at(now)
+        if ready_at > now:
+            return None, ready_at - now
+        while self._waiting and self._waiting[0][0] <= now:
+            self._schedule(heapq.heappop(self._waiting)[1])
+        best: Optional[_Job] = None
+        while self._ready:
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            queue = self._queues.get(chat_id)
+            if not queue or queue[0].seq != seq:
+                continue
+            if priority >= BULK:
+                if self._bulk_in_flight >= self.max_bulk_in_flight:
+                    self._bulk_blocked.add(chat_id)  # scheduled again when a bulk job is done
+                    continue
+            elif chat_id in self._in_flight:
+                continue  # scheduled again when the job in flight is done
+            bucket = self._buckets.get(chat_id)
+            ready_at = now if bucket is None else bucket.ready_at(now)
+            if ready_at > now:
+                heapq.heappush(self._waiting, (ready_at, chat_id))
+                continue
+            best = heapq.heappop(queue)
+            break
+        if best is None:
+            return None, self._waiting[0][0] - now if self._waiting else None
+        chat_id = best.chat_id
+        if self._queues[chat_id]:
+            self._schedule(chat_id)
+        else:
+            del self._queues[chat_id]
+        best.queued = False
+        self._global.take(now)
+        if chat_id not in self._buckets:
+            self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        self._buckets[chat_id].take(now)
+        if best.priority >= BULK:
+            self._bulk_in_flight += 1
+        else:
+            self._in_flight[chat_id] = best
+        return best, None
+
+    def _schedule(self, chat_id: int):
+        """makes the head job of the chat a candidate of :meth:`_pick`"""
+        queue = self._queues.get(chat_id)
+        if queue:
+            heapq.heappush(self._ready, (queue[0].priority, queue[0].seq, chat_id))
+
+    def _gc(self, now: float):
+        """forgets chats that have nothing queued and have been quiet long enough to have a full bucket"""
+        self._last_gc = now
+        for chat_id in [c for c, b in self._buckets.items()
+                        if c not in self._queues and c not in self._in_flight and b.is_full(now)]:
+            del self._buckets[chat_id]
+            self._last.pop(chat_id, None)
+
+    def _send(self, job: _Job):
+        retry_after = None
+        start = monotonic()
+        try:
+            kwargs = dict(job.kwargs)
+            if isinstance(kwargs.get("document"), Path):
+                with kwargs["document"].open("rb") as f:
+                    kwargs["document"] = f
+                    result = getattr(self.bot, job.method)(chat_id=job.chat_id, **kwargs)
+            else:
+                result = getattr(self.bot, job.method)(chat_id=job.chat_id, **kwargs)
+            for f in job.futures:
+                f.set_result(result)
+        except RetryAfter as e:
+            _RETRIES.inc(job.method)
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                self._fail(job, e)
+            else:
+                retry_after = float(e.retry_after)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            _SEND_SECONDS.observe(monotonic() - start, job.method)
+            with self._cond:
+                if job.priority >= BULK:
+                    self._bulk_in_flight -= 1
+                    for chat_id in self._bulk_blocked:
+                        self._schedule(chat_id)
+                    self._bulk_blocked.clear()
+                else:
+                    del self._in_flight[job.chat_id]
+                    self._schedule(job.chat_id)
+                if retry_after is not None and self._stopping is not None and monotonic() >= self._stopping:
+                    for f in job.futures:
+                        f.cancel()
+                elif retry_after is not None:
+                    logging.getLogger(__name__).warning(f"chat {job.chat_id} flooded, retry in {retry_after}s")
+                    now = monotonic()
+                    if job.chat_id not in self._buckets:
+                        self._buckets[job.chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+                    self._buckets[job.chat_id].pause(now + retry_after)
+                    job.queued = True
+                    heapq.heappush(self._queues.setdefault(job.chat_id, []), job)
+                    self._schedule(job.chat_id)
+                self._cond.notify()
+
+    @staticmethod
+    def _fail(job: _Job, e: Exception):
+        level = logging.WARNING if isinstance(e, TelegramError) else logging.ERROR
+        logging.getLogger(__name__).log(level, f"failed to {job.method} to chat {job.chat_id}", exc_info=e)
+        for f in job.futures:
+            f.set_exception(e)
+
+
+# =================================== singleton ===========================================
+__outbox: Optional[Outbox] = None
+
+
+def outbox_init(bot: Bot, **kwargs):
+    """:param kwargs: passed to :class:`Outbox`"""
+    global __outbox
+    __outbox = Outbox(bot, **kwargs)
+    _QUEUED.set_function(__outbox.queued)
+
+
+def outbox_terminate(timeout: float = DEFAULT_DRAIN_TIMEOUT) -> Thread:
+    """:returns thread to join, it ends when queued messages are sent or cancelled"""
+    return __outbox.terminate(timeout)
+
+
+def send(chat_id: int, method: str, priority: int = INTERACTIVE, **kwargs) -> Future:
+    return __outbox.submit(chat_id, method, priority, **kwargs)
+
+
+def reply_text(update: Update, text: str, priority: int = INTERACTIVE, **kwargs) -> Future:
+    return send(update.effective_chat.id, "send_message", priority, text=text, **kwargs)
+
+
+def reply_markdown(update: Update, text: str, priority: int = INTERACTIVE, **kwargs) -> Future:
+    return reply_text(update, text, priority, parse_mode=ParseMode.MARKDOWN, **kwargs)
+
+
+def reply_document(update: Update, document: Path, priority: int = BULK, **kwargs) -> Future:
+    """the file is opened when it is its turn to be sent"""
+    return send(update.effective_chat.id, "send_document", priority, document=document, **kwargs)
+
+
+def edit_message_text(query: CallbackQuery, text: str, **kwargs) -> Future:
+    return send(query.message.chat_id, "edit_message_text", message_id=query.message.message_id, text=text, **kwargs)
+
+
+def edit_message_reply_markup(query: CallbackQuery, reply_markup=None) -> Future:
+    return send(query.message.chat_id, "edit_message_reply_markup",
+                message_id=query.message.message_id, reply_markup=reply_markup)
@@ -1,7 +1,8 @@
 """just some general things here"""
 import re
 from pathlib import Path
-from typing import Set
+
+from .chips import ChipSet
 
 SURVERY_URL = "https://docs.google.com/forms/d/e/1FAIpQLSe4zwAsOisipPy9Jr1OW19zmaspXh-w0aLaUzbSQt3t2o0Utg" \
               "/viewform?usp=pp_url&entry.851864411={chip_id:04d}"
@@ -11,10 +12,11 @@ DATETIME_FMT = "%Y/%m/%d %H:%M:%S"
 
 EMAIL_REGEX = re.compile(r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$")
 CHIP_ID_REGEX = re.compile(r"^[0-9]{4}$")
+ONE_TAP_PAYLOAD_REGEX = re.compile(r"^([0-9]{4})_([a-z_]+|[0-9]+)$")  # `/start` deep-link payload: <chip>_<action>
 
 STORAGE_PATH = (Path(__file__) / "../../../storage/").resolve()
 CHIPS_PATH = STORAGE_PATH / "chips.txt"
 DATABASE_PATH = STORAGE_PATH / "db.sqlite3"
 
 
-valid_chips: Set[int] = set()
+valid_chips = ChipSet()  # kept in sync with CHIPS_PATH by a chips.ChipRegistry
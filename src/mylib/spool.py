@@ -0,0 +1,109 @@
+"""
+append-only spool of queued database writes. a write is appended to the file before it is queued,
+a background thread fsyncs the file in groups, so a crashed process loses none of the writes it has confirmed
+(a power loss: the last `fsync_interval` seconds at most).
+records are numbered, the database stores the number of the last committed one,
+the file is emptied whenever everything in it is committed
+"""
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path
+from threading import Thread, Lock, Event
+from time import sleep
+from typing import Callable, List, Tuple
+
+from . import metrics
+
+DEFAULT_FSYNC_INTERVAL = 0.02  # seconds
+
+_CRC = struct.Struct("<I")  # crc32 of the header and the payload
+_HEADER = struct.Struct("<QI")  # sequence number, payload length
+
+_FSYNC_SECONDS = metrics.Histogram("db_spool_fsync_seconds", "group fsync of the write spool")
+
+
+class Spool:
+    """
+    :param committed: number of the last record that is in the database.
+        the newer records found in the file are in `pending`, replay them, commit and call :meth:`committed`
+        before the first :meth:`append`: that empties the file and drops a torn record at its end
+    """
+
+    def __init__(self, path: Path, committed: int, fsync_interval: float = DEFAULT_FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.pending: List[Tuple[int, bytes]] = self._read(committed)  # (number, payload)
+        self.seq = max([committed] + [seq for seq, _ in self.pending])  # number of the last appended record
+        self.committed_seq = committed  # number of the last committed record
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._size = os.fstat(self._fd).st_size
+        self._lock = Lock()
+        self._dirty = Event()
+        self._closed = False
+        self._thread = Thread(target=self._run, name="db_spool", daemon=True)
+        self._thread.start()
+
+    def append(self, payload: bytes, then: Callable[[], None]):
+        """
+        writes a record, `then` (queueing the write) is called under the same lock, so the queue is in record order.
+        the record is in the os cache on return, it reaches the disk with the next group fsync
+        """
+        with self._lock:
+            if self._closed:
+                logging.getLogger(__name__).warning("write after the spool is closed")
+            else:
+                header = _HEADER.pack(self.seq + 1, len(payload))
+                record = _CRC.pack(zlib.crc32(payload, zlib.crc32(header))) + header + payload
+                if os.write(self._fd, record) != len(record):
+                    os.ftruncate(self._fd, self._size)  # appends after a partial record would be unreadable
+                    raise OSError(f"short write to {self.path}")
+                self.seq += 1
+                self._size += len(record)
+                self._dirty.set()
+            then()
+
+    def committed(self, seq: int):
+        """records up to `seq` are committed, the file is emptied if there are no newer ones"""
+        with self._lock:
+            self.committed_seq = seq
+            if seq == self.seq and self._size:
+                os.ftruncate(self._fd, 0)
+                self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._dirty.set()
+        self._thread.join()
+        os.close(self._fd)
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            sleep(self.fsync_interval)  # appends in the meantime join the group
+            self._dirty.clear()
+            with _FSYNC_SECONDS.time():
+                os.fsync(self._fd)
+            if self._closed:
+                return
+
+    def _read(self, committed: int) -> List[Tuple[int, bytes]]:
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return []
+        records, pos = [], 0
+        while pos + _CRC.size + _HEADER.size <= len(data):
+            (crc, ), (seq, length) = _CRC.unpack_from(data, pos), _HEADER.unpack_from(data, pos + _CRC.size)
+            start = pos + _CRC.size + _HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload, zlib.crc32(data[pos + _CRC.size:start])) != crc:
+                break
+            if seq > committed:
+                records.append((seq, payload))
+            pos = start + length
+        if pos < len(data):
+            logging.getLogger(__name__).warning(f"torn record at the end of {self.path}, {len(data) - pos} bytes")
+        return records
@@ -0,0 +1,121 @@
+"""webhook ingestion: a small http server that feeds telegram updates to the dispatcher"""
+import hmac
+import json
+import logging
+import ssl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue
+from secrets import token_urlsafe
+from threading import Event
+from time import sleep
+from typing import Optional, List
+
+from telegram import Bot, Update
+from telegram.error import TelegramError, Unauthorized
+from telegram.ext import Updater
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: "WebhookServer"
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            return self._respond(404)
+        token = self.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.server.secret_token.encode()):
+            logging.getLogger(__name__).warning(f"webhook request with a wrong secret token from {self.client_address}")
+            return self._respond(403)
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            update = Update.de_json(data, self.server.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.getLogger(__name__).warning(f"malformed webhook request: {e!r}")
+            return self._respond(400)
+        self.server.update_queue.put(update)  # dispatcher workers handle it, telegram gets its answer right away
+        self._respond(200)
+
+    def _respond(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, fmt: str, *args):
+        logging.getLogger(__name__).debug(fmt % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """accepts telegram updates POSTed to `url_path` that carry the right secret token header"""
+    daemon_threads = True
+
+    def __init__(self, listen: str, port: int, url_path: str, bot: Bot, update_queue: Queue,
+                 secret_token: str, ssl_ctx: Optional[ssl.SSLContext] = None):
+        super().__init__((listen, port), _WebhookRequestHandler)
+        self.url_path = url_path
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+        if ssl_ctx is not None:
+            self.socket = ssl_ctx.wrap_socket(self.socket, server_side=True)
+
+    def serve_forever(self, poll_interval: float = 0.5, ready: Event = None):
+        if ready is not None:
+            ready.set()
+        super().serve_forever(poll_interval)
+
+
+class WebhookUpdater(Updater):
+    """
+    :meth:`Updater.start_webhook` that serves updates with :class:`WebhookServer`
+    and registers the webhook with a secret token, which the server checks.
+    without `cert` and `key` the server speaks plain http, so TLS can be terminated by a reverse proxy
+    """
+
+    def __init__(self, *args, secret_token: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.secret_token = secret_token or token_urlsafe(32)
+
+    def _start_webhook(self, listen: str, port: int, url_path: str, cert: str, key: str,
+                       bootstrap_retries: int, drop_pending_updates: bool, webhook_url: str,
+                       allowed_updates: List[str], ready: Event = None, ip_address: str = None,
+                       max_connections: int = 40):
+        if not url_path.startswith("/"):
+            url_path = f"/{url_path}"
+        ssl_ctx = None
+        if cert is not None and key is not None:
+            ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_ctx.load_cert_chain(cert, key)
+        self.httpd = WebhookServer(listen, port, url_path, self.bot, self.update_queue, self.secret_token, ssl_ctx)
+        self._set_webhook(
+            webhook_url or self._gen_webhook_url(listen, port, url_path), cert, bootstrap_retries,
+            drop_pending_updates, allowed_updates, ip_address, max_connections,
+        )
+        self.httpd.serve_forever(ready=ready)
+
+    def _set_webhook(self, url: str, cert: Optional[str], retries: int, drop_pending_updates: bool,
+                     allowed_updates: List[str], ip_address: str, max_connections: int, retry_interval: float = 5):
+        attempt = 0
+        while True:
+            try:
+                with (open(cert, "rb") if cert is not None else _NoFile()) as cert_file:
+                    self.bot.set_webhook(
+                        url=url, certificate=cert_file, allowed_updates=allowed_updates, ip_address=ip_address,
+                        drop_pending_updates=drop_pending_updates, max_connections=max_connections,
+                        secret_token=self.secret_token,
+                    )
+                return
+            except TelegramError as e:
+                attempt += 1
+                if isinstance(e, Unauthorized) or 0 <= retries < attempt:
+                    raise
+                logging.getLogger(__name__).warning(f"failed to set webhook, try={attempt} max_retries={retries}")
+                sleep(retry_interval)
+
+
+class _NoFile:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *_):
+        pass
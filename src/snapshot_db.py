@@ -0,0 +1,29 @@
+"""
+this script makes a consistent copy of ../storage/db.sqlite3 while the bot is running.
+usage: snapshot_db.py [-h] [--gzip] [db_path] [out_path],
+paths default to ../storage/db.sqlite3 and ../storage/db_copy.sqlite3 (the input of decode_db.py)
+"""
+import sys
+
+
+def _check(cond: bool, err_msg: str):
+    if not cond:
+        print(err_msg, file=sys.stderr)
+        sys.exit(1)
+
+
+_check(__name__ == "__main__", err_msg="snapshot_db.py is a script, it cannot be imported")
+
+from pathlib import Path
+from argparse import ArgumentParser
+from mylib import (database, resources as rss)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="copies a live database through the sqlite online backup api")
+    parser.add_argument("db_path", nargs="?", type=Path, default=rss.DATABASE_PATH)
+    parser.add_argument("out_path", nargs="?", type=Path, default=rss.STORAGE_PATH / "db_copy.sqlite3")
+    parser.add_argument("--gzip", action="store_true", help="compress the copy")
+    args = parser.parse_args()
+    _check(args.db_path.exists(), err_msg=f"{args.db_path} does not exist.")
+    print(f"Success, {database.snapshot(args.db_path, args.out_path, compress=args.gzip)}")
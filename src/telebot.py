@@ -1,15 +1,19 @@
 #!/usr/bin/python
 import logging
 from pathlib import Path
-from typing import Set
 
 from setproctitle import setproctitle
 from telegram.ext import Updater
 
 from mylib import (
     resources as rss,
+    aio,
     bot_builder,
     database,
+    chips,
+    logs,
+    metrics,
+    outbox,
 )
 
 # ==================== configuration reading functions ==========================
@@ -17,8 +21,46 @@ default_cfg = {
     "process_title": "bot",
     "log_to_console": False,
     "logging_level": "debug",
+    "log_format": "text",  # or "json": a json object per line, with user, conversation state and handler duration
+    "log_max_bytes": logs.DEFAULT_MAX_BYTES,  # bot.log is rotated when it grows over it or every rotate interval
+    "log_rotate_interval": logs.DEFAULT_ROTATE_INTERVAL,  # seconds, null to rotate by size only
+    "log_backup_count": logs.DEFAULT_BACKUP_COUNT,  # rotated logs are gzipped
     "api_token": "12345",
-    "bot_password": None
+    "bot_password": None,
+    "db_max_batch_size": database.DEFAULT_MAX_BATCH_SIZE,
+    "db_max_commit_delay": database.DEFAULT_MAX_COMMIT_DELAY,
+    "db_read_pool_size": database.DEFAULT_READ_POOL_SIZE,
+    "db_checkpoint_interval": database.DEFAULT_CHECKPOINT_INTERVAL,
+    "db_user_cache_size": database.DEFAULT_USER_CACHE_SIZE,
+    "db_spool": True,  # queued writes are kept in a file until committed, so a crash does not lose them
+    "db_spool_fsync_interval": database.DEFAULT_SPOOL_FSYNC_INTERVAL,
+    "outbox_global_rate": outbox.DEFAULT_GLOBAL_RATE,
+    "outbox_chat_rate": outbox.DEFAULT_CHAT_RATE,
+    "outbox_workers": outbox.DEFAULT_WORKERS,
+    "chips_reload_interval": 30,  # seconds between checks of the chip file for changes
+    "workers": 1,  # more than 1 runs handlers in that many processes and the db in another one, see mylib/cluster.py
+    "runtime": "threads",  # or "asyncio": handlers that wait for the db are coroutines on one event loop thread
+    "webhook": None,  # null to use long polling
+    "metrics": None,  # null to disable instrumentation
+}
+
+default_metrics_cfg = {
+    "listen": "127.0.0.1",  # prometheus scrapes http://listen:port/metrics, null port for no endpoint
+    # with several workers, process i serves its metrics at port + 1 + i (workers, then the db writer)
+    "port": None,
+    "file": None,  # path of a file for the node_exporter textfile collector
+    "file_interval": 15,  # seconds
+}
+
+default_webhook_cfg = {
+    "listen": "127.0.0.1",  # address of the local http server, a reverse proxy forwards to it
+    "port": 8443,
+    "url_path": "bot",
+    "webhook_url": None,  # public url telegram sends updates to, e.g. "https://example.com/bot"
+    "secret_token": None,  # random on every start if null
+    "cert": None,  # paths to the TLS certificate and key, null if the proxy terminates TLS
+    "key": None,
+    "max_connections": 40,
 }
 
 
@@ -38,52 +80,122 @@ def get_config(p: Path) -> dict:
 
 default_chip_file = """# comment lines start with `#`
 # each chip id is a 4 digit decimal number on a separate line
+# a range of ids is written as `first-last`, both ids included
+# the file is re-read when it changes, an invalid file is logged and ignored
 0001  # because of additional text on the line this chip will be invalid
 1234
+2000-2099
 """
 
 
-def get_chips(p: Path) -> Set[int]:
+def get_chips(p: Path) -> chips.ChipRegistry:
     """if file is not found attempts to write into that location a default file"""
     if not p.exists():
         with p.open("wt") as f:
             f.write(default_chip_file)
         raise FileNotFoundError(f"{p} did not exist, wrote default dummy list to that location")
 
-    with p.open("rt") as f:
-        lines = [(i+1, c) for (i, c) in enumerate(f.readlines()) if not c.startswith("#")]
-    if len(lines) == 0:
-        raise ValueError(f"chip file {p} is empty")
-    invalid = [(i, c) for i, c in lines if not rss.CHIP_ID_REGEX.match(c)]
-    if len(invalid) > 0:
-        raise ValueError(
-            "Following invalid chips detected:\n" +
-            "\n".join(f"{i}: {c}" for i, c in invalid)
-        )
-    return {int(c) for _, c in lines}
+    registry = chips.ChipRegistry(p, rss.valid_chips)
+    registry.load()
+    return registry
 
 
 # ================================ main ====================================================
 if __name__ == "__main__":
     # read configs
     cfg = get_config(rss.STORAGE_PATH / "../private/bot_config.json")
-    rss.valid_chips.update(get_chips(rss.CHIPS_PATH))
-    del get_chips, get_config, default_chip_file, default_cfg
+    chip_registry = get_chips(rss.CHIPS_PATH)
+    webhook_cfg = None if cfg.get("webhook") is None else {**default_webhook_cfg, **cfg["webhook"]}
+    metrics_cfg = None if cfg.get("metrics") is None else {**default_metrics_cfg, **cfg["metrics"]}
+    del get_chips, get_config, default_chip_file, default_cfg, default_webhook_cfg, default_metrics_cfg
 
     # setup
     setproctitle(cfg["process_title"])  # send SIGTERM to this name to correctly terminate the bot
-    logging.basicConfig(
-        filename=None if cfg["log_to_console"] else rss.STORAGE_PATH / "bot.log",
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    workers = cfg.get("workers", 1)
+    log_listener = logs.setup(
+        path=None if cfg["log_to_console"] else rss.STORAGE_PATH / "bot.log",
         level=cfg["logging_level"],
+        json_lines=cfg.get("log_format", "text") == "json",
+        max_bytes=cfg.get("log_max_bytes", logs.DEFAULT_MAX_BYTES),
+        interval=cfg.get("log_rotate_interval", logs.DEFAULT_ROTATE_INTERVAL),
+        backup_count=cfg.get("log_backup_count", logs.DEFAULT_BACKUP_COUNT),
+        multiprocess=workers > 1,
+    )
+    log_kwargs = dict(queue=log_listener.queue, level=cfg["logging_level"], json_lines=logs.json_lines())
+    if metrics_cfg is not None:
+        metrics.enable()
+    db_kwargs = dict(
+        max_batch_size=cfg.get("db_max_batch_size", database.DEFAULT_MAX_BATCH_SIZE),
+        max_commit_delay=cfg.get("db_max_commit_delay", database.DEFAULT_MAX_COMMIT_DELAY),
+        read_pool_size=cfg.get("db_read_pool_size", database.DEFAULT_READ_POOL_SIZE),
+        checkpoint_interval=cfg.get("db_checkpoint_interval", database.DEFAULT_CHECKPOINT_INTERVAL),
+        user_cache_size=cfg.get("db_user_cache_size", database.DEFAULT_USER_CACHE_SIZE),
+        spool=cfg.get("db_spool", True),
+        spool_fsync_interval=cfg.get("db_spool_fsync_interval", database.DEFAULT_SPOOL_FSYNC_INTERVAL),
+    )
+    outbox_kwargs = dict(
+        global_rate=cfg.get("outbox_global_rate", outbox.DEFAULT_GLOBAL_RATE),
+        chat_rate=cfg.get("outbox_chat_rate", outbox.DEFAULT_CHAT_RATE),
+        workers=cfg.get("outbox_workers", outbox.DEFAULT_WORKERS),
     )
-    database.db_init(db_path=rss.DATABASE_PATH)
-    updater = bot_builder.build_bot(Updater(cfg["api_token"]), password=cfg["bot_password"])
+    cluster = None
+    runtime = aio.AsyncRuntime() if cfg.get("runtime", "threads") == "asyncio" and workers == 1 else None
+    if workers > 1:
+        from mylib.cluster import Cluster
+        cluster = Cluster(
+            workers, cfg["api_token"], cfg["process_title"], log_kwargs, db_kwargs, outbox_kwargs,
+            password=cfg["bot_password"], chips_reload_interval=cfg.get("chips_reload_interval", 30),
+            metrics_listen=None if metrics_cfg is None else metrics_cfg["listen"],
+            metrics_port=None if metrics_cfg is None else metrics_cfg["port"],
+            async_runtime=cfg.get("runtime", "threads") == "asyncio",
+        )
+        persistence = None  # conversations are in the workers
+    else:
+        database.db_init(db_path=rss.DATABASE_PATH, **db_kwargs)
+        persistence = bot_builder.ConversationPersistence(
+            rss.STORAGE_PATH / "conversations.pickle", bot_builder.pending_action_data)
+    if webhook_cfg is None:
+        updater = Updater(cfg["api_token"], persistence=persistence)
+    else:
+        from mylib.webhook import WebhookUpdater
+        updater = WebhookUpdater(cfg["api_token"], persistence=persistence, secret_token=webhook_cfg["secret_token"])
+    if cluster is not None:
+        cluster.route(updater.dispatcher)
+    else:
+        outbox.outbox_init(updater.bot, **outbox_kwargs)
+        if runtime is not None:
+            runtime.start()
+        updater = bot_builder.build_bot(updater, password=cfg["bot_password"], runtime=runtime)
+        updater.job_queue.run_repeating(
+            lambda _: chip_registry.reload_if_changed(), interval=cfg.get("chips_reload_interval", 30))
+    if metrics_cfg is not None and metrics_cfg["port"] is not None:
+        metrics.serve(metrics_cfg["listen"], metrics_cfg["port"])
+    if metrics_cfg is not None and metrics_cfg["file"] is not None:
+        updater.job_queue.run_repeating(
+            lambda _: metrics.write_file(Path(metrics_cfg["file"])), interval=metrics_cfg["file_interval"])
 
     # work
-    updater.start_polling()  # starts worker threads
+    if webhook_cfg is None:
+        updater.start_polling()  # starts worker threads
+    else:
+        updater.start_webhook(  # starts worker threads and the http server
+            listen=webhook_cfg["listen"],
+            port=webhook_cfg["port"],
+            url_path=webhook_cfg["url_path"],
+            cert=webhook_cfg["cert"],
+            key=webhook_cfg["key"],
+            webhook_url=webhook_cfg["webhook_url"],
+            max_connections=webhook_cfg["max_connections"],
+        )
     updater.idle()  # blocks main thread until SIGTERM, SIGABRT, SIGINT
 
     # shutdown
-    db_thread, db_path = database.db_terminate()
-    db_thread.join()
+    if cluster is not None:
+        cluster.terminate()
+    else:
+        if runtime is not None:
+            runtime.stop()
+        outbox.outbox_terminate().join()
+        db_thread, db_path = database.db_terminate()
+        db_thread.join()
+    log_listener.stop()  # writes what is queued
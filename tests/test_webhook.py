@@ -0,0 +1,69 @@
+import json
+from threading import Event, Thread
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+from telegram import Update
+from telegram.ext import CommandHandler, CallbackContext
+
+from mylib.fake_bot_api import FakeBotApi
+from mylib.webhook import WebhookUpdater, SECRET_TOKEN_HEADER
+
+_TOKEN = "100001:webhook_test"
+_SECRET = "s3cret"
+_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1, "date": 0, "text": "/start",
+        "chat": {"id": 42, "type": "private"}, "from": {"id": 42, "is_bot": False, "first_name": "p"},
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+
+@pytest.fixture
+def bot():
+    """:returns (url of the webhook, replies sent through the fake api, event set on the first reply)"""
+    replies, replied = [], Event()
+
+    def on_reply(chat_id: int, text: str):
+        replies.append((chat_id, text))
+        replied.set()
+
+    api = FakeBotApi(0, on_reply)
+    Thread(target=api.serve_forever, daemon=True).start()
+    updater = WebhookUpdater(_TOKEN, base_url=api.url, secret_token=_SECRET)
+
+    def start(update: Update, _: CallbackContext):
+        update.message.reply_text("hello")
+    updater.dispatcher.add_handler(CommandHandler("start", start))
+    updater.start_webhook(listen="127.0.0.1", port=0, url_path="bot", webhook_url="https://example.com/bot")
+    yield f"http://127.0.0.1:{updater.httpd.server_address[1]}/bot", replies, replied
+    updater.stop()
+    api.close()
+    api.shutdown()
+
+
+def _post(url: str, secret: str) -> int:
+    request = Request(url, data=json.dumps(_UPDATE).encode(), method="POST",
+                      headers={"Content-Type": "application/json", SECRET_TOKEN_HEADER: secret})
+    try:
+        with urlopen(request, timeout=5) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+
+def test_wrong_secret_token_is_rejected(bot):
+    url, replies, replied = bot
+    assert _post(url, "wrong") == 403
+    assert not replied.wait(.5)
+    assert replies == []
+
+
+def test_update_is_dispatched_and_answered(bot):
+    url, replies, replied = bot
+    assert _post(url, _SECRET) == 200
+    assert replied.wait(5)
+    assert replies == [(42, "hello")]